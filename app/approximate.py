@@ -0,0 +1,358 @@
+import math
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from statistics import NormalDist
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import text
+
+from app.config import FAST_MODE_CONFIDENCE, FAST_MODE_UPGRADE_TTL_SECONDS, SAMPLE_TABLE
+from app.models import ExecutionResult
+from app.sql_lexer import PUNCT, QUOTED_IDENT, SEMICOLON, WORD, Token, tokenize
+from app.sql_to_db import get_db_engine
+
+SOURCE_TABLE = "TRANSACTIONS"
+WEIGHT = "sample_weight"
+# Агрегаты, оценка которых по выборке масштабируется весами строк
+SCALABLE_AGGREGATES = {"COUNT", "SUM", "AVG"}
+# Агрегаты, которые по выборке не оцениваются (экстремумы, квантили, списки)
+UNSCALABLE_AGGREGATES = {
+    "MIN", "MAX", "STRING_AGG", "ARRAY_AGG", "JSON_AGG", "JSONB_AGG", "BOOL_AND", "BOOL_OR", "EVERY",
+    "PERCENTILE_CONT", "PERCENTILE_DISC", "MODE", "STDDEV", "STDDEV_POP", "STDDEV_SAMP",
+    "VARIANCE", "VAR_POP", "VAR_SAMP", "CORR", "COVAR_POP", "COVAR_SAMP",
+}
+# Конструкции, при которых запрос выполняется точно
+UNSUPPORTED_KEYWORDS = {
+    "WITH": "CTEs", "JOIN": "joins", "UNION": "set operations", "INTERSECT": "set operations",
+    "EXCEPT": "set operations", "OVER": "window functions", "DISTINCT": "DISTINCT", "FILTER": "aggregate FILTER",
+}
+# Предложения, которые могут следовать за FROM transactions [alias]
+FROM_FOLLOWERS = {"WHERE", "GROUP", "HAVING", "ORDER", "LIMIT", "OFFSET", "FETCH", "WINDOW"}
+# Префикс служебных столбцов с суммами для дисперсии
+HIDDEN_PREFIX = "_sample_"
+# Как долго кэшируются параметры выборки из <SAMPLE_TABLE>_info
+SAMPLE_INFO_TTL_SECONDS = 60
+MAX_PENDING_UPGRADES = 1000
+
+
+class ApproximationUnavailable(Exception):
+    """Запрос нельзя выполнить по выборке (причина - в сообщении), выполняется точный запрос"""
+
+
+class Estimate(NamedTuple):
+    column: str             # имя столбца результата
+    aggregate: str          # COUNT | SUM | AVG
+    hidden: Tuple[str, ...] # служебные столбцы с суммами для дисперсии
+
+
+class SampleQuery(NamedTuple):
+    sql: str
+    estimates: List[Estimate]   # столбцы, для которых считается доверительный интервал
+
+
+class SampleInfo(NamedTuple):
+    built_at: str
+    sample_rate: float
+    source_rows: int
+    sample_rows: int
+    strata: int
+
+
+def _end(token: Token) -> int:
+    return token.position + len(token.value) + (2 if token.kind == QUOTED_IDENT else 0)
+
+
+def _matching_parens(tokens: List[Token]) -> Dict[int, int]:
+    """Индекс '(' -> индекс парной ')'"""
+    pairs: Dict[int, int] = {}
+    stack: List[int] = []
+    for index, token in enumerate(tokens):
+        if token.kind == PUNCT and token.value == "(":
+            stack.append(index)
+        elif token.kind == PUNCT and token.value == ")" and stack:
+            pairs[stack.pop()] = index
+    if stack:
+        raise ApproximationUnavailable("unbalanced parentheses")
+    return pairs
+
+
+def _is_call(tokens: List[Token], index: int) -> bool:
+    return (
+        index + 1 < len(tokens) and tokens[index].kind == WORD
+        and tokens[index + 1].kind == PUNCT and tokens[index + 1].value == "("
+        and not (index > 0 and tokens[index - 1].value == ".")
+    )
+
+
+def _identifier(sql: str, token: Token) -> str:
+    """Имя столбца результата, как его вернет PostgreSQL"""
+    return token.value if token.kind == QUOTED_IDENT else sql[token.position:_end(token)].lower()
+
+
+def _scaled(aggregate: str, argument: str) -> str:
+    """Оценка агрегата по всей таблице (взвешенная сумма Хорвица-Томпсона)"""
+    if aggregate == "COUNT" and argument == "*":
+        return f"ROUND(COALESCE(SUM({WEIGHT}), 0))::bigint"
+    if aggregate == "COUNT":
+        return f"ROUND(COALESCE(SUM(CASE WHEN ({argument}) IS NOT NULL THEN {WEIGHT} END), 0))::bigint"
+    if aggregate == "SUM":
+        return f"SUM(({argument}) * {WEIGHT})"
+    return f"(SUM(({argument}) * {WEIGHT}) / NULLIF(SUM(CASE WHEN ({argument}) IS NOT NULL THEN {WEIGHT} END), 0))"
+
+
+def _variance_terms(aggregate: str, argument: str) -> List[str]:
+    """
+    Суммы для оценки дисперсии: Var(sum w*y) ~ sum w*(w-1)*y^2 (пуассоновское приближение,
+    выигрыш от стратификации не учитывается - интервалы консервативные).
+    Для AVG (отношение оценок) - линеаризация по отклонениям от среднего.
+    """
+    factor = f"{WEIGHT} * ({WEIGHT} - 1)"
+    present = f"({argument}) IS NOT NULL"
+    if aggregate == "COUNT" and argument == "*":
+        return [f"SUM({factor})"]
+    if aggregate == "COUNT":
+        return [f"SUM(CASE WHEN {present} THEN {factor} END)"]
+    if aggregate == "SUM":
+        return [f"SUM({factor} * ({argument}) * ({argument}))"]
+    return [
+        f"SUM({factor} * ({argument}) * ({argument}))",
+        f"SUM({factor} * ({argument}))",
+        f"SUM(CASE WHEN {present} THEN {factor} END)",
+        f"SUM(({argument}) * {WEIGHT})",
+        f"SUM(CASE WHEN {present} THEN {WEIGHT} END)",
+    ]
+
+
+def _apply_edits(sql: str, edits: List[Tuple[int, int, str]]) -> str:
+    """Применение замен (начало, конец, текст); вставки в одной позиции - в порядке добавления"""
+    parts: List[str] = []
+    cursor = 0
+    for start, end, replacement in sorted(edits, key=lambda edit: edit[0]):
+        parts.append(sql[cursor:start])
+        parts.append(replacement)
+        cursor = max(cursor, end)
+    parts.append(sql[cursor:])
+    return "".join(parts)
+
+
+def plan_sample_query(sql_query: str) -> SampleQuery:
+    """
+    Переписывание запроса к transactions в запрос к выборке SAMPLE_TABLE.
+
+    Поддерживаются одиночные SELECT по transactions без подзапросов, соединений, DISTINCT
+    и оконных функций, с агрегатами COUNT/SUM/AVG (в том числе в HAVING и ORDER BY).
+    Агрегаты заменяются взвешенными оценками; для столбцов вида agg(...) или ROUND(agg(...), n)
+    в список выборки добавляются служебные суммы для доверительного интервала.
+    ApproximationUnavailable - если запрос по выборке не оценивается.
+    """
+    tokens = [token for token in tokenize(sql_query) if token.kind != SEMICOLON]
+    if not tokens or tokens[0].kind != WORD or tokens[0].value != "SELECT":
+        raise ApproximationUnavailable("only SELECT queries can run on the sample")
+    words = [token.value for token in tokens if token.kind == WORD]
+    for keyword, construct in UNSUPPORTED_KEYWORDS.items():
+        if keyword in words:
+            raise ApproximationUnavailable(f"{construct}: not supported on the sample")
+    if words.count("SELECT") > 1:
+        raise ApproximationUnavailable("subqueries are not supported on the sample")
+    pairs = _matching_parens(tokens)
+
+    calls: Dict[int, str] = {}
+    for index, token in enumerate(tokens):
+        if not _is_call(tokens, index):
+            continue
+        if token.value in UNSCALABLE_AGGREGATES:
+            raise ApproximationUnavailable(f"{token.value} cannot be estimated from a sample")
+        if token.value in SCALABLE_AGGREGATES:
+            calls[index] = token.value
+    if not calls:
+        raise ApproximationUnavailable("no COUNT/SUM/AVG aggregates to scale")
+
+    depth = 0
+    from_index = None
+    for index, token in enumerate(tokens):
+        if token.kind == PUNCT and token.value in "()":
+            depth += 1 if token.value == "(" else -1
+        elif depth == 0 and token.kind == WORD and token.value == "FROM":
+            from_index = index
+            break
+    if from_index is None or from_index + 1 >= len(tokens):
+        raise ApproximationUnavailable("query has no FROM clause")
+    table = tokens[from_index + 1]
+    if table.kind != WORD or table.value != SOURCE_TABLE:
+        raise ApproximationUnavailable("only queries over transactions can run on the sample")
+    after = from_index + 2
+    has_alias = False
+    if after < len(tokens) and tokens[after].kind == WORD and tokens[after].value == "AS":
+        after += 2
+        has_alias = True
+    elif after < len(tokens) and tokens[after].kind in (WORD, QUOTED_IDENT) and tokens[after].value not in FROM_FOLLOWERS:
+        after += 1
+        has_alias = True
+    if after < len(tokens) and not (tokens[after].kind == WORD and tokens[after].value in FROM_FOLLOWERS):
+        raise ApproximationUnavailable("only a single table can be queried on the sample")
+
+    edits: List[Tuple[int, int, str]] = []
+    for index, aggregate in calls.items():
+        close = pairs[index + 1]
+        argument = sql_query[tokens[index + 1].position + 1:tokens[close].position].strip()
+        edits.append((tokens[index].position, _end(tokens[close]), _scaled(aggregate, argument)))
+    edits.append((table.position, _end(table), SAMPLE_TABLE if has_alias else f"{SAMPLE_TABLE} AS transactions"))
+
+    # Столбцы списка выборки (границы по запятым верхнего уровня)
+    items: List[Tuple[int, int]] = []
+    start = 1
+    depth = 0
+    for index in range(1, from_index):
+        token = tokens[index]
+        if token.kind == PUNCT and token.value in "()":
+            depth += 1 if token.value == "(" else -1
+        elif depth == 0 and token.kind == PUNCT and token.value == ",":
+            items.append((start, index))
+            start = index + 1
+    items.append((start, from_index))
+
+    estimates: List[Estimate] = []
+    hidden_columns: List[str] = []
+    for start, end in items:
+        if end - start >= 3 and tokens[end - 2].kind == WORD and tokens[end - 2].value == "AS":
+            alias, expression_end = _identifier(sql_query, tokens[end - 1]), end - 2
+        elif (end - start >= 2 and tokens[end - 1].kind in (WORD, QUOTED_IDENT)
+              and tokens[end - 2].value == ")"):
+            alias, expression_end = _identifier(sql_query, tokens[end - 1]), end - 1
+        else:
+            alias, expression_end = None, end
+        if not (_is_call(tokens, start) and pairs.get(start + 1) == expression_end - 1):
+            continue
+        outer = tokens[start].value
+        if alias is None and outer in SCALABLE_AGGREGATES:
+            # Имя столбца по умолчанию - имя функции, после замены оно изменилось бы
+            edits.append((_end(tokens[expression_end - 1]), _end(tokens[expression_end - 1]), f' AS "{outer.lower()}"'))
+        column = alias or outer.lower()
+        call = start if outer in SCALABLE_AGGREGATES else None
+        if outer == "ROUND" and start + 2 in calls:
+            inner_close = pairs[start + 3]
+            if tokens[inner_close + 1].value in (",", ")"):
+                call = start + 2
+        if call is None:
+            continue
+        aggregate = calls[call]
+        argument = sql_query[tokens[call + 1].position + 1:tokens[pairs[call + 1]].position].strip()
+        hidden = []
+        for term_index, term in enumerate(_variance_terms(aggregate, argument)):
+            name = f"{HIDDEN_PREFIX}{len(estimates)}_{term_index}"
+            hidden.append(name)
+            hidden_columns.append(f'{term} AS "{name}"')
+        estimates.append(Estimate(column, aggregate, tuple(hidden)))
+
+    if hidden_columns:
+        last = _end(tokens[from_index - 1])
+        edits.append((last, last, ", " + ", ".join(hidden_columns)))
+    return SampleQuery(_apply_edits(sql_query, edits), estimates)
+
+
+def _variance(estimate: Estimate, row: Dict[str, Any]) -> Optional[float]:
+    values = [row.get(name) for name in estimate.hidden]
+    if estimate.aggregate != "AVG":
+        return values[0]
+    squares, sums, weights, total, count = values
+    if squares is None or not count:
+        return None
+    mean = total / count
+    # sum w(w-1)(y - mean)^2 / N^2
+    return (squares - 2 * mean * sums + mean * mean * (weights or 0)) / (count * count)
+
+
+def estimate_result(
+    sample: SampleQuery, result: ExecutionResult, confidence: float = FAST_MODE_CONFIDENCE
+) -> Tuple[ExecutionResult, Dict[str, Any]]:
+    """
+    Результат по выборке без служебных столбцов и границы ошибки: для каждого оцененного
+    столбца - полуширина доверительного интервала по строкам и максимальная относительная ошибка.
+    Исходный результат не изменяется (его могут разделять коалесированные запросы).
+    """
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    margins: Dict[str, List[Optional[float]]] = {estimate.column: [] for estimate in sample.estimates}
+    relative: Dict[str, float] = {estimate.column: 0.0 for estimate in sample.estimates}
+    for row in result.data:
+        for estimate in sample.estimates:
+            variance = _variance(estimate, row)
+            if variance is None:
+                margins[estimate.column].append(None)
+                continue
+            margin = z * math.sqrt(max(variance, 0.0))
+            margins[estimate.column].append(round(margin, 2))
+            value = row.get(estimate.column)
+            if isinstance(value, (int, float)) and value:
+                relative[estimate.column] = max(relative[estimate.column], margin / abs(value))
+    data = [{key: value for key, value in row.items() if not key.startswith(HIDDEN_PREFIX)} for row in result.data]
+    return result.model_copy(update={"data": data}), {
+        "confidence": confidence,
+        "margins": margins,
+        "max_relative_error": {column: round(value, 4) for column, value in relative.items()},
+    }
+
+
+_sample_info: Tuple[float, Optional[SampleInfo]] = (0.0, None)
+_sample_info_lock = threading.Lock()
+
+
+def get_sample_info() -> Optional[SampleInfo]:
+    """Параметры последней сборки выборки (None - выборка не построена), кэшируются на минуту"""
+    global _sample_info
+    with _sample_info_lock:
+        loaded_at, info = _sample_info
+        if time.monotonic() - loaded_at < SAMPLE_INFO_TTL_SECONDS:
+            return info
+    try:
+        with get_db_engine().connect() as connection:
+            row = connection.execute(text(
+                f"SELECT built_at, sample_rate, source_rows, sample_rows, strata FROM {SAMPLE_TABLE}_info LIMIT 1"
+            )).first()
+        info = SampleInfo(row[0].isoformat(), float(row[1]), int(row[2]), int(row[3]), int(row[4])) if row else None
+    except Exception as e:
+        print(f"Sample table info unavailable: {e}")
+        info = None
+    with _sample_info_lock:
+        _sample_info = (time.monotonic(), info)
+    return info
+
+
+class PendingUpgrades:
+    """Запросы, отвеченные по выборке, для последующего точного ответа (TTL и ограничение размера)"""
+
+    def __init__(self, ttl_seconds: int = FAST_MODE_UPGRADE_TTL_SECONDS, max_entries: int = MAX_PENDING_UPGRADES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expire(self, now: float):
+        while self._entries:
+            token, (expires, _) = next(iter(self._entries.items()))
+            if expires > now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[token]
+
+    def put(self, payload: Any) -> str:
+        token = secrets.token_urlsafe(12)
+        with self._lock:
+            now = time.monotonic()
+            self._entries[token] = (now + self.ttl_seconds, payload)
+            self._expire(now)
+        return token
+
+    def get(self, token: str) -> Optional[Any]:
+        with self._lock:
+            self._expire(time.monotonic())
+            entry = self._entries.get(token)
+        return entry[1] if entry else None
+
+
+pending_upgrades = PendingUpgrades()
+# approximate - ответ по выборке, fallback - fast mode выполнен точно, upgraded - точные ответы по upgrade_id
+fast_mode_stats = {"approximate": 0, "fallback": 0, "upgraded": 0}
@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from app.config import LLM_CASSETTE_DIR, LLM_CASSETTE_LATENCY_SCALE, LLM_CASSETTE_MODE
+
+CASSETTE_MODES = {"off", "record", "replay"}
+
+
+class CassetteMiss(Exception):
+    """В режиме replay для запроса нет записанного ответа"""
+    pass
+
+
+def request_hash(request: Dict[str, Any]) -> str:
+    """Хэш запроса к LLM (модель, системная инструкция, сообщения, параметры генерации)"""
+    payload = json.dumps(request, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class Cassette:
+    """
+    Запись и воспроизведение ответов LLM.
+
+    record: запрос уходит в модель, ответ и наблюдаемая задержка дописываются в <dir>/<engine>/<hash>.json;
+    replay: ответ берется с диска (повторные записи одного запроса отдаются по кругу),
+            задержка воспроизводится с множителем latency_scale (0 - без задержки).
+
+    В файле хранится полный запрос: разные запросы с одинаковым хэшем (коллизия)
+    хранятся рядом и учитываются в stats["collisions"].
+    """
+
+    def __init__(self, directory: str, mode: str, latency_scale: float = 0.0):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Unknown cassette mode {mode!r}, expected one of {sorted(CASSETTE_MODES)}")
+        self.directory = directory
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.stats = {"hits": 0, "misses": 0, "recorded": 0, "collisions": 0}
+        self._cursors: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, engine: str, key: str) -> str:
+        return os.path.join(self.directory, engine, f"{key}.json")
+
+    def _load(self, path: str) -> List[Dict[str, Any]]:
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)["entries"]
+        except FileNotFoundError:
+            return []
+
+    def _find(self, entries: List[Dict[str, Any]], request: Dict[str, Any], key: str) -> Optional[Dict[str, Any]]:
+        for entry in entries:
+            if entry["request"] == request:
+                return entry
+        if entries:
+            self.stats["collisions"] += 1
+            print(f"Cassette hash collision for {key}: stored requests differ from the current one")
+        return None
+
+    def lookup(self, engine: str, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Записанный ответ для запроса (режим replay)"""
+        key = request_hash(request)
+        with self._lock:
+            entry = self._find(self._load(self._path(engine, key)), request, key)
+            if entry is None or not entry["responses"]:
+                self.stats["misses"] += 1
+                raise CassetteMiss(f"No recorded {engine} response for request {key}")
+            cursor_key = f"{engine}/{key}"
+            cursor = self._cursors.get(cursor_key, 0)
+            self._cursors[cursor_key] = cursor + 1
+            self.stats["hits"] += 1
+            return entry["responses"][cursor % len(entry["responses"])]
+
+    def record(self, engine: str, request: Dict[str, Any], stage: str, response: Dict[str, Any]):
+        """Добавление ответа к записи запроса (режим record)"""
+        key = request_hash(request)
+        path = self._path(engine, key)
+        with self._lock:
+            entries = self._load(path)
+            entry = self._find(entries, request, key)
+            if entry is None:
+                entry = {"stage": stage, "request": request, "responses": []}
+                entries.append(entry)
+            entry["responses"].append(response)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = f"{path}.tmp"
+            with open(temporary, "w", encoding="utf-8") as f:
+                json.dump({"entries": entries}, f, ensure_ascii=False, indent=1)
+            os.replace(temporary, path)
+            self.stats["recorded"] += 1
+
+    async def _emulate(self, milliseconds: float):
+        if self.latency_scale > 0 and milliseconds > 0:
+            await asyncio.sleep(milliseconds * self.latency_scale / 1000)
+
+    async def call(self, engine: str, request: Dict[str, Any], stage: str, fetch: Callable[[], Awaitable[str]]) -> str:
+        if self.mode == "replay":
+            response = self.lookup(engine, request)
+            await self._emulate(response["latency_ms"])
+            return response["text"]
+        start = time.perf_counter()
+        text = await fetch()
+        if self.mode == "record":
+            self.record(engine, request, stage, {"text": text, "latency_ms": round((time.perf_counter() - start) * 1000, 1)})
+        return text
+
+    async def stream(
+        self, engine: str, request: Dict[str, Any], stage: str, fetch: Callable[[], AsyncIterator[str]]
+    ) -> AsyncIterator[str]:
+        if self.mode == "replay":
+            response = self.lookup(engine, request)
+            elapsed = 0.0
+            # Фрагменты отдаются с теми же интервалами, что и при записи
+            chunks = response.get("chunks", [response["text"]])
+            offsets = response.get("offsets_ms", [response["latency_ms"]])
+            for chunk, offset_ms in zip(chunks, offsets):
+                await self._emulate(offset_ms - elapsed)
+                elapsed = offset_ms
+                yield chunk
+            return
+        start = time.perf_counter()
+        chunks: List[str] = []
+        offsets: List[float] = []
+        async for chunk in fetch():
+            chunks.append(chunk)
+            offsets.append(round((time.perf_counter() - start) * 1000, 1))
+            yield chunk
+        if self.mode == "record":
+            self.record(engine, request, stage, {
+                "text": "".join(chunks),
+                "chunks": chunks,
+                "offsets_ms": offsets,
+                "latency_ms": offsets[-1] if offsets else 0.0,
+            })
+
+
+_cassette: Optional[Cassette] = None
+
+
+def get_cassette() -> Optional[Cassette]:
+    """Кассета из настроек (LLM_CASSETTE_MODE), None если запись выключена"""
+    global _cassette
+    if _cassette is None and LLM_CASSETTE_MODE != "off":
+        _cassette = Cassette(LLM_CASSETTE_DIR, LLM_CASSETTE_MODE, LLM_CASSETTE_LATENCY_SCALE)
+    return _cassette
+
+
+async def call_through_cassette(engine: str, request: Dict[str, Any], stage: str, fetch: Callable[[], Awaitable[str]]) -> str:
+    cassette = get_cassette()
+    if cassette is None:
+        return await fetch()
+    return await cassette.call(engine, request, stage, fetch)
+
+
+async def stream_through_cassette(
+    engine: str, request: Dict[str, Any], stage: str, fetch: Callable[[], AsyncIterator[str]]
+) -> AsyncIterator[str]:
+    cassette = get_cassette()
+    if cassette is None:
+        async for chunk in fetch():
+            yield chunk
+        return
+    async for chunk in cassette.stream(engine, request, stage, fetch):
+        yield chunk
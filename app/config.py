@@ -7,4 +7,106 @@ load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 LLM_API_KEY = os.getenv("LLM_API_KEY")
 LLM_API_URL = os.getenv("LLM_API_URL")
-OLLAMA_API_URL = os.getenv("OLLAMA_API_URL") or 'http://arch-ideapadg3:11434'
\ No newline at end of file
+OLLAMA_API_URL = os.getenv("OLLAMA_API_URL") or 'http://arch-ideapadg3:11434'
+
+# Сколько Ollama держит модель в памяти после запроса ("30m", "-1m" - не выгружать)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Языки, для которых при прогреве вычисляется статический префикс промпта SQL
+OLLAMA_WARMUP_LANGUAGES = [name.strip() for name in os.getenv("OLLAMA_WARMUP_LANGUAGES", "ru").split(",") if name.strip()]
+
+# Хранилище истории диалогов: memory | sqlite | redis
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "memory")
+HISTORY_TTL_SECONDS = int(os.getenv("HISTORY_TTL_SECONDS", "3600"))
+HISTORY_MAX_USERS = int(os.getenv("HISTORY_MAX_USERS", "10000"))
+HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", str(64 * 1024 * 1024)))
+HISTORY_SQLITE_PATH = os.getenv("HISTORY_SQLITE_PATH", "history.sqlite3")
+HISTORY_REDIS_URL = os.getenv("HISTORY_REDIS_URL")
+
+# Движки, доступные в этом деплое: api (Gemini), llm (Ollama)
+ENABLED_ENGINES = [name.strip() for name in os.getenv("ENABLED_ENGINES", "api,llm").split(",") if name.strip()]
+# Создавать и прогревать движки при старте сервера, а не при первом запросе
+WARMUP_ENGINES = os.getenv("WARMUP_ENGINES", "false").lower() in ("1", "true", "yes")
+
+# Переопределение бюджетов токенов по этапам, формат: "sql=1500,narrate=2000"
+PROMPT_TOKEN_BUDGETS = os.getenv("PROMPT_TOKEN_BUDGETS", "")
+
+# Локальный шаблонный ответ для простых результатов (одно значение, одна строка, топ-N) без вызова LLM
+LOCAL_TEXT_RENDERING = os.getenv("LOCAL_TEXT_RENDERING", "true").lower() in ("1", "true", "yes")
+
+# Серверные prepared statements для повторяющихся форм SQL (кэш на соединение пула)
+PREPARED_STATEMENTS = os.getenv("PREPARED_STATEMENTS", "true").lower() in ("1", "true", "yes")
+PREPARED_STATEMENTS_PER_CONNECTION = int(os.getenv("PREPARED_STATEMENTS_PER_CONNECTION", "256"))
+# plan_cache_mode PostgreSQL: auto | force_generic_plan | force_custom_plan
+PLAN_CACHE_MODE = os.getenv("PLAN_CACHE_MODE", "auto")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
+# Замена LIKE/ILIKE по столбцам с закрытым доменом на точные = / IN перед выполнением
+ENUM_PREDICATE_REWRITE = os.getenv("ENUM_PREDICATE_REWRITE", "true").lower() in ("1", "true", "yes")
+
+# Запись/воспроизведение ответов LLM: off | record | replay
+LLM_CASSETTE_MODE = os.getenv("LLM_CASSETTE_MODE", "off").lower()
+LLM_CASSETTE_DIR = os.getenv("LLM_CASSETTE_DIR", "cassettes")
+# Множитель записанной задержки при воспроизведении (0 - отвечать сразу, 1 - как при записи)
+LLM_CASSETTE_LATENCY_SCALE = float(os.getenv("LLM_CASSETTE_LATENCY_SCALE", "0"))
+
+# Компиляция сгенерированного SQL без выполнения (EXPLAIN) с исправлением ошибок до запуска
+SQL_DRY_RUN = os.getenv("SQL_DRY_RUN", "true").lower() in ("1", "true", "yes")
+# Попыток исправления SQL моделью, если локальное автоисправление не помогло
+SQL_REPAIR_ATTEMPTS = int(os.getenv("SQL_REPAIR_ATTEMPTS", "1"))
+
+# Автоматический выбор движка (model="auto"): целевая задержка этапов LLM и оценка здоровья движков
+ROUTING_LATENCY_SLO_MS = float(os.getenv("ROUTING_LATENCY_SLO_MS", "8000"))
+ROUTING_WINDOW = int(os.getenv("ROUTING_WINDOW", "200"))
+ROUTING_MIN_SAMPLES = int(os.getenv("ROUTING_MIN_SAMPLES", "5"))
+ROUTING_MAX_ERROR_RATE = float(os.getenv("ROUTING_MAX_ERROR_RATE", "0.2"))
+ROUTING_COOLDOWN_SECONDS = float(os.getenv("ROUTING_COOLDOWN_SECONDS", "30"))
+ROUTING_EXPLORE_RATE = float(os.getenv("ROUTING_EXPLORE_RATE", "0.05"))
+# Порядок движков по качеству для сложных запросов
+ROUTING_QUALITY_ORDER = [name.strip() for name in os.getenv("ROUTING_QUALITY_ORDER", "api,llm").split(",") if name.strip()]
+
+# Хеджирование вызовов LLM: дубликат запроса, если ответа нет дольше перцентиля задержек этапа
+LLM_HEDGE_ENGINES = [name.strip() for name in os.getenv("LLM_HEDGE_ENGINES", "api").split(",") if name.strip()]
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.9"))
+# Максимальная доля хеджированных вызовов (бюджет дополнительных затрат)
+LLM_HEDGE_BUDGET = float(os.getenv("LLM_HEDGE_BUDGET", "0.1"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_MIN_DELAY_MS = float(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "300"))
+# Модель для дубликата запроса к Gemini (по умолчанию та же)
+LLM_HEDGE_MODEL = os.getenv("LLM_HEDGE_MODEL")
+
+# Явный кэш контекста Gemini для статического префикса этапов (системный промпт, схема, правила)
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "true").lower() in ("1", "true", "yes")
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+GEMINI_CONTEXT_CACHE_STAGES = [
+    name.strip() for name in os.getenv("GEMINI_CONTEXT_CACHE_STAGES", "clarity,format,sql,repair").split(",") if name.strip()
+]
+
+# Бюджет размышлений gemini-2.5-flash на этапах генерации и исправления SQL (остальные этапы без размышлений)
+GEMINI_SQL_THINKING_BUDGET = int(os.getenv("GEMINI_SQL_THINKING_BUDGET", "512"))
+
+# Банк примеров вопрос -> SQL для few-shot: поиск похожих вопросов, пополнение успешными запросами
+EXAMPLE_BANK = os.getenv("EXAMPLE_BANK", "true").lower() in ("1", "true", "yes")
+EXAMPLE_BANK_PATH = os.getenv("EXAMPLE_BANK_PATH", "example_bank.jsonl")
+EXAMPLE_BANK_TOP_K = int(os.getenv("EXAMPLE_BANK_TOP_K", "3"))
+EXAMPLE_BANK_MIN_SCORE = float(os.getenv("EXAMPLE_BANK_MIN_SCORE", "0.15"))
+EXAMPLE_BANK_MAX_LEARNED = int(os.getenv("EXAMPLE_BANK_MAX_LEARNED", "5000"))
+
+# Быстрый приближенный режим (UserQuery.fast_mode): запрос выполняется по стратифицированной выборке
+# (строится build_sample.py), агрегаты масштабируются весами строк, границы ошибки - в метаданных
+FAST_MODE = os.getenv("FAST_MODE", "true").lower() in ("1", "true", "yes")
+SAMPLE_TABLE = os.getenv("SAMPLE_TABLE", "transactions_sample")
+FAST_MODE_CONFIDENCE = float(os.getenv("FAST_MODE_CONFIDENCE", "0.95"))
+# Сколько хранится точный SQL приближенного ответа для последующего уточнения
+FAST_MODE_UPGRADE_TTL_SECONDS = int(os.getenv("FAST_MODE_UPGRADE_TTL_SECONDS", "900"))
+
+# Графики: предельное число точек ряда в ответе (прореживание LTTB) и укрупнение DATE_TRUNC в SQL по диапазону запроса
+GRAPH_MAX_POINTS = int(os.getenv("GRAPH_MAX_POINTS", "500"))
+GRAPH_SQL_BUCKETING = os.getenv("GRAPH_SQL_BUCKETING", "true").lower() in ("1", "true", "yes")
+
+# Курсоры результатов: большие табличные ответы отдаются страницами, остальные строки хранятся на сервере
+# Размер первой страницы по умолчанию (0 - весь результат, если UserQuery.page_size не задан)
+RESULT_PAGE_SIZE = int(os.getenv("RESULT_PAGE_SIZE", "0"))
+RESULT_CURSOR_MAX_PAGE_SIZE = int(os.getenv("RESULT_CURSOR_MAX_PAGE_SIZE", "1000"))
+RESULT_CURSOR_TTL_SECONDS = int(os.getenv("RESULT_CURSOR_TTL_SECONDS", "900"))
+RESULT_CURSOR_MAX_BYTES = int(os.getenv("RESULT_CURSOR_MAX_BYTES", str(256 * 1024 * 1024)))
@@ -1,6 +1,3 @@
-import json
-
-
 DEFAULT_LIMIT = 1000
 AGGREGATION_THRESHOLD = 10000
 MAX_RETRIES = 3
@@ -25,6 +22,50 @@ TABLE_SCHEMA = {
     "wallet_type": "String wallet type. Only this values: (Bank's QR, Samsung Pay, Google Pay, Apple Pay)"
 }
 
+# Бюджеты токенов на тело промпта каждого этапа (без системной инструкции и истории)
+STAGE_TOKEN_BUDGETS = {
+    "clarity": 900,
+    "format": 900,
+    "sql": 1500,
+    "translate": 600,
+    "narrate": 2500,
+    # Без статического префикса (схема, правила, примеры), он передается системным сообщением
+    "local_sql": 1600,
+    "repair": 1500,
+}
+
+# Бюджеты токенов на историю диалога, передаваемую на каждом этапе
+HISTORY_TOKEN_BUDGETS = {
+    "clarity": 400,
+    "format": 600,
+    "sql": 800,
+    "narrate": 200,
+    "local_sql": 600,
+}
+# Максимальный размер сжатого резюме старых реплик
+HISTORY_SUMMARY_MAX_TOKENS = 200
+
+
+def compact_schema(table_schema: dict) -> str:
+    """Компактное представление схемы: одна строка на столбец вида 'name type[, values: (...)]'"""
+    type_names = {"Integer": "int", "String": "text", "Timestamp": "timestamp", "Numeric": "numeric"}
+    lines = []
+    for column, description in table_schema.items():
+        first_word = description.split(" ", 1)[0]
+        line = f"{column} {type_names.get(first_word, first_word.lower())}"
+        if "primary key" in description:
+            line += " pk"
+        if "(" in description and description.endswith(")"):
+            values = description[description.index("(") + 1:-1].strip()
+            if values:
+                kind = "values" if "Only" in description else "e.g."
+                line += f", {kind}: ({values})"
+        lines.append(line)
+    return "transactions(\n" + "\n".join(lines) + "\n)"
+
+
+COMPACT_TABLE_SCHEMA = compact_schema(TABLE_SCHEMA)
+
 PRODUCTION_SYSTEM_PROMPT = f"""
 SYSTEM_ROLES:
 - Data Analyst Assistant
@@ -61,5 +102,5 @@ Amounts filtered through transaction_amount_kzt.
 String filters must use ILIKE.
 
 Table schema:
-{json.dumps(TABLE_SCHEMA, indent=2)}
+{COMPACT_TABLE_SCHEMA}
 """
\ No newline at end of file
@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+import time
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
+
+from app.config import GEMINI_CONTEXT_CACHE, GEMINI_CONTEXT_CACHE_STAGES, GEMINI_CONTEXT_CACHE_TTL_SECONDS
+
+if TYPE_CHECKING:
+    from google.genai import types
+
+# Продление кэша, когда до истечения осталось меньше этой доли TTL
+REFRESH_FRACTION = 0.2
+# Коды ответа API, означающие, что кэш на стороне провайдера уже недоступен
+CACHE_GONE_CODES = (403, 404)
+
+
+class ContextCache:
+    """
+    Явный кэш контекста Gemini (cachedContents) для статического префикса этапа.
+
+    Системная инструкция этапа (системный промпт, схема, правила и примеры этапа) один раз
+    загружается в кэш провайдера, вызовы ссылаются на него через cached_content и не передают
+    префикс заново. Кэш продлевается до истечения TTL; если провайдер отказал в создании
+    (например, префикс короче минимального размера), вызовы этапа идут без кэша до следующей попытки
+    через TTL. Если кэш пропал на стороне провайдера, вызов повторяется без него.
+    """
+
+    def __init__(self, enabled: bool = GEMINI_CONTEXT_CACHE, ttl_seconds: int = GEMINI_CONTEXT_CACHE_TTL_SECONDS,
+                 stages: List[str] = GEMINI_CONTEXT_CACHE_STAGES):
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.stages = set(stages)
+        # ключ префикса -> {"name": имя кэша или None после отказа, "expires": monotonic, "created": monotonic}
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.stats = {
+            "created": 0, "refreshed": 0, "failed": 0, "invalidated": 0,
+            "hits": 0, "misses": 0, "cached_tokens": 0, "prompt_tokens": 0,
+        }
+
+    def _key(self, model: str, system_instruction: str) -> str:
+        return hashlib.sha256(f"{model}\n{system_instruction}".encode("utf-8")).hexdigest()[:16]
+
+    def live(self) -> int:
+        """Количество действующих кэшей"""
+        now = time.monotonic()
+        return sum(1 for entry in self._entries.values() if entry["name"] and entry["expires"] > now)
+
+    async def _acquire(self, client, model: str, system_instruction: str, stage: str) -> Optional[str]:
+        """Имя кэша для префикса: создание, продление или None, если кэш недоступен"""
+        from google.genai import types
+
+        key = self._key(model, system_instruction)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry is not None and entry["name"] is None and entry["expires"] > now:
+                return None
+            if entry is not None and entry["name"] and entry["expires"] - now > self.ttl_seconds * REFRESH_FRACTION:
+                return entry["name"]
+
+            ttl = f"{self.ttl_seconds}s"
+            if entry is not None and entry["name"] and entry["expires"] > now:
+                try:
+                    await client.aio.caches.update(name=entry["name"], config=types.UpdateCachedContentConfig(ttl=ttl))
+                    entry["expires"] = now + self.ttl_seconds
+                    self.stats["refreshed"] += 1
+                    return entry["name"]
+                except Exception as e:
+                    print(f"Context cache refresh failed for {stage}: {e}")
+
+            try:
+                cached = await client.aio.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        system_instruction=system_instruction,
+                        display_name=f"text2sql-{stage}-{key}",
+                        ttl=ttl,
+                    )
+                )
+            except Exception as e:
+                print(f"Context cache unavailable for {stage}: {e}")
+                self.stats["failed"] += 1
+                self._entries[key] = {"name": None, "expires": now + self.ttl_seconds, "created": now}
+                return None
+            print(f"Context cache created for {stage}: {cached.name}")
+            self.stats["created"] += 1
+            self._entries[key] = {"name": cached.name, "expires": now + self.ttl_seconds, "created": now}
+            return cached.name
+
+    def _invalidate(self, name: str):
+        for entry in self._entries.values():
+            if entry["name"] == name:
+                entry["name"] = None
+                entry["expires"] = 0.0
+                self.stats["invalidated"] += 1
+
+    def _observe(self, usage: Optional["types.GenerateContentResponseUsageMetadata"], cached: bool):
+        self.stats["hits" if cached else "misses"] += 1
+        if usage is not None:
+            self.stats["cached_tokens"] += usage.cached_content_token_count or 0
+            self.stats["prompt_tokens"] += usage.prompt_token_count or 0
+
+    async def generate_content(
+        self, client, model: str, contents: List["types.Content"], config: "types.GenerateContentConfig", stage: str
+    ):
+        """generate_content с префиксом из кэша, если этап кэшируется"""
+        name = None
+        if self.enabled and stage in self.stages and config.system_instruction:
+            name = await self._acquire(client, model, config.system_instruction, stage)
+        if name:
+            cached_config = config.model_copy(update={"system_instruction": None, "cached_content": name})
+            try:
+                response = await client.aio.models.generate_content(model=model, contents=contents, config=cached_config)
+                self._observe(response.usage_metadata, True)
+                return response
+            except Exception as e:
+                if getattr(e, "code", None) not in CACHE_GONE_CODES:
+                    raise
+                print(f"Context cache {name} is gone ({e}), retrying without it")
+                self._invalidate(name)
+        response = await client.aio.models.generate_content(model=model, contents=contents, config=config)
+        self._observe(response.usage_metadata, False)
+        return response
+
+
+context_cache = ContextCache()
@@ -0,0 +1,189 @@
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.config import GRAPH_MAX_POINTS
+
+# Минимум точек серии: первая, последняя и хотя бы одна между ними
+MIN_SERIES_POINTS = 3
+# Сколько строк проверяется при определении типов столбцов
+DETECTION_ROWS = 50
+
+
+def _as_number(value: Any) -> Optional[float]:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return float(value)
+
+
+def _as_time(value: Any) -> Optional[float]:
+    """Дата/время в ISO формате (так их отдает sql_to_db) в секунды"""
+    if not isinstance(value, str) or len(value) < 10 or value[4] != "-":
+        return None
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    # Без обращения к часовому поясу системы (timestamp() для наивных дат заметно медленнее)
+    return moment.toordinal() * 86400.0 + moment.hour * 3600 + moment.minute * 60 + moment.second + moment.microsecond / 1e6
+
+
+def detect_series(data: List[Dict[str, Any]]) -> Optional[Tuple[str, List[str], List[str]]]:
+    """
+    Разметка результата как ряда: столбец оси X (дата/время или первый неубывающий
+    числовой столбец), числовые столбцы Y и строковые столбцы, разделяющие серии
+    (например, ряд по каждому городу). None - результат не похож на ряд.
+    """
+    columns = list(data[0].keys())
+    step = max(1, len(data) // DETECTION_ROWS)
+    rows = data[::step]
+
+    def all_match(column: str, convert) -> bool:
+        values = [row.get(column) for row in rows]
+        return any(value is not None for value in values) and all(
+            value is None or convert(value) is not None for value in values
+        )
+
+    x = next((column for column in columns if all_match(column, _as_time)), None)
+    if x is None and columns and all_match(columns[0], _as_number):
+        present = [row.get(columns[0]) for row in data if row.get(columns[0]) is not None]
+        if present == sorted(present):
+            x = columns[0]
+    if x is None:
+        return None
+    ys = [column for column in columns if column != x and all_match(column, _as_number)]
+    if not ys:
+        return None
+    series = [column for column in columns if column != x and column not in ys]
+    return x, ys, series
+
+
+def lttb(xs: List[float], ys: List[float], threshold: int) -> List[int]:
+    """
+    Largest-Triangle-Three-Buckets: индексы threshold точек, сохраняющих форму ряда.
+    Точки делятся на корзины; из каждой берется точка, образующая наибольший треугольник
+    с выбранной точкой предыдущей корзины и средней точкой следующей. Первая и последняя точки сохраняются.
+    """
+    count = len(xs)
+    if threshold >= count or threshold < MIN_SERIES_POINTS:
+        return list(range(count))
+    every = (count - 2) / (threshold - 2)
+    selected = [0]
+    anchor = 0
+    for bucket in range(threshold - 2):
+        next_start = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, count)
+        span = next_end - next_start
+        average_x = sum(xs[next_start:next_end]) / span
+        average_y = sum(ys[next_start:next_end]) / span
+
+        start = int(bucket * every) + 1
+        end = int((bucket + 1) * every) + 1
+        anchor_x, anchor_y = xs[anchor], ys[anchor]
+        best, best_area = start, -1.0
+        for index in range(start, end):
+            area = abs(
+                (anchor_x - average_x) * (ys[index] - anchor_y)
+                - (anchor_x - xs[index]) * (average_y - anchor_y)
+            )
+            if area > best_area:
+                best, best_area = index, area
+        selected.append(best)
+        anchor = best
+    selected.append(count - 1)
+    return selected
+
+
+def _series_points(xs: List[float], columns: List[List[float]], budget: int) -> List[int]:
+    """
+    Позиции точек одной серии: объединение LTTB по всем столбцам Y не больше budget.
+    Столбцы Y делят строки, поэтому бюджет не делится между ними: подбирается наибольший
+    порог LTTB, при котором объединение точек всех столбцов укладывается в budget.
+    """
+    if len(xs) <= budget:
+        return list(range(len(xs)))
+    if budget < MIN_SERIES_POINTS:
+        return [0, len(xs) - 1][:budget]
+    if len(columns) == 1:
+        return lttb(xs, columns[0], budget)
+
+    def union(threshold: int) -> List[int]:
+        kept = set()
+        for values in columns:
+            kept.update(lttb(xs, values, threshold))
+        return sorted(kept)
+
+    best = None
+    low, high = MIN_SERIES_POINTS, budget
+    while low <= high:
+        threshold = (low + high) // 2
+        points = union(threshold)
+        if len(points) <= budget:
+            best, low = points, threshold + 1
+        else:
+            high = threshold - 1
+    # Даже минимальный порог по всем столбцам не помещается - форма по первому столбцу Y
+    return best if best is not None else lttb(xs, columns[0], budget)
+
+
+def downsample_graph(data: List[Dict[str, Any]], max_points: int = GRAPH_MAX_POINTS) -> Optional[Tuple[List[int], Dict[str, Any]]]:
+    """
+    Прореживание ряда графика до max_points точек (LTTB по каждой серии и каждому столбцу Y).
+
+    Бюджет делится между сериями поровну, остаток коротких серий переходит к длинным.
+    Если серий больше, чем помещается по MIN_SERIES_POINTS точек, сохраняются серии
+    с наибольшей суммой первого столбца Y (число отброшенных - в series_dropped).
+    Возвращает индексы сохраненных строк в исходном порядке и описание прореживания
+    (не больше max_points строк); None - строк не больше max_points или результат не является рядом.
+    """
+    if len(data) <= max_points:
+        return None
+    detected = detect_series(data)
+    if detected is None:
+        return None
+    x, ys, series = detected
+
+    groups: Dict[Tuple[Any, ...], List[int]] = {}
+    for index, row in enumerate(data):
+        groups.setdefault(tuple(row.get(column) for column in series), []).append(index)
+    convert = _as_time if _as_time(next(row[x] for row in data if row.get(x) is not None)) is not None else _as_number
+    positions = [convert(row.get(x)) if row.get(x) is not None else None for row in data]
+    if any(position is None and row.get(x) is not None for position, row in zip(positions, data)):
+        return None
+
+    members = list(groups.values())
+    dropped = 0
+    max_series = max(1, max_points // MIN_SERIES_POINTS)
+    if len(members) > max_series:
+        def weight(indices: List[int]) -> float:
+            return sum(abs(_as_number(data[index].get(ys[0])) or 0.0) for index in indices)
+        members.sort(key=weight, reverse=True)
+        dropped = len(members) - max_series
+        members = members[:max_series]
+
+    kept: List[int] = []
+    remaining = max_points
+    # Короткие серии первыми: неиспользованная ими часть бюджета достается следующим
+    members.sort(key=len)
+    for left, indices in zip(range(len(members), 0, -1), members):
+        budget = remaining // left
+        # Строки без X не участвуют в ряду и сохраняются как есть (в пределах бюджета серии)
+        unplaced = [index for index in indices if positions[index] is None][:budget]
+        indices = sorted((index for index in indices if positions[index] is not None), key=positions.__getitem__)
+        xs = [positions[index] for index in indices]
+        columns = [[_as_number(data[index].get(column)) or 0.0 for index in indices] for column in ys]
+        chosen = unplaced + [indices[position] for position in _series_points(xs, columns, budget - len(unplaced))]
+        kept.extend(chosen)
+        remaining -= len(chosen)
+
+    ordered = sorted(kept)
+    info = {
+        "method": "lttb",
+        "x": x,
+        "y": ys,
+        "series": len(members),
+        "source_points": len(data),
+        "points": len(ordered),
+    }
+    if dropped:
+        info["series_dropped"] = dropped
+    return ordered, info
@@ -0,0 +1,219 @@
+import json
+import math
+import os
+import threading
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from app.config import (
+    EXAMPLE_BANK, EXAMPLE_BANK_MAX_LEARNED, EXAMPLE_BANK_MIN_SCORE, EXAMPLE_BANK_PATH, EXAMPLE_BANK_TOP_K
+)
+from app.singleflight import normalize_question
+
+# Длина символьных n-грамм индекса
+NGRAM = 3
+# Множитель оценки примера с тем же форматом вывода
+SAME_FORMAT_BOOST = 1.2
+
+
+class Example(NamedTuple):
+    question: str
+    language: str
+    sql: str
+    output_format: str
+
+
+# Начальные примеры (прежние few-shot списки локального движка)
+SEED_EXAMPLES = [
+    Example("Сколько транзакций в 2024 году?", "ru",
+            "SELECT COUNT(*) as total_transactions FROM transactions WHERE transaction_timestamp >= '2024-01-01' AND transaction_timestamp < '2025-01-01'", "text"),
+    Example("Топ 5 мерчантов по объему транзакций в тенге", "ru",
+            "SELECT merchant_id, SUM(transaction_amount_kzt) as total_volume_kzt FROM transactions WHERE transaction_type = 'POS' GROUP BY merchant_id ORDER BY total_volume_kzt DESC LIMIT 5", "table"),
+    Example("Средняя сумма транзакции для карт Halyk Bank в Алматы", "ru",
+            "SELECT AVG(transaction_amount_kzt) as average_amount FROM transactions WHERE issuer_bank_name = 'Halyk Bank' AND merchant_city = 'Almaty' AND transaction_type = 'POS'", "text"),
+    Example("Транзакции в Астане за последний месяц", "ru",
+            "SELECT merchant_city, COUNT(*) as transaction_count, SUM(transaction_amount_kzt) as total_amount FROM transactions WHERE merchant_city = 'Astana' AND transaction_timestamp >= DATE_TRUNC('month', CURRENT_DATE - INTERVAL '1 month') AND transaction_timestamp < DATE_TRUNC('month', CURRENT_DATE) GROUP BY merchant_city", "table"),
+    Example("Объем транзакций по категориям MCC за последний месяц", "ru",
+            "SELECT mcc_category, SUM(transaction_amount_kzt) as total_volume, COUNT(*) as transaction_count FROM transactions WHERE transaction_timestamp >= DATE_TRUNC('month', CURRENT_DATE - INTERVAL '1 month') AND transaction_timestamp < DATE_TRUNC('month', CURRENT_DATE) AND transaction_type = 'POS' GROUP BY mcc_category ORDER BY total_volume DESC", "table"),
+    Example("Нарисуй график по месяцам за 2024 выручка", "ru",
+            "SELECT DATE_TRUNC('month', transaction_timestamp) as month, SUM(transaction_amount_kzt) as total_revenue, COUNT(*) as transaction_count FROM transactions WHERE transaction_timestamp >= '2024-01-01' AND transaction_timestamp < '2025-01-01' GROUP BY DATE_TRUNC('month', transaction_timestamp) ORDER BY month", "graph"),
+    Example("2024 жылы қанша транзакция?", "kk",
+            "SELECT COUNT(*) as total_transactions FROM transactions WHERE transaction_timestamp >= '2024-01-01' AND transaction_timestamp < '2025-01-01'", "text"),
+    Example("Тенгедегі транзакция көлемі бойынша топ 5 мерчант", "kk",
+            "SELECT merchant_id, SUM(transaction_amount_kzt) as total_volume_kzt FROM transactions WHERE transaction_type = 'POS' GROUP BY merchant_id ORDER BY total_volume_kzt DESC LIMIT 5", "table"),
+    Example("Алматыдағы Halyk Bank карталары үшін орташа транзакция сомасы", "kk",
+            "SELECT AVG(transaction_amount_kzt) as average_amount FROM transactions WHERE issuer_bank_name = 'Halyk Bank' AND merchant_city = 'Almaty' AND transaction_type = 'POS'", "text"),
+    Example("Өткен айда MCC категориялары бойынша транзакция көлемі", "kk",
+            "SELECT mcc_category, SUM(transaction_amount_kzt) as total_volume, COUNT(*) as transaction_count FROM transactions WHERE DATE_TRUNC('month', transaction_timestamp) = DATE_TRUNC('month', CURRENT_DATE - INTERVAL '1 month') AND transaction_type = 'POS' GROUP BY mcc_category ORDER BY total_volume DESC", "table"),
+    Example("Total transactions in 2024", "en",
+            "SELECT COUNT(*) as total_transactions FROM transactions WHERE transaction_timestamp >= '2024-01-01' AND transaction_timestamp < '2025-01-01'", "text"),
+    Example("Top 5 merchants by transaction volume in KZT", "en",
+            "SELECT merchant_id, SUM(transaction_amount_kzt) as total_volume_kzt FROM transactions WHERE transaction_type = 'POS' GROUP BY merchant_id ORDER BY total_volume_kzt DESC LIMIT 5", "table"),
+    Example("Average transaction amount for Halyk Bank cards in Almaty", "en",
+            "SELECT AVG(transaction_amount_kzt) as average_amount FROM transactions WHERE issuer_bank_name = 'Halyk Bank' AND merchant_city = 'Almaty' AND transaction_type = 'POS'", "text"),
+    Example("Transaction volume by MCC category last month", "en",
+            "SELECT mcc_category, SUM(transaction_amount_kzt) as total_volume, COUNT(*) as transaction_count FROM transactions WHERE DATE_TRUNC('month', transaction_timestamp) = DATE_TRUNC('month', CURRENT_DATE - INTERVAL '1 month') AND transaction_type = 'POS' GROUP BY mcc_category ORDER BY total_volume DESC", "table"),
+]
+
+
+def ngrams(text: str) -> Counter:
+    """Символьные n-граммы нормализованного вопроса (с границами слов)"""
+    words = normalize_question(text).split()
+    grams: Counter = Counter()
+    for word in words:
+        padded = f" {word} "
+        for index in range(max(1, len(padded) - NGRAM + 1)):
+            grams[padded[index:index + NGRAM]] += 1
+    return grams
+
+
+def format_examples(examples: List[Example]) -> str:
+    """Примеры для промпта в формате вопрос -> SQL"""
+    if not examples:
+        return ""
+    return "EXAMPLES:\n\n" + "\n\n".join(f'Q: "{example.question}"\nA: {example.sql};' for example in examples)
+
+
+class ExampleBank:
+    """
+    Банк примеров (вопрос, язык, SQL, формат) с поиском top-k по символьным n-граммам.
+
+    Индекс инвертированный: n-грамма -> примеры; оценка - косинус векторов n-грамм с весами IDF.
+    Начальные примеры - SEED_EXAMPLES, банк пополняется успешно выполненными запросами
+    (learn), которые дописываются в JSONL-файл и загружаются при старте.
+    Повторный вопрос заменяет прежний пример; сверх max_learned вытесняются самые старые из выученных.
+    """
+
+    def __init__(self, path: Optional[str] = EXAMPLE_BANK_PATH, max_learned: int = EXAMPLE_BANK_MAX_LEARNED):
+        self.path = path
+        self.max_learned = max_learned
+        self._examples: Dict[int, Example] = {}
+        self._grams: Dict[int, Counter] = {}
+        self._postings: Dict[str, Set[int]] = {}
+        self._by_question: Dict[str, int] = {}
+        self._learned: List[int] = []
+        self._next_id = 0
+        self._lock = threading.Lock()
+        for example in SEED_EXAMPLES:
+            self._add(example)
+        if path:
+            self._load(path)
+
+    def __len__(self) -> int:
+        return len(self._examples)
+
+    def _load(self, path: str):
+        try:
+            with open(path, encoding="utf-8") as f:
+                lines = [line for line in f if line.strip()]
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                self._learn(Example(**json.loads(line)))
+            except (ValueError, TypeError) as e:
+                print(f"Skipping broken example bank entry: {e}")
+        # Файл только дописывается: при разрастании переписывается актуальным содержимым
+        if len(lines) > 2 * max(len(self._learned), 1):
+            self._rewrite(path)
+
+    def _rewrite(self, path: str):
+        temporary = f"{path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            for example_id in self._learned:
+                f.write(json.dumps(self._examples[example_id]._asdict(), ensure_ascii=False) + "\n")
+        os.replace(temporary, path)
+
+    def _add(self, example: Example) -> int:
+        key = normalize_question(example.question)
+        if key in self._by_question:
+            self._remove(self._by_question[key])
+        example_id = self._next_id
+        self._next_id += 1
+        grams = ngrams(example.question)
+        self._examples[example_id] = example
+        self._grams[example_id] = grams
+        self._by_question[key] = example_id
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(example_id)
+        return example_id
+
+    def _remove(self, example_id: int):
+        example = self._examples.pop(example_id)
+        for gram in self._grams.pop(example_id):
+            postings = self._postings.get(gram)
+            if postings is not None:
+                postings.discard(example_id)
+                if not postings:
+                    del self._postings[gram]
+        self._by_question.pop(normalize_question(example.question), None)
+        if example_id in self._learned:
+            self._learned.remove(example_id)
+
+    def _learn(self, example: Example):
+        self._learned.append(self._add(example))
+        while len(self._learned) > self.max_learned:
+            self._remove(self._learned[0])
+
+    def learn(self, question: str, language: str, sql: str, output_format: str) -> bool:
+        """Добавление успешно выполненного запроса; False, если пример не подходит"""
+        sql = sql.strip().rstrip(";").strip()
+        if not question.strip() or not sql or " AS ERROR" in sql.upper():
+            return False
+        example = Example(question.strip(), language, sql, output_format)
+        with self._lock:
+            existing = self._by_question.get(normalize_question(question))
+            if existing is not None and self._examples[existing] == example:
+                return False
+            self._learn(example)
+            if self.path:
+                try:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(example._asdict(), ensure_ascii=False) + "\n")
+                except OSError as e:
+                    print(f"Could not persist example: {e}")
+        return True
+
+    def search(
+        self,
+        question: str,
+        k: int = EXAMPLE_BANK_TOP_K,
+        output_format: Optional[str] = None,
+        min_score: float = EXAMPLE_BANK_MIN_SCORE
+    ) -> List[Example]:
+        """Top-k примеров, похожих на вопрос"""
+        query = ngrams(question)
+        with self._lock:
+            total = len(self._examples)
+            idf = {gram: math.log((total + 1) / (len(self._postings.get(gram, ())) + 1)) + 1 for gram in query}
+            candidates: Set[int] = set()
+            for gram in query:
+                candidates.update(self._postings.get(gram, ()))
+            query_norm = math.sqrt(sum((count * idf[gram]) ** 2 for gram, count in query.items())) or 1.0
+            scored = []
+            for example_id in candidates:
+                example = self._examples[example_id]
+                grams = self._grams[example_id]
+                dot = sum(count * idf[gram] * grams[gram] * idf[gram] for gram, count in query.items() if gram in grams)
+                doc_norm = math.sqrt(sum(
+                    (count * (math.log((total + 1) / (len(self._postings[gram]) + 1)) + 1)) ** 2
+                    for gram, count in grams.items()
+                ))
+                score = dot / (query_norm * doc_norm) if doc_norm else 0.0
+                if output_format and example.output_format == output_format:
+                    score *= SAME_FORMAT_BOOST
+                if score >= min_score:
+                    scored.append((score, example_id))
+            scored.sort(key=lambda item: (-item[0], item[1]))
+            return [self._examples[example_id] for _, example_id in scored[:k]]
+
+
+_bank: Optional[ExampleBank] = None
+
+
+def get_example_bank() -> Optional[ExampleBank]:
+    """Общий банк примеров, None если он выключен (EXAMPLE_BANK)"""
+    global _bank
+    if _bank is None and EXAMPLE_BANK:
+        _bank = ExampleBank()
+    return _bank
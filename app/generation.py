@@ -0,0 +1,68 @@
+import json
+from typing import Any, Dict, NamedTuple, Optional, Tuple, Type, Union
+
+from pydantic import BaseModel
+
+from app.config import GEMINI_SQL_THINKING_BUDGET
+from app.models import ClarityCheck, FormatDecision, SQLGeneration
+
+
+class GenerationProfile(NamedTuple):
+    """Параметры генерации этапа"""
+    max_output_tokens: int
+    schema: Optional[Type[BaseModel]] = None   # структура ответа (JSON по схеме)
+    json_object: bool = False                  # JSON-объект с произвольными ключами (перевод столбцов)
+    thinking_budget: Optional[int] = 0         # токены размышлений Gemini, None - по умолчанию модели
+    stop: Tuple[str, ...] = ()
+
+
+# Этапы без профиля генерируют свободный текст с прежним лимитом
+DEFAULT_PROFILE = GenerationProfile(max_output_tokens=5000, thinking_budget=None)
+
+# Лимит вывода Gemini 2.5 включает токены размышлений
+GEMINI_PROFILES: Dict[str, GenerationProfile] = {
+    "clarity": GenerationProfile(256, schema=ClarityCheck),
+    "format": GenerationProfile(512, schema=FormatDecision),
+    "sql": GenerationProfile(1024 + GEMINI_SQL_THINKING_BUDGET, schema=SQLGeneration, thinking_budget=GEMINI_SQL_THINKING_BUDGET),
+    "repair": GenerationProfile(1024 + GEMINI_SQL_THINKING_BUDGET, schema=SQLGeneration, thinking_budget=GEMINI_SQL_THINKING_BUDGET),
+    "translate": GenerationProfile(512, json_object=True),
+    "narrate": GenerationProfile(1024),
+}
+
+# SQL локальной модели ограничен JSON-схемой {"sql_query": ...}, как и на этапе исправления
+OLLAMA_PROFILES: Dict[str, GenerationProfile] = {
+    "sql": GenerationProfile(512, schema=SQLGeneration),
+    "repair": GenerationProfile(512, schema=SQLGeneration),
+    "translate": GenerationProfile(512, json_object=True),
+    "narrate": GenerationProfile(1024),
+}
+
+
+def gemini_profile(stage: str) -> GenerationProfile:
+    return GEMINI_PROFILES.get(stage, DEFAULT_PROFILE)
+
+
+def ollama_profile(stage: str) -> GenerationProfile:
+    return OLLAMA_PROFILES.get(stage, DEFAULT_PROFILE)
+
+
+def ollama_format(profile: GenerationProfile) -> Optional[Union[str, Dict[str, Any]]]:
+    """Параметр format запроса Ollama: JSON-схема, "json" или None для текста"""
+    if profile.schema is not None:
+        return profile.schema.model_json_schema()
+    return "json" if profile.json_object else None
+
+
+def parse_structured(profile: GenerationProfile, text: str) -> Any:
+    """
+    Строгий разбор ответа по профилю: модель по схеме, словарь для JSON-объекта, текст как есть.
+    Ответ вне контракта - ошибка (ValueError), без поиска JSON в произвольном тексте.
+    """
+    if profile.schema is not None:
+        return profile.schema.model_validate_json(text)
+    if profile.json_object:
+        value = json.loads(text)
+        if not isinstance(value, dict):
+            raise ValueError(f"Expected a JSON object, got {type(value).__name__}")
+        return value
+    return text
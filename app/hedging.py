@@ -0,0 +1,147 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from app.config import (
+    LLM_HEDGE_BUDGET, LLM_HEDGE_ENGINES, LLM_HEDGE_MIN_DELAY_MS, LLM_HEDGE_MIN_SAMPLES, LLM_HEDGE_PERCENTILE
+)
+
+# Размер окна задержек на пару (движок, этап)
+HEDGE_WINDOW = 200
+
+
+class Hedger:
+    """
+    Хеджирование вызовов LLM против длинного хвоста задержек.
+
+    Для каждой пары (движок, этап) хранится окно задержек успешных ответов. Если вызов
+    не ответил за перцентиль окна (LLM_HEDGE_PERCENTILE, не меньше LLM_HEDGE_MIN_DELAY_MS),
+    запускается дубликат (та же или запасная модель); берется первый валидный ответ,
+    проигравший вызов отменяется. Доля хеджированных вызовов ограничена бюджетом
+    LLM_HEDGE_BUDGET от всех вызовов. До набора LLM_HEDGE_MIN_SAMPLES задержек этап не хеджируется.
+    """
+
+    def __init__(
+        self,
+        engines=LLM_HEDGE_ENGINES,
+        percentile: float = LLM_HEDGE_PERCENTILE,
+        budget: float = LLM_HEDGE_BUDGET,
+        min_samples: int = LLM_HEDGE_MIN_SAMPLES,
+        min_delay_ms: float = LLM_HEDGE_MIN_DELAY_MS,
+    ):
+        self.engines = set(engines)
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay_ms / 1000
+        self._latencies: Dict[Tuple[str, str], Deque[float]] = {}
+        # (движок, этап) -> {"calls", "hedged", "wins"}
+        self._stats: Dict[Tuple[str, str], Dict[str, int]] = {}
+        self._calls = 0
+        self._hedged = 0
+        self._lock = threading.Lock()
+
+    def _observe(self, key: Tuple[str, str], seconds: float):
+        with self._lock:
+            window = self._latencies.get(key)
+            if window is None:
+                window = self._latencies[key] = deque(maxlen=HEDGE_WINDOW)
+            window.append(seconds)
+
+    def delay(self, engine: str, stage: str) -> Optional[float]:
+        """Через сколько секунд запускать дубликат, None - этап не хеджируется"""
+        if engine not in self.engines:
+            return None
+        with self._lock:
+            window = self._latencies.get((engine, stage))
+            if window is None or len(window) < self.min_samples:
+                return None
+            ordered = sorted(window)
+        return max(self.min_delay, ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))])
+
+    def _count(self, key: Tuple[str, str], field: str):
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {"calls": 0, "hedged": 0, "wins": 0}
+            stats[field] += 1
+            if field == "calls":
+                self._calls += 1
+            elif field == "hedged":
+                self._hedged += 1
+
+    def _within_budget(self) -> bool:
+        with self._lock:
+            return self._hedged < self.budget * self._calls
+
+    def stats(self) -> Dict[Tuple[str, str], Dict[str, float]]:
+        with self._lock:
+            return {
+                key: {
+                    **values,
+                    "hedge_rate": values["hedged"] / values["calls"] if values["calls"] else 0.0,
+                    "win_rate": values["wins"] / values["hedged"] if values["hedged"] else 0.0,
+                }
+                for key, values in self._stats.items()
+            }
+
+    async def call(
+        self,
+        engine: str,
+        stage: str,
+        fetch: Callable[[], Awaitable[str]],
+        hedge_fetch: Optional[Callable[[], Awaitable[str]]] = None,
+    ) -> str:
+        """Вызов с хеджированием; hedge_fetch - запрос дубликата (по умолчанию тот же fetch)"""
+        key = (engine, stage)
+        self._count(key, "calls")
+        delay = self.delay(engine, stage)
+        start = time.perf_counter()
+        if delay is None:
+            text = await fetch()
+            self._observe(key, time.perf_counter() - start)
+            return text
+
+        primary = asyncio.ensure_future(fetch())
+        pending = {primary}
+        try:
+            await asyncio.wait(pending, timeout=delay)
+            if primary.done() or not self._within_budget():
+                text = await primary
+                self._observe(key, time.perf_counter() - start)
+                return text
+
+            self._count(key, "hedged")
+            hedge_start = time.perf_counter()
+            hedge = asyncio.ensure_future((hedge_fetch or fetch)())
+            pending.add(hedge)
+            print(f"Hedging {engine}/{stage} call after {delay * 1000:.0f} ms")
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    text = task.result()
+                    if not text:
+                        continue
+                    if task is hedge:
+                        self._count(key, "wins")
+                        self._observe(key, time.perf_counter() - hedge_start)
+                    else:
+                        self._observe(key, time.perf_counter() - start)
+                    return text
+        finally:
+            # Проигравший (или оба при отмене вызывающего) отменяется
+            for task in pending:
+                task.cancel()
+        # Валидного ответа нет ни от одного вызова: ошибка или пустой ответ основного
+        if error is not None:
+            raise error
+        return primary.result()
+
+
+hedger = Hedger()
@@ -0,0 +1,311 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.config import (
+    HISTORY_BACKEND, HISTORY_TTL_SECONDS, HISTORY_MAX_USERS,
+    HISTORY_MAX_BYTES, HISTORY_SQLITE_PATH, HISTORY_REDIS_URL
+)
+
+# Сообщение истории в нейтральном формате: {"role": "user" | "assistant" | "summary", "content": "..."}
+Message = Dict[str, str]
+# Свертка вытесняемых сообщений в резюме: (предыдущее резюме, вытесненные сообщения) -> новое резюме
+Summarizer = Callable[[str, List[Message]], str]
+
+SUMMARY_ROLE = "summary"
+
+
+def merge_messages(
+    existing: List[Tuple[str, str]],
+    new_messages: List[Tuple[str, str]],
+    max_messages: int,
+    summarize: Optional[Summarizer] = None
+) -> List[Tuple[str, str]]:
+    """
+    Добавление сообщений с обрезкой до max_messages.
+    Если передан summarize, вытесняемые сообщения сворачиваются в резюме,
+    которое хранится первым элементом с ролью SUMMARY_ROLE.
+    """
+    summary = ""
+    dialog = list(existing)
+    if dialog and dialog[0][0] == SUMMARY_ROLE:
+        summary = dialog[0][1]
+        dialog = dialog[1:]
+    dialog.extend(new_messages)
+
+    if len(dialog) > max_messages:
+        evicted = dialog[:-max_messages]
+        dialog = dialog[-max_messages:]
+        if summarize is not None:
+            summary = summarize(summary, [{"role": role, "content": content} for role, content in evicted])
+
+    if summarize is not None and summary:
+        return [(SUMMARY_ROLE, summary)] + dialog
+    return dialog
+
+
+class HistoryStore:
+    """Базовый интерфейс хранилища истории диалогов"""
+
+    def get(self, user_id: str) -> List[Message]:
+        """Получение истории пользователя (пустой список, если истории нет или она истекла)"""
+        raise NotImplementedError
+
+    def append(
+        self,
+        user_id: str,
+        messages: List[Message],
+        max_messages: int,
+        summarize: Optional[Summarizer] = None
+    ) -> None:
+        """Атомарное добавление сообщений с обрезкой до последних max_messages (резюме не считается)"""
+        raise NotImplementedError
+
+    def clear(self, user_id: str) -> None:
+        """Удаление истории пользователя"""
+        raise NotImplementedError
+
+
+class MemoryHistoryStore(HistoryStore):
+    """
+    In-process LRU хранилище с TTL на пользователя и глобальным лимитом памяти.
+    Сообщения хранятся компактно - кортежами (role, content).
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: int = HISTORY_TTL_SECONDS,
+        max_users: int = HISTORY_MAX_USERS,
+        max_bytes: int = HISTORY_MAX_BYTES
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        # user_id -> (expires_at, сообщения, размер в байтах)
+        self._entries: "OrderedDict[str, Tuple[float, Tuple[Tuple[str, str], ...], int]]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size_of(messages: Tuple[Tuple[str, str], ...]) -> int:
+        return sum(len(role) + len(content.encode("utf-8")) for role, content in messages)
+
+    def _drop(self, user_id: str):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._total_bytes -= entry[2]
+
+    def _evict(self):
+        """Вытеснение самых давно использованных пользователей при превышении лимитов"""
+        while self._entries and (
+            len(self._entries) > self.max_users or self._total_bytes > self.max_bytes
+        ):
+            oldest_user_id = next(iter(self._entries))
+            self._drop(oldest_user_id)
+
+    def get(self, user_id: str) -> List[Message]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return []
+            if entry[0] < time.monotonic():
+                self._drop(user_id)
+                return []
+            self._entries.move_to_end(user_id)
+            return [{"role": role, "content": content} for role, content in entry[1]]
+
+    def append(
+        self,
+        user_id: str,
+        messages: List[Message],
+        max_messages: int,
+        summarize: Optional[Summarizer] = None
+    ) -> None:
+        new_messages = [(m["role"], m["content"]) for m in messages]
+        with self._lock:
+            entry = self._entries.get(user_id)
+            existing = entry[1] if entry is not None and entry[0] >= time.monotonic() else ()
+            combined = tuple(merge_messages(list(existing), new_messages, max_messages, summarize))
+            size = self._size_of(combined)
+            self._drop(user_id)
+            self._entries[user_id] = (time.monotonic() + self.ttl_seconds, combined, size)
+            self._total_bytes += size
+            self._evict()
+
+    def clear(self, user_id: str) -> None:
+        with self._lock:
+            self._drop(user_id)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    Общее для всех воркеров хоста хранилище на SQLite в режиме WAL.
+    Добавление выполняется в транзакции BEGIN IMMEDIATE, поэтому параллельные
+    append из разных процессов не теряют сообщения.
+    """
+
+    # Как часто (в операциях записи) чистить истекшие записи
+    PURGE_EVERY = 500
+
+    def __init__(
+        self,
+        path: str = HISTORY_SQLITE_PATH,
+        namespace: str = "default",
+        ttl_seconds: int = HISTORY_TTL_SECONDS
+    ):
+        self.path = path
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+        self._writes = 0
+        connection = self._connection()
+        connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversation_history (
+                namespace TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                messages TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (namespace, user_id)
+            )
+            """
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS conversation_history_expires ON conversation_history (expires_at)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        """Отдельное соединение на поток"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=30000")
+            self._local.connection = connection
+        return connection
+
+    def get(self, user_id: str) -> List[Message]:
+        row = self._connection().execute(
+            "SELECT messages FROM conversation_history WHERE namespace = ? AND user_id = ? AND expires_at >= ?",
+            (self.namespace, user_id, time.time())
+        ).fetchone()
+        if row is None:
+            return []
+        return [{"role": role, "content": content} for role, content in json.loads(row[0])]
+
+    def append(
+        self,
+        user_id: str,
+        messages: List[Message],
+        max_messages: int,
+        summarize: Optional[Summarizer] = None
+    ) -> None:
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT messages FROM conversation_history WHERE namespace = ? AND user_id = ? AND expires_at >= ?",
+                (self.namespace, user_id, now)
+            ).fetchone()
+            existing = [tuple(m) for m in json.loads(row[0])] if row is not None else []
+            combined = merge_messages(existing, [(m["role"], m["content"]) for m in messages], max_messages, summarize)
+            connection.execute(
+                "INSERT OR REPLACE INTO conversation_history (namespace, user_id, messages, expires_at) VALUES (?, ?, ?, ?)",
+                (self.namespace, user_id, json.dumps(combined, ensure_ascii=False, separators=(",", ":")), now + self.ttl_seconds)
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            connection.execute("DELETE FROM conversation_history WHERE expires_at < ?", (now,))
+
+    def clear(self, user_id: str) -> None:
+        self._connection().execute(
+            "DELETE FROM conversation_history WHERE namespace = ? AND user_id = ?",
+            (self.namespace, user_id)
+        )
+
+
+class RedisHistoryStore(HistoryStore):
+    """
+    Сетевое хранилище на Redis для нескольких хостов.
+    Добавление, обрезка и продление TTL выполняются одной MULTI/EXEC транзакцией
+    (с WATCH на ключ пользователя, если нужна свертка в резюме).
+    """
+
+    def __init__(
+        self,
+        url: Optional[str] = HISTORY_REDIS_URL,
+        namespace: str = "default",
+        ttl_seconds: int = HISTORY_TTL_SECONDS
+    ):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("HISTORY_BACKEND=redis requires the 'redis' package") from e
+        if not url:
+            raise RuntimeError("HISTORY_BACKEND=redis requires HISTORY_REDIS_URL")
+        self.client = redis.Redis.from_url(url)
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+
+    def _key(self, user_id: str) -> str:
+        return f"history:{self.namespace}:{user_id}"
+
+    def get(self, user_id: str) -> List[Message]:
+        raw_messages = self.client.lrange(self._key(user_id), 0, -1)
+        return [json.loads(raw) for raw in raw_messages]
+
+    def append(
+        self,
+        user_id: str,
+        messages: List[Message],
+        max_messages: int,
+        summarize: Optional[Summarizer] = None
+    ) -> None:
+        key = self._key(user_id)
+        if summarize is None:
+            pipeline = self.client.pipeline(transaction=True)
+            pipeline.rpush(key, *[json.dumps(m, ensure_ascii=False) for m in messages])
+            pipeline.ltrim(key, -max_messages, -1)
+            pipeline.expire(key, self.ttl_seconds)
+            pipeline.execute()
+            return
+
+        def update(pipeline):
+            existing = [(m["role"], m["content"]) for m in map(json.loads, pipeline.lrange(key, 0, -1))]
+            combined = merge_messages(existing, [(m["role"], m["content"]) for m in messages], max_messages, summarize)
+            pipeline.multi()
+            pipeline.delete(key)
+            pipeline.rpush(key, *[
+                json.dumps({"role": role, "content": content}, ensure_ascii=False) for role, content in combined
+            ])
+            pipeline.expire(key, self.ttl_seconds)
+
+        self.client.transaction(update, key)
+
+    def clear(self, user_id: str) -> None:
+        self.client.delete(self._key(user_id))
+
+
+def build_history_store(namespace: str) -> HistoryStore:
+    """Создание хранилища истории согласно HISTORY_BACKEND"""
+    backend = HISTORY_BACKEND.lower()
+    if backend == "sqlite":
+        return SQLiteHistoryStore(namespace=namespace)
+    if backend == "redis":
+        return RedisHistoryStore(namespace=namespace)
+    if backend != "memory":
+        print(f"Unknown HISTORY_BACKEND '{HISTORY_BACKEND}', falling back to memory")
+    return MemoryHistoryStore()
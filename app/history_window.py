@@ -0,0 +1,112 @@
+import re
+from typing import List, Optional
+
+from app.constants import HISTORY_SUMMARY_MAX_TOKENS, HISTORY_TOKEN_BUDGETS
+from app.history_store import SUMMARY_ROLE, Message
+from app.prompts import estimate_tokens
+
+# Префикс ответа ассистента, содержащего SQL
+SQL_PREFIX = "SQL: "
+
+SUMMARY_LABEL = "Краткое содержание предыдущего диалога:"
+QUESTION_CHARS = 120
+ANSWER_CHARS = 120
+SQL_CHARS = 240
+
+
+def compress_sql(sql: str, max_chars: int = SQL_CHARS) -> str:
+    """Сжатие SQL для истории: без комментариев, лишних пробелов и завершающей точки с запятой"""
+    sql = re.sub(r"--[^\n]*", " ", sql)
+    sql = re.sub(r"/\*.*?\*/", " ", sql, flags=re.DOTALL)
+    sql = " ".join(sql.split()).rstrip(";").strip()
+    if len(sql) > max_chars:
+        sql = sql[:max_chars - 1] + "…"
+    return sql
+
+
+def format_sql_answer(sql: str) -> str:
+    """Ответ ассистента для истории: сгенерированный SQL в сжатом виде"""
+    return f"{SQL_PREFIX}{compress_sql(sql)}"
+
+
+def _shorten(text: str, max_chars: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= max_chars else text[:max_chars - 1] + "…"
+
+
+def _trim_summary(lines: List[str], max_tokens: int) -> List[str]:
+    """Удаление самых старых строк резюме до укладывания в бюджет"""
+    while lines and estimate_tokens("\n".join(lines)) > max_tokens:
+        lines = lines[1:]
+    return lines
+
+
+def fold_into_summary(summary: str, evicted: List[Message]) -> str:
+    """
+    Свертка вытесняемых из окна реплик в краткое резюме.
+    Каждая пара превращается в одну строку: вопрос -> SQL (сжатый) или краткий ответ.
+    """
+    lines = [line for line in summary.split("\n") if line] if summary else []
+    question = None
+    for message in evicted:
+        if message["role"] == "user":
+            if question is not None:
+                lines.append(f"- Q: {question}")
+            question = _shorten(message["content"], QUESTION_CHARS)
+            continue
+        content = message["content"]
+        if content.startswith(SQL_PREFIX):
+            answer = f"SQL: {compress_sql(content[len(SQL_PREFIX):])}"
+        else:
+            answer = f"A: {_shorten(content, ANSWER_CHARS)}"
+        lines.append(f"- Q: {question} -> {answer}" if question is not None else f"- {answer}")
+        question = None
+    if question is not None:
+        lines.append(f"- Q: {question}")
+    return "\n".join(_trim_summary(lines, HISTORY_SUMMARY_MAX_TOKENS))
+
+
+def window_history(messages: List[Message], stage: Optional[str]) -> List[Message]:
+    """
+    Окно истории для этапа в пределах бюджета токенов.
+
+    Берутся самые свежие полные пары (вопрос + ответ), пока они помещаются в бюджет.
+    Резюме старых реплик (не более трети бюджета) добавляется в начало первого
+    сообщения окна, чтобы не нарушать чередование ролей user/model.
+    Для stage=None история возвращается целиком, без резюме.
+    """
+    summary = ""
+    dialog = messages
+    if messages and messages[0]["role"] == SUMMARY_ROLE:
+        summary = messages[0]["content"]
+        dialog = messages[1:]
+    if stage is None:
+        return list(dialog)
+
+    budget = HISTORY_TOKEN_BUDGETS.get(stage, 0)
+    if budget <= 0:
+        return []
+
+    # Под резюме резервируется не более трети бюджета, остальное - свежие реплики
+    summary_text = f"{SUMMARY_LABEL}\n{summary}" if summary else ""
+    summary_tokens = estimate_tokens(summary_text)
+    if summary_tokens > budget // 3:
+        summary_text, summary_tokens = "", 0
+
+    window: List[Message] = []
+    used = summary_tokens
+    index = len(dialog)
+    while index > 0:
+        # Окно собирается парами, чтобы не начинать с ответа ассистента
+        start = index - 2 if index >= 2 and dialog[index - 2]["role"] == "user" else index - 1
+        chunk = dialog[start:index]
+        chunk_tokens = sum(estimate_tokens(m["content"]) for m in chunk)
+        if used + chunk_tokens > budget:
+            break
+        window = chunk + window
+        used += chunk_tokens
+        index = start
+
+    if summary_text and window and window[0]["role"] == "user":
+        window[0] = {"role": "user", "content": f"{summary_text}\n\n{window[0]['content']}"}
+    return window
@@ -0,0 +1,141 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Границы корзин гистограмм длительности, в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Длительности этапов текущего запроса: этап -> миллисекунды (повторы суммируются)
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("stage_timings", default=None)
+
+
+def start_timings() -> Dict[str, float]:
+    """Начало сбора длительностей этапов для текущего запроса"""
+    timings: Dict[str, float] = {}
+    _timings.set(timings)
+    return timings
+
+
+def record_timing(stage: str, milliseconds: float):
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + milliseconds
+
+
+def get_timings() -> Dict[str, float]:
+    return {stage: round(ms, 2) for stage, ms in (_timings.get() or {}).items()}
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Замер длительности блока как этапа текущего запроса"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(stage, (time.perf_counter() - start) * 1000)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus (кумулятивные корзины, сумма и количество)"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...], buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # значения меток -> (счетчики корзин, сумма, количество)
+        self._series: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, list(series[0]), series[1], series[2]) for key, series in self._series.items()]
+        for key, counts, total, count in items:
+            labels = dict(zip(self.labelnames, key))
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': repr(bound)})} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Gauge:
+    """Gauge, значения которого вычисляются в момент отдачи метрик"""
+
+    def __init__(self, name: str, documentation: str, collect: Callable[[], Dict[Tuple[Tuple[str, str], ...], float]]):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.collect()
+        except Exception as e:
+            print(f"Could not collect metric {self.name}: {e}")
+            return lines
+        for labels, value in values.items():
+            lines.append(f"{self.name}{_format_labels(dict(labels))} {value}")
+        return lines
+
+
+REGISTRY: List = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+STAGE_DURATION = register(Histogram(
+    "text2sql_stage_duration_seconds",
+    "Duration of pipeline stages",
+    ("stage", "engine", "model", "output_format")
+))
+REQUEST_DURATION = register(Histogram(
+    "text2sql_request_duration_seconds",
+    "Duration of /process-text requests",
+    ("engine", "model", "output_format", "status")
+))
+
+
+def observe_request(engine: str, model: str, output_format: str, status: str, seconds: float):
+    """Перенос длительностей этапов текущего запроса в гистограммы"""
+    for stage, milliseconds in (_timings.get() or {}).items():
+        STAGE_DURATION.observe(milliseconds / 1000, stage=stage, engine=engine, model=model, output_format=output_format)
+    REQUEST_DURATION.observe(seconds, engine=engine, model=model, output_format=output_format, status=status)
+
+
+def render_metrics() -> str:
+    """Все зарегистрированные метрики в текстовом формате Prometheus"""
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -65,7 +65,11 @@ class TransactionSchema(BaseModel):
 class UserQuery(BaseModel):
     natural_language_query: str
     user_id: str
-    model: Literal["llm", "api"] = "api"
+    model: Literal["llm", "api", "auto"] = "api"
+    # Приближенный ответ по стратифицированной выборке с границами ошибки (см. app.approximate)
+    fast_mode: bool = False
+    # Строк в первой странице табличного ответа, остальные - через /results/{cursor} (None - RESULT_PAGE_SIZE)
+    page_size: Optional[int] = Field(default=None, ge=1)
 
 class FormatDecision(BaseModel):
     output_format: Literal["text", "table", "graph", "diagram"]
@@ -73,6 +77,16 @@ class FormatDecision(BaseModel):
     clarification_question: Optional[str] = None
     refined_query: str
 
+# Структурированные ответы модели (схемы ответа этапов, см. app.generation)
+class ClarityCheck(BaseModel):
+    is_clear: bool
+    clarification_question: Optional[str] = None
+
+class SQLGeneration(BaseModel):
+    sql_query: str
+    explanation: Optional[str] = None
+    estimated_performance: Optional[Literal["good", "medium", "poor"]] = None
+
 class SQLValidation(BaseModel):
     sql_query: str
     is_safe: bool
@@ -84,6 +98,8 @@ class ExecutionResult(BaseModel):
     data: List[Dict[str, Any]]
     row_count: int
     execution_time_ms: float
+    # Отпечаток формы запроса (см. app.sql_fingerprint)
+    sql_fingerprint: Optional[str] = None
 
 class FinalResponse(BaseModel):
     content: str
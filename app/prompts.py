@@ -0,0 +1,477 @@
+import json
+from contextvars import ContextVar
+from textwrap import dedent
+from typing import Any, Dict, List, Optional
+
+from app.config import PROMPT_TOKEN_BUDGETS
+from app.constants import DEFAULT_LIMIT, PRODUCTION_SYSTEM_PROMPT, STAGE_TOKEN_BUDGETS
+from app.example_bank import format_examples
+
+
+def _parse_budget_overrides(raw: str) -> Dict[str, int]:
+    """Разбор PROMPT_TOKEN_BUDGETS вида 'sql=1500,narrate=2000'"""
+    overrides = {}
+    for item in raw.split(","):
+        stage, _, value = item.partition("=")
+        if stage.strip() and value.strip().isdigit():
+            overrides[stage.strip()] = int(value.strip())
+    return overrides
+
+
+TOKEN_BUDGETS = {**STAGE_TOKEN_BUDGETS, **_parse_budget_overrides(PROMPT_TOKEN_BUDGETS)}
+
+LANGUAGE_NAMES = {
+    "ru": "русском",
+    "kk": "казахском",
+    "en": "английском"
+}
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """
+    Быстрая оценка количества токенов без токенизатора.
+    ~4 байта UTF-8 на токен: латиница ~4 символа на токен, кириллица ~2.
+    """
+    if not text:
+        return 0
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+# Отчет о токенах по этапам для текущего запроса
+_prompt_report: ContextVar[Optional[Dict[str, int]]] = ContextVar("prompt_report", default=None)
+
+
+def start_prompt_report() -> Dict[str, int]:
+    """Начало сбора статистики токенов для текущего запроса"""
+    report: Dict[str, int] = {}
+    _prompt_report.set(report)
+    return report
+
+
+def record_prompt_tokens(stage: str, tokens: int):
+    """Учет входных токенов этапа (повторные вызовы этапа суммируются)"""
+    report = _prompt_report.get()
+    if report is not None:
+        report[stage] = report.get(stage, 0) + tokens
+
+
+def get_prompt_report() -> Dict[str, int]:
+    """Статистика токенов по этапам для текущего запроса"""
+    return dict(_prompt_report.get() or {})
+
+
+def _truncate_to_tokens(text: str, tokens: int) -> str:
+    """Обрезка текста по границе строки до заданного числа токенов"""
+    if tokens <= 0:
+        return ""
+    lines = text.split("\n")
+    kept = []
+    used = 0
+    for line in lines:
+        line_tokens = estimate_tokens(line)
+        if used + line_tokens > tokens:
+            kept.append("...")
+            break
+        kept.append(line)
+        used += line_tokens
+    return "\n".join(kept)
+
+
+def fit_to_budget(stage: str, sections: List[str], optional: Optional[Dict[int, str]] = None) -> str:
+    """
+    Сборка промпта этапа в пределах бюджета токенов.
+
+    Args:
+        stage: название этапа (ключ TOKEN_BUDGETS)
+        sections: обязательные фрагменты в порядке следования
+        optional: {позиция: фрагмент} - необязательные фрагменты (контекст, примеры, данные),
+                  которые обрезаются с конца, если промпт не помещается в бюджет
+    """
+    optional = optional or {}
+    budget = TOKEN_BUDGETS.get(stage)
+    if budget is not None:
+        required_tokens = sum(estimate_tokens(s) for s in sections)
+        remaining = budget - required_tokens
+        fitted = {}
+        for position in sorted(optional):
+            text = optional[position]
+            text_tokens = estimate_tokens(text)
+            if text_tokens > remaining:
+                text = _truncate_to_tokens(text, remaining)
+                text_tokens = estimate_tokens(text)
+            fitted[position] = text
+            remaining -= text_tokens
+        optional = fitted
+
+    parts = list(sections)
+    for position in sorted(optional):
+        parts.insert(min(position, len(parts)), optional[position])
+    return "\n".join(part for part in parts if part)
+
+
+def _fragments(**by_language: str) -> Dict[str, str]:
+    """Подготовка фрагментов по языкам: убираем отступы один раз при импорте"""
+    return {lang: dedent(text).strip() for lang, text in by_language.items()}
+
+
+# Проверка ясности запроса
+
+CLARITY_EXAMPLES = _fragments(
+    kk="""
+    ПРИМЕРЫ УМНЫХ ПРЕДПОЛОЖЕНИЙ:
+    - "Қанша транзакция бар?" -> ПОНЯТНО: все транзакции за все время (is_clear: true)
+    - "Транзакциялар саны?" -> ПОНЯТНО: все транзакции (is_clear: true)
+    - "Барлық транзакциялар" -> ПОНЯТНО: все транзакции (is_clear: true)
+    - "Топ мерчанттар" -> ПОНЯТНО: топ по количеству/сумме (is_clear: true)
+    - "Алматыдағы транзакциялар" -> ПОНЯТНО: транзакции в Алматы (is_clear: true)
+    """,
+    en="""
+    EXAMPLES OF SMART ASSUMPTIONS:
+    - "How many transactions?" -> CLEAR: all transactions (is_clear: true)
+    - "Count transactions" -> CLEAR: all transactions (is_clear: true)
+    - "All transactions" -> CLEAR: all transactions (is_clear: true)
+    - "Top merchants" -> CLEAR: top by count/amount (is_clear: true)
+    - "Transactions in Almaty" -> CLEAR: transactions in Almaty (is_clear: true)
+    """,
+    ru="""
+    ПРИМЕРЫ УМНЫХ ПРЕДПОЛОЖЕНИЙ:
+    - "Сколько транзакций?" -> ПОНЯТНО: все транзакции за все время (is_clear: true)
+    - "Количество транзакций" -> ПОНЯТНО: все транзакции (is_clear: true)
+    - "Все транзакции" -> ПОНЯТНО: все транзакции (is_clear: true)
+    - "Топ мерчанты" -> ПОНЯТНО: топ по количеству/сумме (is_clear: true)
+    - "Транзакции в Алматы" -> ПОНЯТНО: транзакции в Алматы (is_clear: true)
+    """
+)
+
+_CLARITY_RULES_TEMPLATE = dedent("""
+    ПРАВИЛА АНАЛИЗА:
+    1. Если запрос содержит общие вопросы (сколько, количество, все, топ) БЕЗ указания периода - это ПОНЯТНО, значит "за все время"
+    2. Если запрос содержит фильтры (город, категория, тип) - это ПОНЯТНО, даже без даты
+    3. Если намерение пользователя очевидно из контекста - это ПОНЯТНО
+    4. Делай умные предположения вместо переспрашивания
+
+    КОГДА ТРЕБОВАТЬ УТОЧНЕНИЕ (только в критических случаях):
+    - Запрос полностью неясен или бессмыслен
+    - Есть конфликтующие требования (например, "топ-10" и "все" одновременно)
+    - Запрос слишком абстрактный без возможности предположения
+
+    КОГДА НЕ ТРЕБОВАТЬ УТОЧНЕНИЕ:
+    - Общие вопросы о количестве/сумме/топе - делай предположение "за все время"
+    - Вопросы с фильтрами без даты - используй все доступные данные
+    - Понятные запросы, даже если не указаны все параметры
+
+    КРИТИЧЕСКИ ВАЖНО: Запрос пользователя на {lang_name} языке.
+    Если нужно задать уточняющий вопрос, верни его СТРОГО на {lang_name} языке.
+
+    В большинстве случаев запросы ПОНЯТНЫ и не требуют уточнения.
+    Верни is_clear: true, если можно сделать разумное предположение.
+    Верни is_clear: false ТОЛЬКО если запрос действительно неясен и невозможно предположить намерение.
+
+    Верни JSON:
+    {{"is_clear": true/false, "clarification_question": "уточняющий вопрос на {lang_name} языке или null"}}
+""").strip()
+
+CLARITY_RULES = {lang: _CLARITY_RULES_TEMPLATE.format(lang_name=name) for lang, name in LANGUAGE_NAMES.items()}
+
+
+def build_clarity_prompt(query: str, lang: str, rules: bool = True) -> str:
+    """Промпт проверки ясности запроса (rules=False - правила уже в системной инструкции этапа)"""
+    return fit_to_budget("clarity", [
+        "Проанализируй запрос пользователя и определи, достаточно ли информации для его выполнения.",
+        f"ЗАПРОС: {query}",
+        *((CLARITY_EXAMPLES[lang], CLARITY_RULES[lang]) if rules else ()),
+    ])
+
+
+# Определение формата вывода
+
+FORMAT_EXAMPLES = _fragments(
+    kk="""
+    ПРИМЕРЫ:
+    - "Қанша транзакция бар?" -> output_format: "text", clarification_question: null
+    - "Транзакциялар тізімі" -> output_format: "table", clarification_question: null
+    - "График көрсет" -> output_format: "graph", clarification_question: null
+    """,
+    en="""
+    EXAMPLES:
+    - "How many transactions?" -> output_format: "text", clarification_question: null
+    - "List transactions" -> output_format: "table", clarification_question: null
+    - "Show graph" -> output_format: "graph", clarification_question: null
+    """,
+    ru="""
+    ПРИМЕРЫ:
+    - "Сколько транзакций?" -> output_format: "text", clarification_question: null
+    - "Список транзакций" -> output_format: "table", clarification_question: null
+    - "Покажи график" -> output_format: "graph", clarification_question: null
+    """
+)
+
+_FORMAT_RULES_TEMPLATE = dedent("""
+    Возможные форматы:
+    - "text": текстовый ответ, статистика, описания, вопросы "сколько", "сколько всего"
+    - "table": табличные данные, списки транзакций, "покажи", "выведи список"
+    - "graph": данные для графиков (временные ряды, сравнения), "график", "диаграмма"
+    - "diagram": диаграммы, распределения
+
+    ВАЖНО:
+    - Пользователь может менять формат вывода в рамках одного диалога - это нормально
+    - Если пользователь сначала запросил текст, а потом таблицу - это не требует уточнения
+    - Делай умные предположения: общие вопросы о количестве = формат "text"
+    - Требуй уточнение ТОЛЬКО если запрос действительно неясен и невозможно определить формат
+
+    КРИТИЧЕСКИ ВАЖНО: Запрос пользователя на {lang_name} языке.
+    Если нужно задать уточняющий вопрос, верни его СТРОГО на {lang_name} языке.
+
+    В большинстве случаев запросы ПОНЯТНЫ и не требуют уточнения.
+    Верни clarification_question: null, если можно определить формат или сделать предположение.
+    Верни clarification_question ТОЛЬКО если запрос действительно неясен.
+
+    Верни JSON:
+    {{"output_format": "text|table|graph|diagram", "confidence_score": 0.0-1.0, "clarification_question": null или "уточняющий вопрос на {lang_name} языке", "refined_query": "уточненный запрос пользователя с учетом контекста"}}
+""").strip()
+
+FORMAT_RULES = {lang: _FORMAT_RULES_TEMPLATE.format(lang_name=name) for lang, name in LANGUAGE_NAMES.items()}
+
+
+def build_format_prompt(query: str, lang: str, rules: bool = True) -> str:
+    """Промпт определения формата вывода (история передается отдельно, в contents)"""
+    return fit_to_budget("format", [
+        "Определи формат вывода для запроса пользователя с учетом контекста предыдущих сообщений.",
+        f"ТЕКУЩИЙ ЗАПРОС ПОЛЬЗОВАТЕЛЯ: {query}",
+        *((FORMAT_EXAMPLES[lang], FORMAT_RULES[lang]) if rules else ()),
+    ])
+
+
+# Генерация SQL
+
+SQL_INSTRUCTIONS = dedent(f"""
+    Generate optimized PostgreSQL SELECT query с учетом контекста предыдущих запросов:
+    - Use indexes on merchant_city, transaction_timestamp
+    - Add WHERE conditions before JOINs
+    - Include LIMIT {DEFAULT_LIMIT} if aggregating large datasets
+    - Validate against user intent
+    - Only SELECT queries allowed
+    - Учитывай контекст предыдущих сообщений при интерпретации запроса
+
+    КРИТИЧЕСКИ ВАЖНО:
+    - Все названия столбцов в SQL запросе ДОЛЖНЫ быть на английском языке
+    - Используй английские названия для AS алиасов: transaction_year, transaction_month, total_count, total_amount
+    - НЕ используй кириллицу или казахские символы в названиях столбцов SQL
+    - Примеры правильных названий: transaction_year, transaction_month, total_transactions, total_amount_kzt
+
+    Return JSON:
+    {{"sql_query": "string", "explanation": "string", "estimated_performance": "good|medium|poor"}}
+""").strip()
+
+
+def build_sql_prompt(query: str, examples: Optional[List[Any]] = None, rules: bool = True) -> str:
+    """
+    Промпт генерации SQL. Схема не дублируется - она уже есть в системном промпте,
+    история диалога передается отдельно, в contents.
+    """
+    examples_text = format_examples(examples) if examples else ""
+    return fit_to_budget(
+        "sql",
+        [f"USER_QUERY: {query}", *((SQL_INSTRUCTIONS,) if rules else ())],
+        optional={1: examples_text}
+    )
+
+
+# Исправление SQL по ошибке PostgreSQL
+
+REPAIR_INSTRUCTIONS = dedent("""
+    The PostgreSQL query below fails to compile. Fix only what the error points to,
+    keep the meaning, selected columns and aliases of the query unchanged.
+    Only SELECT queries allowed. Use only columns of the transactions table.
+
+    Return JSON:
+    {"sql_query": "string"}
+""").strip()
+
+
+def build_repair_prompt(query: str, sql: str, error: str, rules: bool = True) -> str:
+    """Промпт точечного исправления SQL: вопрос, запрос и ошибка компиляции"""
+    return fit_to_budget("repair", [
+        *((REPAIR_INSTRUCTIONS,) if rules else ()),
+        f"POSTGRES_ERROR: {error}",
+        f"SQL: {sql}",
+    ], optional={1: f"USER_QUERY: {query}"})
+
+
+# Системные инструкции этапов: общий системный промпт со схемой и статические правила этапа.
+# Префикс запроса одинаков для всех вызовов этапа, что позволяет кэшировать его на стороне провайдера.
+
+def _stage_system(rules: str) -> str:
+    return f"{PRODUCTION_SYSTEM_PROMPT.rstrip()}\n\nSTAGE_RULES:\n{rules}"
+
+
+STAGE_SYSTEM_INSTRUCTIONS = {
+    **{("clarity", lang): _stage_system(f"{CLARITY_EXAMPLES[lang]}\n{CLARITY_RULES[lang]}") for lang in LANGUAGE_NAMES},
+    **{("format", lang): _stage_system(f"{FORMAT_EXAMPLES[lang]}\n{FORMAT_RULES[lang]}") for lang in LANGUAGE_NAMES},
+    ("sql", None): _stage_system(SQL_INSTRUCTIONS),
+    ("repair", None): _stage_system(REPAIR_INSTRUCTIONS),
+}
+
+
+def stage_system_instruction(stage: str, lang: Optional[str] = None) -> str:
+    """Системная инструкция этапа; промпт этапа в этом случае собирается с rules=False"""
+    return STAGE_SYSTEM_INSTRUCTIONS[(stage, lang if stage in ("clarity", "format") else None)]
+
+
+# Перевод названий столбцов
+
+TRANSLATE_INSTRUCTIONS = {
+    "kk": _fragments(text="""
+        Келесі SQL сұрауының нәтижелерінен алынған баған атауларын қазақ тіліне аудар.
+        Әрбір баған атауын қазақ тіліне табиғи және түсінікті түрде аудар.
+        Мысалы:
+        - transaction_count -> Транзакциялар саны
+        - merchant_id -> Мерчант ID
+        - total_amount -> Жалпы сома
+        - avg_amount -> Орташа сома
+        - transaction_amount_kzt -> Транзакция сомасы (KZT)
+        - mcc_category -> MCC санаты
+        - merchant_city -> Мерчант қаласы
+        - transaction_year -> Транзакция жылы
+        - transaction_month -> Транзакция айы
+        - total_transactions -> Транзакциялар саны
+        - total_amount_kzt -> Жалпы сома (KZT)
+        КРИТИЧЕСКИ ВАЖНО: Запрос пользователя на казахском языке. Переведи ВСЕ названия столбцов на казахский язык.
+        Верни JSON объект, где ключи - оригинальные названия, значения - переводы.
+    """)["text"],
+    "ru": _fragments(text="""
+        Переведи названия столбцов из результатов SQL запроса на русский язык.
+        Переведи каждое название столбца на русский язык естественным и понятным образом.
+        Примеры:
+        - transaction_count -> Количество транзакций
+        - merchant_id -> ID мерчанта
+        - total_amount -> Общая сумма
+        - avg_amount -> Средняя сумма
+        - transaction_amount_kzt -> Сумма транзакции (KZT)
+        - mcc_category -> Категория MCC
+        - merchant_city -> Город мерчанта
+        - transaction_year -> Год транзакции
+        - transaction_month -> Месяц транзакции
+        - total_transactions -> Количество транзакций
+        - total_amount_kzt -> Общая сумма (KZT)
+        КРИТИЧЕСКИ ВАЖНО: Запрос пользователя на русском языке. Переведи ВСЕ названия столбцов на русский язык.
+        НЕ используй казахский язык для переводов, даже если в истории диалога были казахские сообщения.
+        Верни JSON объект, где ключи - оригинальные названия, значения - переводы.
+    """)["text"],
+    # Обратный перевод уже переведенных столбцов
+    "kk_to_ru": _fragments(text="""
+        Переведи названия столбцов с казахского языка на русский язык естественным и понятным образом.
+        Примеры:
+        - Транзакция жылы -> Год транзакции
+        - Транзакция айы -> Месяц транзакции
+        - Транзакциялар саны -> Количество транзакций
+        - Жалпы сома (KZT) -> Общая сумма (KZT)
+        - Мерчант ID -> ID мерчанта
+        Верни JSON объект, где ключи - казахские названия, значения - русские переводы.
+    """)["text"],
+    "ru_to_kk": _fragments(text="""
+        Келесі баған атауларын орыс тілінен қазақ тіліне табиғи және түсінікті түрде аудар.
+        Мысалы:
+        - Год транзакции -> Транзакция жылы
+        - Месяц транзакции -> Транзакция айы
+        - Количество транзакций -> Транзакциялар саны
+        - Общая сумма (KZT) -> Жалпы сома (KZT)
+        Верни JSON объект, где ключи - русские названия, значения - казахские переводы.
+    """)["text"],
+}
+
+TRANSLATE_SYSTEM = {
+    "kk": "Сен баған атауларын қазақ тіліне аударасың. Табиғи және түсінікті аудармалар бер.",
+    "ru": "Ты переводишь названия столбцов на русский язык. Давай естественные и понятные переводы. НЕ используй казахский язык.",
+    "kk_to_ru": "Ты переводишь названия столбцов с казахского языка на русский язык. Давай естественные и понятные переводы.",
+    "ru_to_kk": "Сен баған атауларын орыс тілінен қазақ тіліне аударасың. Табиғи және түсінікті аудармалар бер.",
+}
+
+
+def build_translate_prompt(columns: List[str], direction: str) -> str:
+    """Промпт перевода названий столбцов (direction: kk, ru, kk_to_ru, ru_to_kk)"""
+    return fit_to_budget("translate", [
+        TRANSLATE_INSTRUCTIONS[direction],
+        json.dumps(columns, ensure_ascii=False),
+    ])
+
+
+# Текстовый ответ по результатам SQL
+
+NARRATION_SYSTEM = {
+    "kk": "Сен - деректер аналитигінің көмекшісі. Деректер базасының деректері негізінде түсінікті және толық жауаптар құрастырасың.",
+    "en": "You are a data analyst assistant. You form clear and detailed answers based on database data.",
+    "ru": "Ты - помощник аналитика данных. Формируешь понятные и развернутые ответы на основе данных из базы данных.",
+}
+
+NARRATION_HEADERS = {
+    "kk": ("Сен - деректер аналитигінің көмекшісі. Пайдаланушы сұрақ қойды және SQL сұрауының нәтижелерін алды.",
+           "ПАЙДАЛАНУШЫНЫҢ СҰРАҒЫ:", "SQL СҰРАУЫНЫҢ НӘТИЖЕЛЕРІ:"),
+    "en": ("You are a data analyst assistant. The user asked a question and received SQL query results.",
+           "USER'S QUESTION:", "SQL QUERY RESULTS:"),
+    "ru": ("Ты - помощник аналитика данных. Пользователь задал вопрос и получил результаты SQL запроса.",
+           "ВОПРОС ПОЛЬЗОВАТЕЛЯ:", "РЕЗУЛЬТАТЫ SQL ЗАПРОСА:"),
+}
+
+NARRATION_INSTRUCTIONS = _fragments(
+    kk="""
+    Осы деректер негізінде толық, түсінікті жауапты қазақ тілінде құрастыр.
+    Жауап болуы керек:
+    - Табиғи және досалым, чат-бот сияқты
+    - Толық және ақпаратты
+    - Құрылымдалған (қажет болса, тізімдерді пайдалануға болады)
+    - Деректерден нақты сандар мен фактілерді қамтуы керек
+    - Пайдаланушының сұрағына толық жауап беруі керек
+    Егер деректер жоқ болса, мейірімділікпен хабарла.
+    Тек жауап мәтінін қайтар, қосымша түсіндірмелер немесе метадеректерсіз.
+    """,
+    en="""
+    Form a detailed, clear answer in English based on this data.
+    The answer should be:
+    - Natural and friendly, like from a chatbot
+    - Detailed and informative
+    - Structured (you can use lists if appropriate)
+    - Contain specific numbers and facts from the data
+    - Fully answer the user's question
+    If there is no data, politely inform about it.
+    Return ONLY the answer text, without additional explanations or metadata.
+    """,
+    ru="""
+    Сформируй развернутый, понятный ответ на русском языке на основе этих данных.
+    Ответ должен быть:
+    - Естественным и дружелюбным, как от чат-бота
+    - Развернутым и информативным
+    - Структурированным (можно использовать списки, если уместно)
+    - Содержать конкретные цифры и факты из данных
+    - Отвечать на вопрос пользователя полностью
+    Если данных нет, вежливо сообщи об этом.
+    Верни ТОЛЬКО текст ответа, без дополнительных пояснений или метаданных.
+    """
+)
+
+NO_DATA = {"kk": "Деректер жоқ", "en": "No data", "ru": "Нет данных"}
+MORE_ROWS = {
+    "kk": "... және тағы {count} жол(дар)",
+    "en": "... and {count} more row(s)",
+    "ru": "... и еще {count} строк(и)",
+}
+
+
+def summarize_rows(rows: List[Dict[str, Any]], lang: str, max_rows: int = 20) -> str:
+    """Компактное JSON-представление первых строк результата для промпта"""
+    if not rows:
+        return NO_DATA[lang]
+    lines = [json.dumps(row, ensure_ascii=False, separators=(",", ":")) for row in rows[:max_rows]]
+    if len(rows) > max_rows:
+        lines.append(MORE_ROWS[lang].format(count=len(rows) - max_rows))
+    return "\n".join(lines)
+
+
+def build_narration_prompt(query: str, rows: List[Dict[str, Any]], lang: str) -> str:
+    """Промпт формирования текстового ответа; строки данных обрезаются по бюджету этапа"""
+    intro, question_label, results_label = NARRATION_HEADERS[lang]
+    return fit_to_budget(
+        "narrate",
+        [intro, f"{question_label} {query}", results_label, NARRATION_INSTRUCTIONS[lang]],
+        optional={3: summarize_rows(rows, lang)}
+    )
@@ -0,0 +1,132 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.config import RESULT_CURSOR_MAX_BYTES, RESULT_CURSOR_MAX_PAGE_SIZE, RESULT_CURSOR_TTL_SECONDS, RESULT_PAGE_SIZE
+
+# Оценка накладных расходов на строку и значение (словарь, ключи, объекты значений)
+ROW_OVERHEAD_BYTES = 64
+VALUE_OVERHEAD_BYTES = 16
+
+
+class CursorEntry:
+    """Сохраненный результат: строки, размер страницы, срок действия и вычисленные сортировки"""
+
+    def __init__(self, rows: List[Dict[str, Any]], page_size: int, expires: float, size: int):
+        self.rows = rows
+        self.page_size = page_size
+        self.columns = list(rows[0].keys()) if rows else []
+        self.expires = expires
+        self.size = size
+        # (столбец, по убыванию) -> порядок индексов строк
+        self.orders: Dict[Tuple[str, bool], List[int]] = {}
+
+
+def _sort_key(value: Any) -> Tuple:
+    # NULL в конце; числа и строки сравниваются внутри своего типа
+    if value is None:
+        return (2, 0)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (0, value)
+    return (1, str(value))
+
+
+class ResultCursors:
+    """
+    Результаты табличных ответов на стороне сервера для постраничного просмотра.
+
+    Обработанные строки (после перевода столбцов) сохраняются под непрозрачным токеном;
+    страницы и сортированные представления отдаются из памяти без повторной генерации
+    и выполнения SQL. Срок действия продлевается при каждом обращении; при превышении
+    лимита памяти вытесняются давно не использованные результаты.
+    """
+
+    def __init__(self, ttl_seconds: int = RESULT_CURSOR_TTL_SECONDS, max_bytes: int = RESULT_CURSOR_MAX_BYTES):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, CursorEntry]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    @staticmethod
+    def _size_of(rows: List[Dict[str, Any]]) -> int:
+        size = 0
+        for row in rows:
+            size += ROW_OVERHEAD_BYTES
+            for key, value in row.items():
+                size += VALUE_OVERHEAD_BYTES + len(key) + (len(value) if isinstance(value, str) else 8)
+        return size
+
+    def _drop(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            self._total_bytes -= entry.size
+
+    def _evict(self, now: float):
+        """Удаление истекших результатов и вытеснение давно не использованных при превышении лимита"""
+        for token in [token for token, entry in self._entries.items() if entry.expires < now]:
+            self._drop(token)
+        while self._entries and self._total_bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def put(self, rows: List[Dict[str, Any]], page_size: int = RESULT_PAGE_SIZE) -> str:
+        """Сохранение результата с размером страницы первого ответа, возвращает токен курсора"""
+        token = secrets.token_urlsafe(16)
+        page_size = min(page_size or RESULT_CURSOR_MAX_PAGE_SIZE, RESULT_CURSOR_MAX_PAGE_SIZE)
+        entry = CursorEntry(rows, page_size, 0.0, self._size_of(rows))
+        with self._lock:
+            now = time.monotonic()
+            entry.expires = now + self.ttl_seconds
+            self._entries[token] = entry
+            self._total_bytes += entry.size
+            self._evict(now)
+        return token
+
+    def page(
+        self, token: str, offset: int, limit: Optional[int] = None, sort: Optional[str] = None, descending: bool = False
+    ) -> Optional[Tuple[List[Dict[str, Any]], int, int]]:
+        """
+        Страница результата (строки, общее количество строк и размер страницы), None - курсор
+        неизвестен или истек. Без limit страница того же размера, что и первая (не больше
+        RESULT_CURSOR_MAX_PAGE_SIZE). ValueError - сортировка по несуществующему столбцу.
+        """
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(token)
+            if entry is None or entry.expires < now:
+                self._drop(token)
+                return None
+            entry.expires = now + self.ttl_seconds
+            self._entries.move_to_end(token)
+        limit = min(limit or entry.page_size, RESULT_CURSOR_MAX_PAGE_SIZE)
+        if sort is None:
+            return entry.rows[offset:offset + limit], len(entry.rows), limit
+        if sort not in entry.columns:
+            raise ValueError(f"Unknown column '{sort}'")
+        # Сортировка вычисляется один раз на столбец и направление
+        order = entry.orders.get((sort, descending))
+        if order is None:
+            order = sorted(range(len(entry.rows)), key=lambda index: _sort_key(entry.rows[index].get(sort)), reverse=descending)
+            if descending:
+                # NULL в конце и при сортировке по убыванию
+                order = [index for index in order if entry.rows[index].get(sort) is not None] + \
+                        [index for index in order if entry.rows[index].get(sort) is None]
+            with self._lock:
+                if (sort, descending) not in entry.orders:
+                    entry.orders[(sort, descending)] = order
+                    entry.size += 8 * len(order)
+                    if self._entries.get(token) is entry:
+                        self._total_bytes += 8 * len(order)
+        return [entry.rows[index] for index in order[offset:offset + limit]], len(entry.rows), limit
+
+
+result_cursors = ResultCursors()
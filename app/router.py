@@ -0,0 +1,181 @@
+import random
+import re
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from app.config import (
+    ROUTING_COOLDOWN_SECONDS, ROUTING_EXPLORE_RATE, ROUTING_LATENCY_SLO_MS, ROUTING_MAX_ERROR_RATE,
+    ROUTING_MIN_SAMPLES, ROUTING_QUALITY_ORDER, ROUTING_WINDOW
+)
+
+# Признаки сложного запроса: сравнения, динамика, несколько измерений, доли
+COMPLEX_MARKERS = re.compile(
+    r"сравни|сравнен|динамик|тренд|рост|измен|дол[яиею]|процент|корреляц|медиан|в разрезе|по каждому|"
+    r"салыстыр|өзгеріс|үлес|пайыз|"
+    r"compare|versus|\bvs\b|trend|growth|change|share|percent|ratio|correlat|median|breakdown|per each",
+    re.IGNORECASE
+)
+# Соединители условий: "и", "а также", "and", "және"
+CONDITION_MARKERS = re.compile(r"\b(и|а также|но|and|but|және|мен)\b", re.IGNORECASE)
+# Запрос длиннее этого числа слов считается сложным
+COMPLEX_WORDS = 18
+# Подряд идущих ошибок, после которых движок выводится из ротации без ожидания статистики
+MAX_CONSECUTIVE_FAILURES = 3
+
+
+def classify_complexity(query: str) -> str:
+    """Локальная оценка сложности запроса: simple | complex"""
+    words = len(query.split())
+    if words > COMPLEX_WORDS or COMPLEX_MARKERS.search(query):
+        return "complex"
+    if len(CONDITION_MARKERS.findall(query)) >= 2:
+        return "complex"
+    return "simple"
+
+
+def _percentile(ordered: List[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class EngineHealth:
+    """Скользящее окно задержек и ошибок движка"""
+
+    def __init__(self, window: int):
+        self.samples: Deque[Tuple[float, bool]] = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+
+    def snapshot(self) -> Dict[str, Optional[float]]:
+        latencies = sorted(seconds for seconds, ok in self.samples if ok)
+        errors = sum(1 for _, ok in self.samples if not ok)
+        return {
+            "samples": len(self.samples),
+            "p50": _percentile(latencies, 0.5) if latencies else None,
+            "p95": _percentile(latencies, 0.95) if latencies else None,
+            "error_rate": errors / len(self.samples) if self.samples else 0.0,
+        }
+
+
+class RoutingDecision(NamedTuple):
+    engine: str
+    complexity: str
+    reason: str                 # affinity | quality | fastest | slo_miss | explore | unhealthy
+    fallback: Optional[str]     # движок для повтора при отказе выбранного
+
+
+class Router:
+    """
+    Выбор движка для model="auto".
+
+    Для каждого движка в скользящем окне хранятся задержки успешных запросов и ошибки.
+    Движок с долей ошибок выше порога (или несколькими ошибками подряд) выводится из ротации
+    на время cooldown. Из оставшихся выбирается:
+      - движок, в котором уже идет диалог пользователя, если он укладывается в SLO (история не теряется);
+      - для сложных запросов - первый по качеству (ROUTING_QUALITY_ORDER), укладывающийся в SLO;
+      - для простых - самый быстрый по p50;
+      - если в SLO не укладывается никто - движок с наименьшим p95.
+    Движки без статистики считаются укладывающимися в SLO; небольшая доля запросов
+    (ROUTING_EXPLORE_RATE) уходит в другой движок, чтобы его статистика не устаревала.
+    """
+
+    def __init__(
+        self,
+        slo_ms: float = ROUTING_LATENCY_SLO_MS,
+        window: int = ROUTING_WINDOW,
+        max_error_rate: float = ROUTING_MAX_ERROR_RATE,
+        cooldown_seconds: float = ROUTING_COOLDOWN_SECONDS,
+        min_samples: int = ROUTING_MIN_SAMPLES,
+        explore_rate: float = ROUTING_EXPLORE_RATE,
+        quality_order: Sequence[str] = ROUTING_QUALITY_ORDER,
+    ):
+        self.slo = slo_ms / 1000
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.cooldown_seconds = cooldown_seconds
+        self.min_samples = min_samples
+        self.explore_rate = explore_rate
+        self.quality_order = list(quality_order)
+        self._health: Dict[str, EngineHealth] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name: str) -> EngineHealth:
+        health = self._health.get(name)
+        if health is None:
+            health = self._health[name] = EngineHealth(self.window)
+        return health
+
+    def record(self, name: str, seconds: float, ok: bool):
+        """Результат запроса к движку (задержка этапов LLM, успех или отказ)"""
+        with self._lock:
+            health = self._get(name)
+            health.samples.append((seconds, ok))
+            if ok:
+                health.consecutive_failures = 0
+                return
+            health.consecutive_failures += 1
+            snapshot = health.snapshot()
+            degraded = (
+                health.consecutive_failures >= MAX_CONSECUTIVE_FAILURES
+                or (snapshot["samples"] >= self.min_samples and snapshot["error_rate"] > self.max_error_rate)
+            )
+            if degraded:
+                health.down_until = time.monotonic() + self.cooldown_seconds
+                print(f"Engine '{name}' marked unhealthy for {self.cooldown_seconds}s "
+                      f"(error rate {snapshot['error_rate']:.2f}, {health.consecutive_failures} failures in a row)")
+
+    def healthy(self, name: str) -> bool:
+        with self._lock:
+            return time.monotonic() >= self._get(name).down_until
+
+    def stats(self) -> Dict[str, Dict[str, Optional[float]]]:
+        with self._lock:
+            return {
+                name: {**health.snapshot(), "healthy": float(time.monotonic() >= health.down_until)}
+                for name, health in self._health.items()
+            }
+
+    def _p95(self, stats: Dict[str, Dict], name: str) -> Optional[float]:
+        snapshot = stats.get(name)
+        if not snapshot or snapshot["samples"] < self.min_samples:
+            return None
+        return snapshot["p95"]
+
+    def choose(self, query: str, candidates: Sequence[str], affinity: Optional[str] = None) -> RoutingDecision:
+        complexity = classify_complexity(query)
+        healthy = [name for name in candidates if self.healthy(name)]
+        reason = None
+        if not healthy:
+            # Все движки выведены из ротации - пробуем все, начиная с лучшего по качеству
+            healthy, reason = list(candidates), "unhealthy"
+        stats = self.stats()
+
+        def meets_slo(name: str) -> bool:
+            p95 = self._p95(stats, name)
+            return p95 is None or p95 <= self.slo
+
+        def p50(name: str) -> float:
+            snapshot = stats.get(name)
+            return snapshot["p50"] if snapshot and snapshot["p50"] is not None and snapshot["samples"] >= self.min_samples else 0.0
+
+        by_quality = sorted(healthy, key=lambda name: self.quality_order.index(name) if name in self.quality_order else len(self.quality_order))
+        if affinity in healthy and meets_slo(affinity):
+            engine, reason = affinity, reason or "affinity"
+        else:
+            order = by_quality if complexity == "complex" else sorted(healthy, key=p50)
+            within_slo = [name for name in order if meets_slo(name)]
+            if within_slo:
+                engine, reason = within_slo[0], reason or ("quality" if complexity == "complex" else "fastest")
+            else:
+                engine = min(healthy, key=lambda name: self._p95(stats, name) or 0.0)
+                reason = reason or "slo_miss"
+
+        others = [name for name in by_quality if name != engine]
+        if others and reason not in ("affinity", "unhealthy") and random.random() < self.explore_rate:
+            engine, reason = random.choice(others), "explore"
+            others = [name for name in by_quality if name != engine]
+        return RoutingDecision(engine, complexity, reason, others[0] if others else None)
+
+
+router = Router()
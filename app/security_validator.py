@@ -1,21 +1,106 @@
+import hashlib
 import re
-from typing import List, Set
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import FrozenSet, List, Set, Tuple
 from app.models import SQLValidation
+from app.sql_lexer import ERROR, WORD, split_statements, tokenize
 
 class SecurityException(Exception):
     """Исключение для нарушений безопасности SQL"""
     pass
 
+
+# Первое ключевое слово разрешенного выражения
+ALLOWED_STATEMENTS = {"SELECT", "WITH"}
+# Запрещенные ключевые слова в любом месте запроса (вне литералов и комментариев)
+FORBIDDEN_KEYWORDS = {
+    "INSERT", "UPDATE", "DELETE", "DROP", "ALTER", "CREATE", "TRUNCATE", "MERGE",
+    "COPY", "GRANT", "REVOKE", "EXEC", "EXECUTE", "CALL", "INTO", "LOCK", "VACUUM",
+    "SLEEP", "PG_SLEEP", "BENCHMARK", "WAITFOR"
+}
+# Более длинные запросы отклоняются без разбора (ограничивает худшее время проверки)
+MAX_SQL_CHARS = 20000
+# Размер кэша вердиктов по хэшу SQL
+VERDICT_CACHE_SIZE = 4096
+
+STOP_WORDS = {"the", "a", "an", "and", "or", "but", "in", "on", "at", "to", "for", "of", "with", "by", "как", "что", "где", "когда", "какой", "какая", "какие", "какое", "какую", "какого"}
+
+
+@lru_cache(maxsize=4096)
+def _intent_keywords(text: str) -> FrozenSet[str]:
+    """Ключевые слова текста без стоп-слов (кэшируется: интент проверяется несколько раз за запрос)"""
+    words = re.findall(r'\b\w+\b', text.lower())
+    return frozenset(w for w in words if len(w) > 2 and w not in STOP_WORDS)
+
+
+def check_sql_safety(sql: str) -> Tuple[bool, List[str]]:
+    """
+    Проверка безопасности SQL по токенам: ровно одно выражение, начинающееся с
+    SELECT/WITH, без запрещенных ключевых слов и без UNION ... SELECT.
+    Ключевые слова внутри строк, комментариев и идентификаторов в кавычках не учитываются.
+    """
+    notes: List[str] = []
+    
+    def add_note(note: str):
+        if note not in notes:
+            notes.append(note)
+    
+    if len(sql) > MAX_SQL_CHARS:
+        add_note(f"Запрос длиннее {MAX_SQL_CHARS} символов")
+        return False, notes
+    
+    tokens = tokenize(sql)
+
+    if any(token.kind == ERROR for token in tokens):
+        add_note("Незакрытая строка, идентификатор или комментарий")
+
+    statements = split_statements(tokens)
+    if len(statements) > 1:
+        add_note("Несколько SQL выражений в одном запросе")
+    if not statements:
+        add_note("Пустой запрос")
+
+    for statement in statements:
+        words = [token.value for token in statement if token.kind == WORD]
+        first_word = words[0] if words else ""
+        if first_word not in ALLOWED_STATEMENTS:
+            add_note("Разрешены только SELECT запросы")
+
+        forbidden = sorted(FORBIDDEN_KEYWORDS.intersection(words))
+        if forbidden:
+            add_note(f"Запрещенные операции: {', '.join(forbidden)}")
+
+        if "UNION" in words and "SELECT" in words[words.index("UNION") + 1:]:
+            add_note("UNION с SELECT запрещен")
+
+    return not notes, notes
+
+
 class SecurityValidator:
     """Валидатор безопасности SQL запросов"""
     
-    DANGEROUS_PATTERNS = [
-        r"\b(INSERT|UPDATE|DELETE|DROP|ALTER|CREATE|TRUNCATE)\b",
-        r";\s*(\w|\s)*$",  # Multiple statements
-        r"\b(COPY|GRANT|REVOKE|EXEC)\b",
-        r"(\bUNION\b.*\bSELECT\b)",
-        r"\b(SLEEP|BENCHMARK|WAITFOR)\b"
-    ]
+    # Вердикты безопасности по хэшу SQL, общие для всех экземпляров
+    # (запрос проверяется и при генерации, и перед выполнением)
+    _verdicts: "OrderedDict[str, Tuple[bool, Tuple[str, ...]]]" = OrderedDict()
+    _verdicts_lock = threading.Lock()
+    
+    def _safety_verdict(self, sql: str) -> Tuple[bool, Tuple[str, ...]]:
+        key = hashlib.sha256(sql.encode("utf-8")).hexdigest()
+        with self._verdicts_lock:
+            verdict = self._verdicts.get(key)
+            if verdict is not None:
+                self._verdicts.move_to_end(key)
+                return verdict
+        
+        is_safe, notes = check_sql_safety(sql)
+        verdict = (is_safe, tuple(notes))
+        with self._verdicts_lock:
+            self._verdicts[key] = verdict
+            while len(self._verdicts) > VERDICT_CACHE_SIZE:
+                self._verdicts.popitem(last=False)
+        return verdict
     
     def validate_sql(self, sql: str, user_intent: str) -> SQLValidation:
         """
@@ -24,21 +109,8 @@ class SecurityValidator:
         Returns:
             SQLValidation с результатами валидации
         """
-        sql_upper = sql.upper().strip()
-        
-        # Проверка синтаксической безопасности
-        is_safe = True
-        security_notes = []
-        
-        for pattern in self.DANGEROUS_PATTERNS:
-            if re.search(pattern, sql, re.IGNORECASE):
-                is_safe = False
-                security_notes.append(f"Обнаружен опасный паттерн: {pattern}")
-        
-        # Проверка что это SELECT запрос
-        # if not sql_upper.startswith(("SELECT", "WITH")):
-        #     is_safe = False
-        #     security_notes.append("Разрешены только SELECT запросы")
+        # Проверка синтаксической безопасности (результат кэшируется по хэшу SQL)
+        is_safe, security_notes = self._safety_verdict(sql.strip())
         
         # Проверка соответствия интенту
         matches_intent = self._matches_intent(sql, user_intent)
@@ -46,7 +118,8 @@ class SecurityValidator:
         # if not matches_intent:
         #     intent_notes.append("SQL запрос может не соответствовать намерению пользователя")
         
-        validation_notes = "; ".join(security_notes + intent_notes) if (security_notes or intent_notes) else "Запрос валиден"
+        notes = list(security_notes) + intent_notes
+        validation_notes = "; ".join(notes) if notes else "Запрос валиден"
         
         return SQLValidation(
             sql_query=sql,
@@ -58,17 +131,14 @@ class SecurityValidator:
     
     def _extract_keywords(self, text: str) -> Set[str]:
         """Извлечение ключевых слов из текста"""
-        # Удаляем стоп-слова и извлекаем значимые слова
-        stop_words = {"the", "a", "an", "and", "or", "but", "in", "on", "at", "to", "for", "of", "with", "by", "как", "что", "где", "когда", "какой", "какая", "какие", "какое", "какую", "какого", "какой", "какую", "какие", "какое", "какого", "какой", "какую", "какие", "какое", "какого"}
-        words = re.findall(r'\b\w+\b', text.lower())
-        return {w for w in words if len(w) > 2 and w not in stop_words}
+        return set(_intent_keywords(text))
     
     def _matches_intent(self, sql: str, user_intent: str) -> bool:
         """
         Проверка соответствия SQL запроса намерению пользователя
         Базовая проверка по ключевым словам
         """
-        intent_keywords = self._extract_keywords(user_intent)
+        intent_keywords = _intent_keywords(user_intent)
         sql_lower = sql.lower()
         
         # Если интент пустой или слишком общий, считаем что соответствует
@@ -81,4 +151,3 @@ class SecurityValidator:
         
         # Если совпало больше половины ключевых слов, считаем что соответствует
         return matched_keywords >= len(intent_keywords) * 0.3
-
@@ -1,18 +1,85 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+import asyncio
+import json
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from app.text2sql import build_text2sql
-from app.text2sql_local import build_text2sql_local
+from app.config import (
+    ENABLED_ENGINES, WARMUP_ENGINES, LOCAL_TEXT_RENDERING, ENUM_PREDICATE_REWRITE, FAST_MODE,
+    GRAPH_MAX_POINTS, GRAPH_SQL_BUCKETING, RESULT_PAGE_SIZE, RESULT_CURSOR_MAX_PAGE_SIZE, RESULT_CURSOR_TTL_SECONDS
+)
+from app import sql_to_db
 from app.sql_to_db import execute_sql_query
-from app.models import UserQuery, FinalResponse
-from app.security_validator import SecurityException
+from app.approximate import (
+    ApproximationUnavailable, estimate_result, fast_mode_stats, get_sample_info, pending_upgrades, plan_sample_query
+)
+from app.cassette import get_cassette
+from app.context_cache import context_cache
+from app.downsampling import downsample_graph
+from app.example_bank import get_example_bank
+from app.hedging import hedger
+from app.metrics import Gauge, register, render_metrics, observe_request, start_timings, get_timings, record_timing, timed
+from app.models import UserQuery, FinalResponse, ExecutionResult
+from app.router import RoutingDecision, router
+from app.prompts import start_prompt_report, get_prompt_report
+from app.result_cursors import result_cursors
+from app.security_validator import SecurityException, SecurityValidator
+from app.sql_fingerprint import analyze_sql, shape_metadata
+from app.sql_rewriter import coarsen_time_buckets, rewrite_enum_predicates
+from app.sql_repair import SQLCompileError, prepare_sql
+from app.text_renderer import render_text
+
+# Движки создаются лениво при первом использовании
+_engines: Dict[str, Any] = {}
+_engines_lock = threading.Lock()
+
+
+def _build_engine(name: str):
+    """Импорт и создание движка по имени (тяжелые SDK импортируются только здесь)"""
+    if name == "api":
+        from app.text2sql import build_text2sql
+        return build_text2sql()
+    from app.text2sql_local import build_text2sql_local
+    return build_text2sql_local()
+
+
+def get_engine(name: str):
+    """Получение движка по имени с созданием при первом обращении"""
+    if name not in ENABLED_ENGINES:
+        raise HTTPException(status_code=400, detail=f"Model '{name}' is not enabled on this server")
+    engine = _engines.get(name)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(name)
+            if engine is None:
+                engine = _build_engine(name)
+                _engines[name] = engine
+    return engine
 
-app = FastAPI()
 
-# Инициализируем оба движка
-api_engine = build_text2sql()
-llm_engine = build_text2sql_local()
+def warmup_engines():
+    """Создание и прогрев всех включенных движков"""
+    for name in ENABLED_ENGINES:
+        try:
+            get_engine(name).warmup()
+            print(f"Engine '{name}' warmed up")
+        except Exception as e:
+            print(f"Warning: could not warm up engine '{name}': {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if WARMUP_ENGINES:
+        await asyncio.to_thread(warmup_engines)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,86 +88,614 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.post("/process-text")
-async def process_text_stream(req: UserQuery):
-    """Обработка запроса с использованием production контракта и поддержкой контекста"""
+def _collect_inflight():
+    values = {(("flight", "sql"),): sql_to_db.sql_flight.in_flight()}
+    for name, engine in list(_engines.items()):
+        values[(("flight", name),)] = engine._inflight.in_flight()
+    return values
+
+
+def _collect_coalesced():
+    values = {(("flight", "sql"),): sql_to_db.sql_flight.coalesced}
+    for name, engine in list(_engines.items()):
+        values[(("flight", name),)] = engine._inflight.coalesced
+    return values
+
+
+def _collect_pool():
+    db_engine = sql_to_db._engine
+    if db_engine is None:
+        return {}
+    pool = db_engine.pool
+    return {
+        (("state", "size"),): pool.size(),
+        (("state", "checked_out"),): pool.checkedout(),
+        (("state", "checked_in"),): pool.checkedin(),
+        (("state", "overflow"),): pool.overflow(),
+    }
+
+
+def _collect_caches():
+    shape_cache = analyze_sql.cache_info()
+    values = {
+        (("cache", "validator_verdicts"), ("kind", "size")): len(SecurityValidator._verdicts),
+        (("cache", "sql_shapes"), ("kind", "size")): shape_cache.currsize,
+        (("cache", "sql_shapes"), ("kind", "hits")): shape_cache.hits,
+        (("cache", "sql_shapes"), ("kind", "misses")): shape_cache.misses,
+    }
+    for name, engine in list(_engines.items()):
+        if hasattr(engine.history_store, "__len__"):
+            values[(("cache", f"history_{name}"), ("kind", "size"))] = len(engine.history_store)
+    bank = get_example_bank()
+    if bank is not None:
+        values[(("cache", "example_bank"), ("kind", "size"))] = len(bank)
+    values[(("cache", "result_cursors"), ("kind", "size"))] = len(result_cursors)
+    values[(("cache", "result_cursors"), ("kind", "bytes"))] = result_cursors.total_bytes
+    return values
+
+
+def _collect_cassette():
+    cassette = get_cassette()
+    if cassette is None:
+        return {}
+    return {(("mode", cassette.mode), ("kind", kind)): value for kind, value in cassette.stats.items()}
+
+
+def _collect_routing():
+    values = {}
+    for name, snapshot in router.stats().items():
+        for kind in ("p50", "p95", "error_rate", "healthy", "samples"):
+            if snapshot[kind] is not None:
+                values[(("engine", name), ("kind", kind))] = snapshot[kind]
+    return values
+
+
+def _collect_context_cache():
+    values = {(("kind", kind),): value for kind, value in context_cache.stats.items()}
+    values[(("kind", "live"),)] = context_cache.live()
+    return values
+
+
+def _collect_fast_mode():
+    values = {(("kind", kind),): value for kind, value in fast_mode_stats.items()}
+    values[(("kind", "pending_upgrades"),)] = len(pending_upgrades)
+    return values
+
+
+def _collect_hedging():
+    values = {}
+    for (engine, stage), stats in hedger.stats().items():
+        for kind in ("calls", "hedged", "wins", "hedge_rate", "win_rate"):
+            values[(("engine", engine), ("stage", stage), ("kind", kind))] = stats[kind]
+    return values
+
+
+register(Gauge("text2sql_inflight", "Computations currently in flight per single-flight group", _collect_inflight))
+register(Gauge("text2sql_coalesced_calls", "Calls served by another caller's in-flight computation", _collect_coalesced))
+register(Gauge("text2sql_db_pool_connections", "Database connection pool state", _collect_pool))
+register(Gauge("text2sql_cache_entries", "Cache sizes and hit counters", _collect_caches))
+register(Gauge("text2sql_engine_health", "Rolling engine latency (seconds), error rate and health used by auto routing", _collect_routing))
+register(Gauge("text2sql_llm_cassette", "Recorded/replayed LLM calls and prompt hash collisions", _collect_cassette))
+register(Gauge("text2sql_llm_hedging", "Hedged LLM calls: calls, duplicates fired, duplicate wins and their rates", _collect_hedging))
+register(Gauge("text2sql_fast_mode", "Fast mode requests answered from the sample, run exactly, and upgraded to exact", _collect_fast_mode))
+register(Gauge("text2sql_gemini_context_cache", "Gemini context cache lifecycle, hits/misses and cached vs total prompt tokens", _collect_context_cache))
+
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики в формате Prometheus"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/health")
+async def health():
+    """Проверка готовности сервера"""
+    return {"status": "ok", "engines": {name: name in _engines for name in ENABLED_ENGINES}}
+
+
+def _history_affinity(user_id: str) -> Optional[str]:
+    """Движок, в котором у пользователя уже есть история диалога"""
+    for name, engine in list(_engines.items()):
+        try:
+            if engine.history_store.get(user_id):
+                return name
+        except Exception as e:
+            print(f"Could not read history of engine '{name}': {e}")
+    return None
+
+
+def _get_request_engine(req: UserQuery) -> Tuple[Any, str, Optional[RoutingDecision]]:
+    """Проверка запроса и выбор движка в зависимости от параметра model (auto - выбор роутером)"""
     query = req.natural_language_query.strip()
     if not query:
         raise HTTPException(status_code=400, detail="Field 'natural_language_query' is required")
     
-    # Выбираем движок в зависимости от параметра model
+    routing = None
+    if req.model == "auto":
+        routing = router.choose(query, ENABLED_ENGINES, _history_affinity(req.user_id))
+        print(f"Routing user {req.user_id} to '{routing.engine}' ({routing.complexity} query, {routing.reason})")
+        req.model = routing.engine
+    
+    engine = get_engine(req.model)
     if req.model == "api":
-        engine = api_engine
         print(f"Using API engine (Gemini) for user {req.user_id}")
-    else:  # "llm" или по умолчанию
-        engine = llm_engine
+    else:  # "llm"
         print(f"Using LLM engine (Ollama) for user {req.user_id}")
     
     print(f"Received query from user {req.user_id}: {query}")
+    return engine, query, routing
+
+
+def _start_request() -> float:
+    """Начало сбора отчетов о токенах и длительностях этапов для запроса"""
+    start_prompt_report()
+    start_timings()
+    return time.perf_counter()
+
+
+def _observe(req: UserQuery, engine, output_format: str, status: str, started: float):
+    observe_request(req.model, getattr(engine, "model", ""), output_format, status, time.perf_counter() - started)
+
 
+def _clarification_data(final_response: FinalResponse) -> Dict[str, Any]:
+    return {
+        "content": final_response.content,
+        "output_format": final_response.output_format,
+        "data": None,
+        "row_count": 0,
+        "execution_time_ms": 0,
+        "metadata": {**final_response.metadata, "prompt_tokens": get_prompt_report(), "timings": get_timings()}
+    }
+
+
+async def _generate(engine, req: UserQuery, routing: Optional[RoutingDecision]) -> Tuple[Any, FinalResponse]:
+    """
+    Генерация SQL движком с учетом его задержки и отказов в статистике роутера.
+    В режиме auto при отказе движка запрос повторяется на запасном.
+    """
+    while True:
+        started = time.perf_counter()
+        try:
+            final_response: FinalResponse = await engine.process_user_request(req)
+        except (HTTPException, SecurityException):
+            # Ответ движка получен - это не отказ бэкенда
+            router.record(req.model, time.perf_counter() - started, ok=True)
+            raise
+        except Exception as e:
+            router.record(req.model, time.perf_counter() - started, ok=False)
+            if routing is None or routing.fallback is None or routing.fallback == req.model:
+                raise
+            print(f"Engine '{req.model}' failed ({e}), failing over to '{routing.fallback}'")
+            req.model = routing.fallback
+            routing = routing._replace(engine=routing.fallback, reason="failover", fallback=None)
+            engine = get_engine(req.model)
+            continue
+        router.record(req.model, time.perf_counter() - started, ok=True)
+        if routing is not None:
+            final_response.metadata["routing"] = {
+                "engine": routing.engine, "complexity": routing.complexity, "reason": routing.reason
+            }
+        return engine, final_response
+
+
+async def _generate_and_execute(
+    engine, req: UserQuery, query: str, routing: Optional[RoutingDecision] = None
+) -> Tuple[Any, FinalResponse, Optional[ExecutionResult]]:
+    """
+    Генерация и выполнение SQL. Возвращает движок, который ответил (при auto он может смениться),
+    ответ и результат выполнения (None для уточняющего вопроса).
+    """
+    engine, final_response = await _generate(engine, req, routing)
+    if final_response.metadata.get("requires_clarification", False):
+        return engine, final_response, None
+    
+    sql_query = final_response.metadata.get("sql_query", final_response.content)
+    
+    if not sql_query:
+        raise HTTPException(status_code=400, detail="Failed to generate SQL from the query")
+    
+    print("Generated SQL:", sql_query)
+    
+    if ENUM_PREDICATE_REWRITE:
+        # ILIKE по столбцам с закрытым доменом -> точные предикаты, использующие индексы
+        with timed("rewrite"):
+            rewritten = rewrite_enum_predicates(sql_query)
+        if rewritten != sql_query:
+            print("Rewritten SQL:", rewritten)
+            final_response.metadata["sql_query_original"] = sql_query
+            final_response.metadata["sql_query"] = sql_query = rewritten
+    
+    # SQL, которым банк примеров учится отвечать на вопрос: без изменений, сделанных только для выполнения
+    learned_sql: Optional[str] = sql_query
+    
+    if GRAPH_SQL_BUCKETING and final_response.output_format == "graph":
+        # Ряд за длинный диапазон группируется крупнее, чтобы точек было не больше GRAPH_MAX_POINTS
+        coarsened, bucket = coarsen_time_buckets(sql_query, GRAPH_MAX_POINTS)
+        if bucket is not None:
+            print(f"Coarsened graph buckets to '{bucket}':", coarsened)
+            final_response.metadata.setdefault("sql_query_original", sql_query)
+            final_response.metadata["sql_query"] = sql_query = coarsened
+            final_response.metadata["graph_bucket"] = bucket
+    
+    # Ошибки компиляции исправляются до выполнения, а не обнаруживаются им
     try:
-        final_response: FinalResponse = await engine.process_user_request(req)
-        
-        if final_response.metadata.get("requires_clarification", False):
-            return JSONResponse(content={
-                "content": final_response.content,
-                "output_format": final_response.output_format,
-                "data": None,
-                "row_count": 0,
-                "execution_time_ms": 0,
-                "metadata": final_response.metadata
-            })
-        
-        sql_query = final_response.metadata.get("sql_query", final_response.content)
-        
-        if not sql_query:
-            raise HTTPException(status_code=400, detail="Failed to generate SQL from the query")
-        
-        print("Generated SQL:", sql_query)
-        
-        execution_result = await execute_sql_query(sql_query, query)
-        
-        processed_data = execution_result.data
-        text_content = final_response.content
-        if final_response.output_format == "text":
-            text_response = await engine.format_text_response(
-                query,
-                execution_result.data,
-                req.user_id
-            )
-            text_content = text_response
-            processed_data = [{"text": text_response}]
-        elif final_response.output_format in ["table", "graph", "diagram"]:
-            processed_data = await engine.translate_column_names(
-                execution_result.data,
-                query,
-                req.user_id
-            )
-            for row in processed_data:
-                for key, value in row.items():
-                    if isinstance(value, float):
-                        row[key] = round(value, 2)
-        
-        response_data = {
-            "content": text_content if final_response.output_format == "text" else final_response.content,
-            "output_format": final_response.output_format,
-            "data": processed_data,
-            "row_count": len(processed_data) if final_response.output_format == "text" else execution_result.row_count,
+        prepared, repairs = await prepare_sql(engine, query, sql_query)
+    except SQLCompileError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if prepared != sql_query:
+        print("Repaired SQL:", prepared)
+        final_response.metadata.setdefault("sql_query_original", sql_query)
+        final_response.metadata["sql_query"] = sql_query = prepared
+        final_response.metadata["sql_repairs"] = repairs
+        # Исправленный SQL укрупненного ряда отличается от исходного вопроса единицей группировки
+        learned_sql = prepared if "graph_bucket" not in final_response.metadata else None
+    
+    execution_result = _shape_graph(final_response, await _execute(req, query, final_response, sql_query))
+    approximate = final_response.metadata.get("approximate", {}).get("applied", False)
+    if execution_result.row_count > 0 and learned_sql and not approximate:
+        # Выполненный запрос с данными пополняет банк примеров few-shot
+        bank = get_example_bank()
+        if bank is not None:
+            bank.learn(query, engine._detect_language(query), learned_sql, final_response.output_format)
+    return engine, final_response, execution_result
+
+
+async def _execute(req: UserQuery, query: str, final_response: FinalResponse, sql_query: str) -> ExecutionResult:
+    """
+    Выполнение SQL. В быстром режиме (req.fast_mode) запрос выполняется по стратифицированной
+    выборке: агрегаты масштабируются, границы ошибки и upgrade_id для точного ответа
+    записываются в metadata.approximate. Если запрос по выборке не оценивается или выборка
+    не построена, выполняется точный запрос с причиной в metadata.approximate.reason.
+    """
+    if not req.fast_mode:
+        return await execute_sql_query(sql_query, query)
+    
+    # Копия для точного ответа сохраняется до добавления метаданных приближения
+    exact_response = final_response.model_copy(deep=True)
+    try:
+        if not FAST_MODE:
+            raise ApproximationUnavailable("fast mode is disabled on this server")
+        sample = plan_sample_query(sql_query)
+        info = await asyncio.to_thread(get_sample_info)
+        if info is None:
+            raise ApproximationUnavailable("sample table is not built")
+        sample_result = await execute_sql_query(sample.sql, query)
+    except SecurityException:
+        raise
+    except Exception as e:
+        print(f"Fast mode unavailable, running exact query: {e}")
+        fast_mode_stats["fallback"] += 1
+        final_response.metadata["approximate"] = {"applied": False, "reason": str(e)}
+        return await execute_sql_query(sql_query, query)
+    
+    execution_result, bounds = estimate_result(sample, sample_result)
+    fast_mode_stats["approximate"] += 1
+    final_response.metadata["approximate"] = {
+        "applied": True,
+        "sql_query": sample.sql,
+        "sample_rate": info.sample_rate,
+        "sample_rows": info.sample_rows,
+        "sample_built_at": info.built_at,
+        **bounds,
+        "upgrade_id": pending_upgrades.put((req.model_copy(), query, exact_response)),
+    }
+    return execution_result
+
+
+def _shape_graph(final_response: FinalResponse, execution_result: ExecutionResult) -> ExecutionResult:
+    """
+    Прореживание ряда графика до GRAPH_MAX_POINTS точек с сохранением формы (LTTB):
+    размер ответа не зависит от длины диапазона. Границы ошибки быстрого режима прореживаются вместе с рядом.
+    """
+    if final_response.output_format != "graph":
+        return execution_result
+    with timed("downsampling"):
+        downsampled = downsample_graph(execution_result.data, GRAPH_MAX_POINTS)
+    if downsampled is None:
+        return execution_result
+    kept, info = downsampled
+    print(f"Downsampled graph from {info['source_points']} to {info['points']} points")
+    final_response.metadata["graph_downsampling"] = info
+    approximate = final_response.metadata.get("approximate")
+    if approximate and approximate.get("applied"):
+        approximate["margins"] = {column: [margins[i] for i in kept] for column, margins in approximate["margins"].items()}
+    data = [execution_result.data[i] for i in kept]
+    return execution_result.model_copy(update={"data": data, "row_count": len(data)})
+
+
+def _rename_metadata_columns(final_response: FinalResponse, renamed: Dict[str, str]):
+    """Имена столбцов в метаданных (границы ошибки, оси прореживания) - как в переведенных данных"""
+    approximate = final_response.metadata.get("approximate")
+    if approximate and approximate.get("margins"):
+        approximate["margins"] = {renamed.get(column, column): margins for column, margins in approximate["margins"].items()}
+    downsampling = final_response.metadata.get("graph_downsampling")
+    if downsampling:
+        downsampling["x"] = renamed.get(downsampling["x"], downsampling["x"])
+        downsampling["y"] = [renamed.get(column, column) for column in downsampling["y"]]
+
+
+async def _process_data(
+    engine, req: UserQuery, query: str, final_response: FinalResponse, execution_result: ExecutionResult
+) -> List[Dict[str, Any]]:
+    """Перевод столбцов и округление для табличных форматов"""
+    with timed("translation"):
+        processed_data = await engine.translate_column_names(
+            execution_result.data,
+            query,
+            req.user_id
+        )
+    if execution_result.data and processed_data:
+        original, translated = list(execution_result.data[0]), list(processed_data[0])
+        # Перевод сохраняет порядок столбцов; при совпадении переводов соответствие не восстанавливается
+        if len(original) == len(translated):
+            _rename_metadata_columns(final_response, dict(zip(original, translated)))
+    for row in processed_data:
+        for key, value in row.items():
+            if isinstance(value, float):
+                row[key] = round(value, 2)
+    return processed_data
+
+
+def _render_locally(engine, query: str, execution_result: ExecutionResult) -> Optional[str]:
+    """Шаблонный текстовый ответ для простых результатов (None - нужен LLM)"""
+    if not LOCAL_TEXT_RENDERING:
+        return None
+    return render_text(execution_result.data, engine._detect_language(query))
+
+
+def _response_data(
+    final_response: FinalResponse,
+    execution_result: ExecutionResult,
+    processed_data: List[Dict[str, Any]],
+    text_content: Optional[str],
+    text_renderer: Optional[str],
+    page_size: int = 0
+) -> Dict[str, Any]:
+    is_text = final_response.output_format == "text"
+    row_count = len(processed_data) if is_text else execution_result.row_count
+    cursor = None
+    page_size = min(page_size, RESULT_CURSOR_MAX_PAGE_SIZE)
+    if page_size and final_response.output_format in ("table", "diagram") and len(processed_data) > page_size:
+        # Первая страница в ответе, весь результат - на сервере за курсором
+        cursor = {
+            "token": result_cursors.put(processed_data, page_size),
+            "page_size": page_size,
+            "total_rows": len(processed_data),
+            "ttl_seconds": RESULT_CURSOR_TTL_SECONDS,
+        }
+        processed_data = processed_data[:page_size]
+    return {
+        "content": text_content if is_text else final_response.content,
+        "output_format": final_response.output_format,
+        "data": processed_data,
+        "row_count": row_count,
+        "execution_time_ms": execution_result.execution_time_ms,
+        "metadata": {
+            **final_response.metadata,
+            **shape_metadata(final_response.metadata.get("sql_query", final_response.content)),
             "execution_time_ms": execution_result.execution_time_ms,
-            "metadata": {
-                **final_response.metadata,
-                "execution_time_ms": execution_result.execution_time_ms,
-                "row_count": len(processed_data) if final_response.output_format == "text" else execution_result.row_count
-            }
+            "row_count": row_count,
+            "text_renderer": text_renderer,
+            "cursor": cursor,
+            "prompt_tokens": get_prompt_report(),
+            "timings": get_timings()
         }
+    }
+
+
+async def _build_response(
+    engine, req: UserQuery, query: str, final_response: FinalResponse, execution_result: ExecutionResult
+) -> Dict[str, Any]:
+    """Ответ /process-text по результату выполнения: текст (шаблоном или LLM) или обработанные данные"""
+    processed_data = execution_result.data
+    text_content = final_response.content
+    text_renderer = None
+    if final_response.output_format == "text":
+        # Простые результаты оформляем шаблоном, сложные - через LLM
+        with timed("narration"):
+            text_response = _render_locally(engine, query, execution_result)
+            if text_response is not None:
+                text_renderer = "local"
+            else:
+                text_response = await engine.format_text_response(
+                    query,
+                    execution_result.data,
+                    req.user_id
+                )
+                text_renderer = "llm"
+        text_content = text_response
+        processed_data = [{"text": text_response}]
+    elif final_response.output_format in ["table", "graph", "diagram"]:
+        processed_data = await _process_data(engine, req, query, final_response, execution_result)
+    
+    return _response_data(
+        final_response, execution_result, processed_data, text_content, text_renderer, req.page_size or RESULT_PAGE_SIZE
+    )
+
+
+@app.post("/process-text")
+async def process_text_stream(req: UserQuery):
+    """Обработка запроса с использованием production контракта и поддержкой контекста"""
+    engine, query, routing = _get_request_engine(req)
+    started = _start_request()
+    output_format = ""
+    status = "error"
+
+    try:
+        engine, final_response, execution_result = await _generate_and_execute(engine, req, query, routing)
+        output_format = final_response.output_format
+        if execution_result is None:
+            status = "clarification"
+            return JSONResponse(content=_clarification_data(final_response))
         
-        return JSONResponse(content=response_data)
+        response_data = await _build_response(engine, req, query, final_response, execution_result)
+        with timed("serialization"):
+            response = JSONResponse(content=response_data)
+        status = "ok"
+        return response
         
+    except HTTPException as e:
+        status = str(e.status_code)
+        raise
+    except SecurityException as e:
+        status = "403"
+        raise HTTPException(status_code=403, detail=str(e))
+    except Exception as e:
+        print(f"Error processing request: {e}")
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    finally:
+        _observe(req, engine, output_format, status, started)
+
+
+def _sse(event: str, payload: Dict[str, Any]) -> str:
+    """Одно событие в формате server-sent events"""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.post("/process-text/stream")
+async def process_text_sse(req: UserQuery):
+    """
+    Потоковая версия /process-text (text/event-stream).
+    
+    События: meta - формат и SQL до начала генерации текста, delta - фрагмент
+    текстового ответа, done - итоговый ответ в формате /process-text, error - ошибка
+    после начала потока. Ошибки до начала потока возвращаются обычными HTTP статусами.
+    """
+    engine, query, routing = _get_request_engine(req)
+    started = _start_request()
+
+    try:
+        engine, final_response, execution_result = await _generate_and_execute(engine, req, query, routing)
+    except HTTPException as e:
+        _observe(req, engine, "", str(e.status_code), started)
+        raise
     except SecurityException as e:
+        _observe(req, engine, "", "403", started)
         raise HTTPException(status_code=403, detail=str(e))
     except Exception as e:
         print(f"Error processing request: {e}")
+        _observe(req, engine, "", "error", started)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    
+    async def events():
+        if execution_result is None:
+            yield _sse("done", _clarification_data(final_response))
+            _observe(req, engine, final_response.output_format, "clarification", started)
+            return
+        
+        yield _sse("meta", {
+            "output_format": final_response.output_format,
+            "sql_query": final_response.metadata.get("sql_query"),
+            "sql_fingerprint": execution_result.sql_fingerprint,
+            "row_count": execution_result.row_count,
+            "execution_time_ms": execution_result.execution_time_ms,
+            "approximate": final_response.metadata.get("approximate", {}).get("applied", False)
+        })
+        try:
+            processed_data = execution_result.data
+            text_content = final_response.content
+            text_renderer = None
+            if final_response.output_format == "text":
+                narration_started = time.perf_counter()
+                text_content = _render_locally(engine, query, execution_result)
+                if text_content is not None:
+                    text_renderer = "local"
+                    yield _sse("delta", {"text": text_content})
+                else:
+                    text_renderer = "llm"
+                    chunks = []
+                    async for chunk in engine.stream_text_response(query, execution_result.data, req.user_id):
+                        if not chunks:
+                            record_timing("narration_first_chunk", (time.perf_counter() - narration_started) * 1000)
+                        chunks.append(chunk)
+                        yield _sse("delta", {"text": chunk})
+                    text_content = "".join(chunks).strip()
+                record_timing("narration", (time.perf_counter() - narration_started) * 1000)
+                processed_data = [{"text": text_content}]
+            elif final_response.output_format in ["table", "graph", "diagram"]:
+                processed_data = await _process_data(engine, req, query, final_response, execution_result)
+            
+            yield _sse("done", _response_data(
+                final_response, execution_result, processed_data, text_content, text_renderer,
+                req.page_size or RESULT_PAGE_SIZE
+            ))
+            _observe(req, engine, final_response.output_format, "ok", started)
+        except Exception as e:
+            print(f"Error streaming response: {e}")
+            yield _sse("error", {"detail": f"Internal server error: {str(e)}"})
+            _observe(req, engine, final_response.output_format, "error", started)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/process-text/exact/{upgrade_id}")
+async def process_text_exact(upgrade_id: str):
+    """
+    Точный ответ на запрос, отвеченный в быстром режиме: SQL выполняется по всей таблице
+    без повторной генерации (upgrade_id из metadata.approximate, действует FAST_MODE_UPGRADE_TTL_SECONDS)
+    """
+    pending = pending_upgrades.get(upgrade_id)
+    if pending is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired upgrade_id")
+    req, query, final_response = pending
+    final_response = final_response.model_copy(deep=True)
+    final_response.metadata["approximate"] = {"applied": False, "upgrade_of": upgrade_id}
+    engine = get_engine(req.model)
+    started = _start_request()
+    status = "error"
+    
+    try:
+        execution_result = _shape_graph(final_response, await execute_sql_query(final_response.metadata["sql_query"], query))
+        fast_mode_stats["upgraded"] += 1
+        response_data = await _build_response(engine, req, query, final_response, execution_result)
+        with timed("serialization"):
+            response = JSONResponse(content=response_data)
+        status = "ok"
+        return response
+    except SecurityException as e:
+        status = "403"
+        raise HTTPException(status_code=403, detail=str(e))
+    except Exception as e:
+        print(f"Error processing exact upgrade: {e}")
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    finally:
+        _observe(req, engine, final_response.output_format, status, started)
+
+
+@app.get("/results/{cursor}")
+async def result_page(
+    cursor: str,
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    sort: Optional[str] = None,
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+):
+    """
+    Страница сохраненного табличного результата (курсор из metadata.cursor ответа /process-text):
+    без повторной генерации и выполнения SQL, с сортировкой по любому столбцу результата.
+    Без limit размер страницы - как у первой страницы ответа (не больше RESULT_CURSOR_MAX_PAGE_SIZE)
+    """
+    try:
+        page = result_cursors.page(cursor, offset, limit, sort, order == "desc")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if page is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired cursor")
+    rows, total_rows, limit = page
+    next_offset = offset + len(rows)
+    return JSONResponse(content={
+        "data": rows,
+        "offset": offset,
+        "limit": limit,
+        "total_rows": total_rows,
+        "sort": sort,
+        "order": order,
+        "next_offset": next_offset if next_offset < total_rows else None,
+    })
+
 
 class ClearHistoryRequest(BaseModel):
     user_id: str
@@ -110,9 +705,9 @@ class ClearHistoryRequest(BaseModel):
 async def clear_history(req: ClearHistoryRequest):
     """Очистка истории диалога для пользователя"""
     try:
-        # Очищаем историю в обоих движках
-        api_engine._clear_history(req.user_id)
-        #llm_engine._clear_history(req.user_id)
+        # Очищаем историю во всех включенных движках
+        for name in ENABLED_ENGINES:
+            get_engine(name)._clear_history(req.user_id)
         return JSONResponse(content={"message": f"History cleared for user {req.user_id}"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error clearing history: {str(e)}")
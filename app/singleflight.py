@@ -0,0 +1,64 @@
+import asyncio
+import copy
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Dict, TypeVar
+
+T = TypeVar("T")
+
+
+def make_key(*parts: Any) -> str:
+    """Стабильный ключ из произвольных JSON-совместимых частей"""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def normalize_question(text: str) -> str:
+    """Нормализация вопроса для коалесинга: регистр, пробелы, завершающая пунктуация"""
+    return " ".join(text.lower().split()).rstrip("?!. ")
+
+
+class SingleFlight:
+    """
+    Коалесинг одинаковых параллельных вычислений (single-flight).
+
+    Пока вычисление по ключу выполняется, повторные вызовы с тем же ключом не запускают
+    его заново, а ждут результат первого. Каждый вызывающий получает собственную
+    глубокую копию результата, поэтому последующие мутации не влияют на других.
+    Исключение лидера пробрасывается всем ожидающим.
+    """
+
+    def __init__(self, name: str = "default"):
+        self.name = name
+        self._calls: Dict[str, asyncio.Future] = {}
+        # Количество вызовов, получивших результат чужого вычисления
+        self.coalesced = 0
+
+    def in_flight(self) -> int:
+        """Количество выполняющихся сейчас вычислений"""
+        return len(self._calls)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            result = await asyncio.shield(future)
+            return copy.deepcopy(result)
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Помечаем исключение как полученное, даже если ожидающих не было
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            self._calls.pop(key, None)
+        return copy.deepcopy(result)
@@ -0,0 +1,250 @@
+import hashlib
+import re
+from functools import lru_cache
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from app.sql_lexer import NUMBER, PUNCT, QUOTED_IDENT, STRING, WORD, Token, tokenize
+
+# Ключевые слова SQL (в каноническом виде пишутся заглавными, остальные слова - строчными)
+KEYWORDS = {
+    "ALL", "AND", "ANY", "AS", "ASC", "BETWEEN", "BY", "CASE", "CAST", "CROSS", "CURRENT_DATE",
+    "CURRENT_TIMESTAMP", "DATE", "DESC", "DISTINCT", "ELSE", "END", "EXCEPT", "EXISTS", "FALSE",
+    "FETCH", "FILTER", "FIRST", "FOLLOWING", "FOR", "FROM", "FULL", "GROUP", "HAVING", "ILIKE",
+    "IN", "INNER", "INTERSECT", "INTERVAL", "IS", "JOIN", "LAST", "LATERAL", "LEFT", "LIKE",
+    "LIMIT", "NATURAL", "NOT", "NULL", "NULLS", "OFFSET", "ON", "OR", "ORDER", "OUTER", "OVER",
+    "PARTITION", "PRECEDING", "RANGE", "RECURSIVE", "RIGHT", "ROW", "ROWS", "SELECT", "SIMILAR",
+    "THEN", "TIME", "TIMESTAMP", "TIMESTAMPTZ", "TRUE", "UNBOUNDED", "UNION", "USING", "VALUES",
+    "WHEN", "WHERE", "WINDOW", "WITH", "WITHIN",
+}
+# Типизированные литералы (DATE '2024-01-01'): строка остается частью синтаксиса, а не параметром
+TYPED_LITERAL_KEYWORDS = {"DATE", "TIME", "TIMESTAMP", "TIMESTAMPTZ", "INTERVAL"}
+# Предложения, завершающие список GROUP BY / ORDER BY
+CLAUSE_KEYWORDS = {"FROM", "WHERE", "GROUP", "HAVING", "ORDER", "LIMIT", "OFFSET", "UNION", "EXCEPT", "INTERSECT", "WINDOW", "FETCH"}
+
+PARAM = "param"
+PLACEHOLDER = "?"
+_IN_LIST_RE = re.compile(r"IN \(\?(?:, \?)*\)")
+
+
+class SQLShape(NamedTuple):
+    """Каноническое представление SQL запроса"""
+    canonical: str          # SQL без комментариев, с единым форматированием и отсортированными IN-списками
+    parameterized: str      # канонический SQL с литералами, вынесенными в типизированные параметры $1..$n
+    params: Tuple[Any, ...] # значения параметров в порядке $1..$n
+    fingerprint: str        # хэш формы запроса без литералов (IN-списки любой длины совпадают)
+
+
+def _is_literal(token: Token) -> bool:
+    return token.kind == NUMBER or (token.kind == STRING and token.value.startswith("'"))
+
+
+def _literal_value(token: Token) -> Any:
+    if token.kind == NUMBER:
+        if any(char in token.value for char in ".eE"):
+            return float(token.value)
+        return int(token.value)
+    return token.value[1:-1].replace("''", "'")
+
+
+def _placeholder(number: int, value: Any) -> str:
+    """
+    Параметр с типом исходного литерала: целые - integer/bigint, дробные - numeric,
+    строки без приведения (unknown), как и литералы в исходном запросе.
+    """
+    if isinstance(value, int):
+        if -2**31 <= value < 2**31:
+            return f"${number}::integer"
+        if -2**63 <= value < 2**63:
+            return f"${number}::bigint"
+        return f"${number}::numeric"
+    if isinstance(value, float):
+        return f"${number}::numeric"
+    return f"${number}"
+
+
+def _normalize_aliases(tokens: List[Token]) -> List[Token]:
+    """Единые имена псевдонимов таблиц (FROM transactions tx -> FROM transactions AS t1)"""
+    aliases: Dict[str, str] = {}
+    # Позиции псевдонимов, объявленных без AS
+    missing_as = set()
+    for index, token in enumerate(tokens):
+        if token.kind != WORD or token.value not in ("FROM", "JOIN"):
+            continue
+        table = index + 1
+        if table >= len(tokens) or tokens[table].kind != WORD or tokens[table].value in KEYWORDS:
+            continue
+        # schema.table
+        while table + 2 < len(tokens) and tokens[table + 1].value == "." and tokens[table + 2].kind == WORD:
+            table += 2
+        alias = table + 1
+        if alias < len(tokens) and tokens[alias].kind == WORD and tokens[alias].value == "AS":
+            alias += 1
+        if alias < len(tokens) and tokens[alias].kind == WORD and tokens[alias].value not in KEYWORDS:
+            aliases.setdefault(tokens[alias].value, f"T{len(aliases) + 1}")
+            if alias == table + 1:
+                missing_as.add(alias)
+    if not aliases:
+        return tokens
+
+    renamed: List[Token] = []
+    for index, token in enumerate(tokens):
+        if index in missing_as:
+            renamed.append(Token(WORD, "AS", -1))
+        renamed.append(token)
+        if token.kind != WORD or token.value not in aliases:
+            continue
+        is_reference = index + 1 < len(tokens) and tokens[index + 1].value == "."
+        previous = tokens[index - 1] if index > 0 else None
+        is_definition = previous is not None and (
+            previous.value == "AS" or (previous.kind == WORD and previous.value not in KEYWORDS)
+        )
+        if is_reference or is_definition:
+            renamed[-1] = token._replace(value=aliases[token.value])
+    return renamed
+
+
+def _sort_in_lists(tokens: List[Token]) -> List[Token]:
+    """Сортировка списков литералов в IN (...) - порядок значений не влияет на результат"""
+    result: List[Token] = []
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        result.append(token)
+        index += 1
+        if not (token.kind == WORD and token.value == "IN" and index < len(tokens) and tokens[index].value == "("):
+            continue
+        literals: List[Token] = []
+        cursor = index + 1
+        while cursor < len(tokens) and _is_literal(tokens[cursor]):
+            literals.append(tokens[cursor])
+            cursor += 1
+            if cursor < len(tokens) and tokens[cursor].value == ",":
+                cursor += 1
+                continue
+            break
+        if literals and cursor < len(tokens) and tokens[cursor].value == ")":
+            literals.sort(key=lambda literal: (literal.kind, literal.value))
+            separated: List[Token] = [tokens[index]]
+            for position, literal in enumerate(literals):
+                if position:
+                    separated.append(Token(PUNCT, ",", -1))
+                separated.append(literal)
+            separated.append(tokens[cursor])
+            result.extend(separated)
+            index = cursor + 1
+    return result
+
+
+def _render(tokens: List[Token]) -> str:
+    """Сборка SQL из токенов с единым форматированием"""
+    parts: List[str] = []
+    previous: Optional[Token] = None
+    for token in tokens:
+        if token.kind == WORD:
+            text = token.value if token.value in KEYWORDS else token.value.lower()
+        elif token.kind == QUOTED_IDENT:
+            text = f'"{token.value}"'
+        else:
+            text = token.value
+        if previous is not None:
+            glued = (
+                text in (",", ")", ".", ":")
+                or previous.value in ("(", ".", ":")
+                or (text == "(" and previous.kind == WORD and previous.value not in KEYWORDS)
+                # Многосимвольные операторы (>=, <>, ::, ||) не разрываются
+                or (token.kind == PUNCT and previous.kind == PUNCT and text not in "()," and previous.value not in "(),"
+                    and previous.position >= 0 and token.position == previous.position + 1)
+            )
+            if not glued:
+                parts.append(" ")
+        parts.append(text)
+        previous = token
+    return "".join(parts)
+
+
+def _parameterize(tokens: List[Token]):
+    """
+    Вынос литералов в параметры $1..$n (кроме типизированных литералов и позиций в GROUP/ORDER BY).
+    Одинаковые литералы получают один номер: иначе DATE_TRUNC($1, ...) в SELECT и DATE_TRUNC($3, ...)
+    в GROUP BY - разные выражения, и PREPARE падает с ошибкой группировки.
+    """
+    parameterized: List[Token] = []
+    shape: List[Token] = []
+    params: List[Any] = []
+    numbers: Dict[Tuple[str, str], int] = {}
+    in_position_list = False
+    for index, token in enumerate(tokens):
+        previous = tokens[index - 1] if index > 0 else None
+        if token.kind == WORD and token.value == "BY" and previous is not None and previous.value in ("GROUP", "ORDER"):
+            in_position_list = True
+        elif token.kind == WORD and token.value in CLAUSE_KEYWORDS:
+            in_position_list = False
+
+        if not _is_literal(token):
+            parameterized.append(token)
+            # Типизированные и экранированные строки в форме запроса тоже обезличиваются
+            shape.append(token._replace(value=PLACEHOLDER) if token.kind == STRING else token)
+            continue
+
+        is_typed = previous is not None and previous.kind == WORD and previous.value in TYPED_LITERAL_KEYWORDS
+        is_position = (
+            in_position_list and token.kind == NUMBER and previous is not None and previous.value in ("BY", ",")
+        )
+        if is_position:
+            parameterized.append(token)
+            shape.append(token)
+        elif is_typed:
+            parameterized.append(token)
+            shape.append(token._replace(value=PLACEHOLDER))
+        else:
+            key = (token.kind, token.value)
+            if key not in numbers:
+                params.append(_literal_value(token))
+                numbers[key] = len(params)
+            number = numbers[key]
+            parameterized.append(Token(PARAM, _placeholder(number, params[number - 1]), token.position))
+            shape.append(Token(PARAM, PLACEHOLDER, token.position))
+    return parameterized, shape, params
+
+
+def _collapse_in_lists(text: str) -> str:
+    """IN (?, ?, ?) -> IN (?): форма не зависит от длины списка"""
+    return _IN_LIST_RE.sub("IN (?)", text)
+
+
+@lru_cache(maxsize=2048)
+def analyze_sql(sql: str) -> SQLShape:
+    """
+    Каноникализация SQL: комментарии и завершающие ';' удаляются, пробелы и регистр
+    ключевых слов приводятся к единому виду, псевдонимы таблиц переименовываются,
+    IN-списки литералов сортируются. Для запроса строятся параметризованная форма
+    и отпечаток формы (одинаковый для запросов, отличающихся только литералами).
+    """
+    tokens = [token for token in tokenize(sql) if token.value != ";"]
+    tokens = _sort_in_lists(_normalize_aliases(tokens))
+    parameterized, shape, params = _parameterize(tokens)
+    shape_text = _collapse_in_lists(_render(shape))
+    return SQLShape(
+        canonical=_render(tokens),
+        parameterized=_render(parameterized),
+        params=tuple(params),
+        fingerprint=hashlib.sha256(shape_text.encode("utf-8")).hexdigest()[:16]
+    )
+
+
+def canonicalize_sql(sql: str) -> str:
+    return analyze_sql(sql).canonical
+
+
+def fingerprint_sql(sql: str) -> str:
+    return analyze_sql(sql).fingerprint
+
+
+def shape_metadata(sql: str) -> Dict[str, Any]:
+    """Поля формы запроса для metadata ответа"""
+    shape = analyze_sql(sql)
+    return {
+        "sql_canonical": shape.canonical,
+        "sql_fingerprint": shape.fingerprint,
+        "sql_params": list(shape.params),
+    }
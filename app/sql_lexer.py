@@ -0,0 +1,184 @@
+import re
+from typing import List, NamedTuple
+
+# Виды токенов
+WORD = "word"              # ключевое слово или идентификатор (в верхнем регистре)
+QUOTED_IDENT = "quoted"    # "идентификатор в кавычках"
+STRING = "string"          # строковый литерал (содержимое не анализируется)
+NUMBER = "number"
+SEMICOLON = ";"
+PUNCT = "punct"            # операторы и прочие символы
+ERROR = "error"            # незакрытая строка, идентификатор или комментарий
+
+_SPACE_RE = re.compile(r"\s+")
+_WORD_RE = re.compile(r"[A-Za-z_\u0080-\uffff][A-Za-z0-9_$\u0080-\uffff]*")
+_NUMBER_RE = re.compile(r"\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?")
+_DOLLAR_TAG_RE = re.compile(r"\$(?:[A-Za-z_][A-Za-z0-9_]*)?\$")
+
+
+class Token(NamedTuple):
+    kind: str
+    value: str
+    position: int
+
+
+def _scan_quoted(sql: str, start: int, quote: str) -> int:
+    """Конец литерала в кавычках (удвоенная кавычка - экранирование), -1 если не закрыт"""
+    position = start + 1
+    length = len(sql)
+    while True:
+        quote_at = sql.find(quote, position)
+        if quote_at == -1:
+            return -1
+        if quote_at + 1 < length and sql[quote_at + 1] == quote:
+            position = quote_at + 2
+            continue
+        return quote_at + 1
+
+
+def _scan_escape_string(sql: str, start: int) -> int:
+    """Конец строки E'...' (экранирование обратной косой чертой или удвоенной кавычкой), -1 если не закрыта"""
+    position = start + 1
+    length = len(sql)
+    while position < length:
+        char = sql[position]
+        if char == "\\":
+            position += 2
+        elif char == "'":
+            if position + 1 < length and sql[position + 1] == "'":
+                position += 2
+            else:
+                return position + 1
+        else:
+            position += 1
+    return -1
+
+
+def _scan_block_comment(sql: str, start: int) -> int:
+    """Конец блочного комментария (в PostgreSQL они вложенные), -1 если не закрыт"""
+    depth = 0
+    position = start
+    # Позиции ближайших открытия и закрытия пересчитываются, только когда пройдены
+    opening = sql.find("/*", position)
+    closing = sql.find("*/", position)
+    while closing != -1:
+        if opening != -1 and opening < closing:
+            depth += 1
+            position = opening + 2
+            opening = sql.find("/*", position)
+        else:
+            depth -= 1
+            position = closing + 2
+            if depth == 0:
+                return position
+            if opening != -1 and opening < position:
+                opening = sql.find("/*", position)
+        closing = sql.find("*/", position) if closing < position else closing
+    return -1
+
+
+def tokenize(sql: str) -> List[Token]:
+    """
+    Однопроходный лексер SQL (диалект PostgreSQL).
+
+    Комментарии пропускаются, содержимое строковых литералов и идентификаторов в кавычках
+    не разбирается, поэтому ключевые слова внутри них не влияют на проверки.
+    Работает за линейное время: каждый символ просматривается не более одного раза.
+    """
+    tokens: List[Token] = []
+    position = 0
+    length = len(sql)
+    while position < length:
+        char = sql[position]
+        if char.isspace():
+            position = _SPACE_RE.match(sql, position).end()
+            continue
+
+        if char == "-" and sql.startswith("--", position):
+            newline = sql.find("\n", position)
+            position = length if newline == -1 else newline + 1
+            continue
+
+        if char == "/" and sql.startswith("/*", position):
+            end = _scan_block_comment(sql, position)
+            if end == -1:
+                tokens.append(Token(ERROR, "/*", position))
+                break
+            position = end
+            continue
+
+        if char in "eE" and position + 1 < length and sql[position + 1] == "'":
+            end = _scan_escape_string(sql, position + 1)
+            if end == -1:
+                tokens.append(Token(ERROR, "'", position))
+                break
+            tokens.append(Token(STRING, sql[position:end], position))
+            position = end
+            continue
+
+        if char == "'":
+            end = _scan_quoted(sql, position, "'")
+            if end == -1:
+                tokens.append(Token(ERROR, "'", position))
+                break
+            tokens.append(Token(STRING, sql[position:end], position))
+            position = end
+            continue
+
+        if char == '"':
+            end = _scan_quoted(sql, position, '"')
+            if end == -1:
+                tokens.append(Token(ERROR, '"', position))
+                break
+            tokens.append(Token(QUOTED_IDENT, sql[position + 1:end - 1], position))
+            position = end
+            continue
+
+        if char == "$":
+            tag = _DOLLAR_TAG_RE.match(sql, position)
+            if tag:
+                end = sql.find(tag.group(), tag.end())
+                if end == -1:
+                    tokens.append(Token(ERROR, tag.group(), position))
+                    break
+                end += len(tag.group())
+                tokens.append(Token(STRING, sql[position:end], position))
+                position = end
+                continue
+
+        if char == ";":
+            tokens.append(Token(SEMICOLON, ";", position))
+            position += 1
+            continue
+
+        match = _WORD_RE.match(sql, position)
+        if match:
+            tokens.append(Token(WORD, match.group().upper(), position))
+            position = match.end()
+            continue
+
+        match = _NUMBER_RE.match(sql, position)
+        if match:
+            tokens.append(Token(NUMBER, match.group(), position))
+            position = match.end()
+            continue
+
+        tokens.append(Token(PUNCT, char, position))
+        position += 1
+    return tokens
+
+
+def split_statements(tokens: List[Token]) -> List[List[Token]]:
+    """Разбиение токенов на выражения по ';' (пустые выражения отбрасываются)"""
+    statements: List[List[Token]] = []
+    current: List[Token] = []
+    for token in tokens:
+        if token.kind == SEMICOLON:
+            if current:
+                statements.append(current)
+            current = []
+        else:
+            current.append(token)
+    if current:
+        statements.append(current)
+    return statements
@@ -0,0 +1,133 @@
+import asyncio
+import difflib
+import re
+from typing import List, Tuple
+
+from app.config import SQL_DRY_RUN, SQL_REPAIR_ATTEMPTS
+from app.constants import DEFAULT_LIMIT, TABLE_SCHEMA
+from app.metrics import timed
+from app.security_validator import SecurityException
+from app.sql_lexer import PUNCT, QUOTED_IDENT, SEMICOLON, WORD, tokenize
+from app.sql_rewriter import fix_enum_literal_case
+from app.sql_to_db import CompileError, compile_sql
+
+KNOWN_COLUMNS = list(TABLE_SCHEMA)
+KNOWN_TABLES = ["transactions"]
+AGGREGATE_FUNCTIONS = {"COUNT", "SUM", "AVG", "MIN", "MAX", "STRING_AGG", "ARRAY_AGG", "BOOL_AND", "BOOL_OR"}
+# Минимальная похожесть имени для автоисправления (difflib ratio)
+NAME_MATCH_CUTOFF = 0.75
+
+# column "merchnt_city" does not exist / column t.merchnt_city does not exist
+_UNKNOWN_COLUMN_RE = re.compile(r'column "?(?:\w+\.)?(\w+)"? does not exist')
+_UNKNOWN_TABLE_RE = re.compile(r'relation "?(\w+)"? does not exist')
+
+
+class SQLCompileError(Exception):
+    """Запрос не компилируется и не исправлен ни локально, ни моделью"""
+
+    def __init__(self, error: CompileError, sql_query: str):
+        super().__init__(f"SQL compile error [{error.code}]: {error.message}")
+        self.error = error
+        self.sql_query = sql_query
+
+
+def add_listing_limit(sql_query: str) -> str:
+    """
+    LIMIT DEFAULT_LIMIT для выборки сырых строк без LIMIT: без агрегатов и GROUP BY на верхнем уровне.
+    Иначе такой запрос постранично вычитывает таблицу до MAX_RESULT_ROWS.
+    """
+    tokens = [token for token in tokenize(sql_query) if token.kind != SEMICOLON]
+    if not tokens or tokens[0].kind != WORD or tokens[0].value != "SELECT":
+        return sql_query
+    depth = 0
+    for index, token in enumerate(tokens):
+        if token.kind == PUNCT and token.value == "(":
+            depth += 1
+        elif token.kind == PUNCT and token.value == ")":
+            depth -= 1
+        elif token.kind == WORD and depth == 0:
+            if token.value in ("LIMIT", "FETCH", "GROUP", "DISTINCT", "UNION", "EXCEPT", "INTERSECT"):
+                return sql_query
+            is_call = index + 1 < len(tokens) and tokens[index + 1].value == "("
+            if token.value in AGGREGATE_FUNCTIONS and is_call:
+                return sql_query
+    last = tokens[-1]
+    # Конец последнего токена: завершающие ';' и комментарии отбрасываются
+    end = last.position + len(last.value) + (2 if last.kind == QUOTED_IDENT else 0)
+    return f"{sql_query[:end]} LIMIT {DEFAULT_LIMIT}"
+
+
+def _replace_identifier(sql_query: str, name: str, replacement: str) -> str:
+    """Замена идентификатора (без кавычек, без учета регистра) во всех местах запроса"""
+    for token in reversed(tokenize(sql_query)):
+        if token.kind == WORD and token.value == name.upper():
+            sql_query = sql_query[:token.position] + replacement + sql_query[token.position + len(token.value):]
+    return sql_query
+
+
+def autocorrect(sql_query: str, error: CompileError) -> Tuple[str, List[str]]:
+    """
+    Локальное исправление по ошибке компиляции: опечатки в именах столбцов и таблицы
+    исправляются на ближайшее имя из TABLE_SCHEMA. Возвращает SQL и список исправлений.
+    """
+    for pattern, known in ((_UNKNOWN_COLUMN_RE, KNOWN_COLUMNS), (_UNKNOWN_TABLE_RE, KNOWN_TABLES)):
+        match = pattern.search(error.message)
+        if not match:
+            continue
+        name = match.group(1)
+        candidates = difflib.get_close_matches(name.lower(), known, n=1, cutoff=NAME_MATCH_CUTOFF)
+        if candidates and candidates[0] != name.lower():
+            return _replace_identifier(sql_query, name, candidates[0]), [f"{name} -> {candidates[0]}"]
+    return sql_query, []
+
+
+def normalize(sql_query: str) -> Tuple[str, List[str]]:
+    """Исправления, не требующие обращения к БД: регистр значений закрытых доменов и LIMIT выборок"""
+    notes = []
+    fixed = fix_enum_literal_case(sql_query)
+    if fixed != sql_query:
+        notes.append("enum literal case")
+    limited = add_listing_limit(fixed)
+    if limited != fixed:
+        notes.append(f"LIMIT {DEFAULT_LIMIT}")
+    return limited, notes
+
+
+async def prepare_sql(engine, query: str, sql_query: str) -> Tuple[str, List[str]]:
+    """
+    Подготовка SQL к выполнению: локальные исправления, компиляция без выполнения (EXPLAIN),
+    при ошибке - локальное автоисправление и только затем точечное исправление моделью.
+    Возвращает итоговый SQL и список примененных исправлений; SQLCompileError, если исправить не удалось.
+    """
+    sql_query, notes = normalize(sql_query)
+    if not SQL_DRY_RUN:
+        return sql_query, notes
+
+    with timed("compile"):
+        error = await asyncio.to_thread(compile_sql, sql_query)
+    if error is None:
+        return sql_query, notes
+    print(f"SQL compile error [{error.code}]: {error.message}")
+
+    fixed, fixes = autocorrect(sql_query, error)
+    if fixes:
+        with timed("compile"):
+            fixed_error = await asyncio.to_thread(compile_sql, fixed)
+        if fixed_error is None:
+            return fixed, notes + fixes
+
+    for attempt in range(SQL_REPAIR_ATTEMPTS):
+        with timed("repair"):
+            candidate = await engine.repair_sql(query, sql_query, error.message)
+        print(f"Repaired SQL (attempt {attempt + 1}): {candidate}")
+        validation = engine.security_validator.validate_sql(candidate, query)
+        if not validation.is_safe:
+            raise SecurityException(f"Repaired query violates security policy: {validation.validation_notes}")
+        candidate, candidate_notes = normalize(candidate)
+        with timed("compile"):
+            candidate_error = await asyncio.to_thread(compile_sql, candidate)
+        if candidate_error is None:
+            return candidate, notes + candidate_notes + ["llm repair"]
+        sql_query, error = candidate, candidate_error
+
+    raise SQLCompileError(error, sql_query)
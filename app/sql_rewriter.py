@@ -0,0 +1,349 @@
+import re
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, get_args
+
+from app.models import CITIES, MCC_CATEGORIES, POS_ENTRY_MODES, TRANSACTION_TYPES, WALLET_TYPES
+from app.sql_lexer import PUNCT, QUOTED_IDENT, SEMICOLON, STRING, WORD, Token, tokenize
+
+# Столбцы с закрытым множеством значений (контракт данных в app.models)
+ENUM_DOMAINS: Dict[str, Tuple[str, ...]] = {
+    "merchant_city": get_args(CITIES),
+    "mcc_category": get_args(MCC_CATEGORIES),
+    "transaction_type": get_args(TRANSACTION_TYPES),
+    "pos_entry_mode": get_args(POS_ENTRY_MODES),
+    "wallet_type": get_args(WALLET_TYPES),
+}
+
+# Единицы DATE_TRUNC от мелкой к крупной и их приблизительная длительность в секундах
+TIME_UNITS: List[Tuple[str, float]] = [
+    ("second", 1), ("minute", 60), ("hour", 3600), ("day", 86400), ("week", 7 * 86400),
+    ("month", 30.44 * 86400), ("quarter", 91.31 * 86400), ("year", 365.25 * 86400),
+]
+# Ключевые слова типизированных литералов времени (DATE '2024-01-01')
+TIME_LITERAL_KEYWORDS = {"DATE", "TIMESTAMP", "TIMESTAMPTZ"}
+# Предложения верхнего уровня, в которых DATE_TRUNC задает группировку ряда
+BUCKET_CLAUSES = {"SELECT", "GROUP", "ORDER"}
+TOP_LEVEL_CLAUSES = {"SELECT", "FROM", "WHERE", "GROUP", "HAVING", "ORDER", "LIMIT", "OFFSET"}
+# Ключевые слова, которыми может закончиться шаблон LIKE: после литерала нет продолжения выражения
+PATTERN_END_KEYWORDS = {
+    "AND", "OR", "THEN", "WHEN", "ELSE", "END", "GROUP", "ORDER", "HAVING", "LIMIT", "OFFSET",
+    "UNION", "INTERSECT", "EXCEPT", "WINDOW", "FETCH",
+}
+
+
+def like_to_regex(pattern: str, case_insensitive: bool) -> "re.Pattern":
+    """Шаблон LIKE/ILIKE в регулярное выражение: % - любая строка, _ - один символ, \\ - экранирование"""
+    parts: List[str] = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == "\\" and index + 1 < len(pattern):
+            parts.append(re.escape(pattern[index + 1]))
+            index += 2
+            continue
+        if char == "%":
+            parts.append(".*")
+        elif char == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(char))
+        index += 1
+    return re.compile("".join(parts), re.DOTALL | (re.IGNORECASE if case_insensitive else 0))
+
+
+def resolve_pattern(column: str, pattern: str, case_insensitive: bool = True) -> List[str]:
+    """Значения домена столбца, подходящие под шаблон (в порядке домена)"""
+    regex = like_to_regex(pattern, case_insensitive)
+    return [value for value in ENUM_DOMAINS[column] if regex.fullmatch(value)]
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _column_name(token: Token) -> Optional[str]:
+    if token.kind == WORD and token.value.lower() in ENUM_DOMAINS:
+        return token.value.lower()
+    if token.kind == QUOTED_IDENT and token.value in ENUM_DOMAINS:
+        return token.value
+    return None
+
+
+def _predicate(column_sql: str, values: List[str], negated: bool) -> str:
+    if len(values) == 1:
+        return f"{column_sql} {'<>' if negated else '='} {_quote(values[0])}"
+    operator = "NOT IN" if negated else "IN"
+    return f"{column_sql} {operator} ({', '.join(_quote(value) for value in values)})"
+
+
+def _ends_predicate(tokens: List[Token], index: int) -> bool:
+    """Токен с позиции index завершает предикат: конец запроса, ')', ',', ';' или ключевое слово"""
+    if index >= len(tokens):
+        return True
+    token = tokens[index]
+    if token.kind == SEMICOLON or (token.kind == PUNCT and token.value in (")", ",")):
+        return True
+    return token.kind == WORD and token.value in PATTERN_END_KEYWORDS
+
+
+def rewrite_enum_predicates(sql: str) -> str:
+    """
+    Замена LIKE/ILIKE по столбцам с закрытым доменом на точные предикаты.
+
+    merchant_city ILIKE 'almaty'       -> merchant_city = 'Almaty'
+    mcc_category ILIKE '%food%'        -> mcc_category = 'Grocery & Food Markets'
+    mcc_category ILIKE '%service%'     -> mcc_category IN ('Fuel & Service Stations', 'Services (Other)')
+    wallet_type NOT ILIKE '%pay'       -> wallet_type NOT IN (...)
+
+    Такие предикаты используют btree индексы. Шаблоны без совпадений в домене,
+    шаблоны с ESCAPE, не-литеральные шаблоны и операнды-выражения
+    (merchant_city ILIKE '%a%' || 'ty', 'x' || merchant_city ILIKE ...) остаются без изменений.
+    """
+    tokens = tokenize(sql)
+    replacements: List[Tuple[int, int, str]] = []
+    for index, token in enumerate(tokens):
+        column = _column_name(token)
+        if column is None:
+            continue
+        # Начало выражения столбца с учетом квалификатора (t.merchant_city)
+        start = token.position
+        if index >= 2 and tokens[index - 1].kind == PUNCT and tokens[index - 1].value == "." and tokens[index - 2].kind in (WORD, QUOTED_IDENT):
+            start = tokens[index - 2].position
+        column_end = token.position + len(token.value) + (2 if token.kind == QUOTED_IDENT else 0)
+
+        cursor = index + 1
+        negated = cursor < len(tokens) and tokens[cursor].kind == WORD and tokens[cursor].value == "NOT"
+        if negated:
+            cursor += 1
+        if cursor + 1 >= len(tokens) or tokens[cursor].kind != WORD or tokens[cursor].value not in ("LIKE", "ILIKE"):
+            continue
+        literal = tokens[cursor + 1]
+        if literal.kind != STRING or not literal.value.startswith("'"):
+            continue
+        # Шаблон - весь литерал: '%a%' || 'ty', '%a%'::text и ESCAPE не переписываются
+        if not _ends_predicate(tokens, cursor + 2):
+            continue
+        # Столбец - весь левый операнд: 'x' || merchant_city ILIKE ... сравнивает конкатенацию
+        first = index - 2 if start != token.position else index
+        before = tokens[first - 1] if first > 0 else None
+        if before is not None and before.kind == PUNCT and before.value not in ("(", ","):
+            continue
+
+        pattern = literal.value[1:-1].replace("''", "'")
+        values = resolve_pattern(column, pattern, case_insensitive=tokens[cursor].value == "ILIKE")
+        if not values:
+            continue
+        end = literal.position + len(literal.value)
+        replacements.append((start, end, _predicate(sql[start:column_end], values, negated)))
+
+    for start, end, predicate in reversed(replacements):
+        sql = sql[:start] + predicate + sql[end:]
+    return sql
+
+
+def _canonical_value(column: str, literal: Token) -> Optional[str]:
+    """Значение домена, отличающееся от литерала только регистром"""
+    if literal.kind != STRING or not literal.value.startswith("'"):
+        return None
+    value = literal.value[1:-1].replace("''", "'")
+    for candidate in ENUM_DOMAINS[column]:
+        if candidate != value and candidate.lower() == value.lower():
+            return candidate
+    return None
+
+
+def fix_enum_literal_case(sql: str) -> str:
+    """
+    Исправление регистра литералов в сравнениях со столбцами закрытого домена:
+    merchant_city = 'almaty' -> merchant_city = 'Almaty', wallet_type IN ('apple pay') -> ('Apple Pay').
+    Без исправления такие условия молча возвращают пустой результат.
+    """
+    tokens = tokenize(sql)
+    replacements: List[Tuple[int, int, str]] = []
+    for index, token in enumerate(tokens):
+        column = _column_name(token)
+        if column is None:
+            continue
+        cursor = index + 1
+        if cursor < len(tokens) and tokens[cursor].kind == WORD and tokens[cursor].value == "NOT":
+            cursor += 1
+        literals: List[Token] = []
+        # Оператор сравнения: =, <>, != (каждый символ - отдельный токен)
+        operator = ""
+        while cursor < len(tokens) and tokens[cursor].kind == PUNCT and tokens[cursor].value in "=<>!":
+            operator += tokens[cursor].value
+            cursor += 1
+        if operator in ("=", "<>", "!="):
+            if cursor < len(tokens):
+                literals.append(tokens[cursor])
+        elif not operator and cursor + 1 < len(tokens) and tokens[cursor].value == "IN" and tokens[cursor + 1].value == "(":
+            cursor += 2
+            while cursor < len(tokens) and tokens[cursor].kind == STRING:
+                literals.append(tokens[cursor])
+                cursor += 1
+                if cursor < len(tokens) and tokens[cursor].value == ",":
+                    cursor += 1
+                    continue
+                break
+        for literal in literals:
+            value = _canonical_value(column, literal)
+            if value is not None:
+                replacements.append((literal.position, literal.position + len(literal.value), _quote(value)))
+
+    for start, end, replacement in reversed(replacements):
+        sql = sql[:start] + replacement + sql[end:]
+    return sql
+
+
+def _time_literal(tokens: List[Token], index: int) -> Tuple[Optional[datetime], int]:
+    """Литерал времени ('2024-01-01' или DATE '2024-01-01') с позиции index и индекс следующего токена"""
+    if index < len(tokens) and tokens[index].kind == WORD and tokens[index].value in TIME_LITERAL_KEYWORDS:
+        index += 1
+    if index >= len(tokens) or tokens[index].kind != STRING or not tokens[index].value.startswith("'"):
+        return None, index
+    try:
+        value = datetime.fromisoformat(tokens[index].value[1:-1].strip())
+    except ValueError:
+        return None, index + 1
+    return value.replace(tzinfo=None), index + 1
+
+
+def query_time_range(tokens: List[Token]) -> Tuple[Optional[datetime], Optional[datetime]]:
+    """
+    Диапазон времени из условий вида column >= '...', column < DATE '...', column BETWEEN '...' AND '...'.
+    Несколько условий пересекаются; отсутствующая граница - None.
+    """
+    lower: Optional[datetime] = None
+    upper: Optional[datetime] = None
+    for index, token in enumerate(tokens):
+        if token.kind not in (WORD, QUOTED_IDENT):
+            continue
+        cursor = index + 1
+        if cursor < len(tokens) and tokens[cursor].kind == WORD and tokens[cursor].value == "BETWEEN":
+            start, cursor = _time_literal(tokens, cursor + 1)
+            if start is None or cursor >= len(tokens) or tokens[cursor].value != "AND":
+                continue
+            end, _ = _time_literal(tokens, cursor + 1)
+            if end is not None:
+                lower = start if lower is None else max(lower, start)
+                upper = end if upper is None else min(upper, end)
+            continue
+        # Оператор сравнения (каждый символ - отдельный токен)
+        operator = ""
+        while cursor < len(tokens) and tokens[cursor].kind == PUNCT and tokens[cursor].value in "<>=":
+            operator += tokens[cursor].value
+            cursor += 1
+        if operator not in (">", ">=", "<", "<="):
+            continue
+        value, _ = _time_literal(tokens, cursor)
+        if value is None:
+            continue
+        if operator.startswith(">"):
+            lower = value if lower is None else max(lower, value)
+        else:
+            upper = value if upper is None else min(upper, value)
+    return lower, upper
+
+
+def _bucket_aliases(sql: str, tokens: List[Token], units: List[Token], unit: str) -> List[Token]:
+    """
+    Псевдоним DATE_TRUNC, совпадающий с единицей (DATE_TRUNC('day', ts) AS day), и ссылки на него
+    в GROUP BY и ORDER BY: при укрупнении они переименовываются, чтобы подпись оси не расходилась с данными.
+    """
+    def name(token: Token) -> str:
+        return token.value if token.kind == QUOTED_IDENT else sql[token.position:token.position + len(token.value)].lower()
+
+    definitions: List[Token] = []
+    for literal in units:
+        index = next(position for position, token in enumerate(tokens) if token is literal)
+        depth = 0
+        while index < len(tokens):
+            if tokens[index].value == "(":
+                depth += 1
+            elif tokens[index].value == ")":
+                depth -= 1
+                if depth < 0:
+                    break
+            index += 1
+        if (
+            index + 2 < len(tokens) and tokens[index + 1].kind == WORD and tokens[index + 1].value == "AS"
+            and tokens[index + 2].kind in (WORD, QUOTED_IDENT) and name(tokens[index + 2]) == unit
+        ):
+            definitions.append(tokens[index + 2])
+    if not definitions:
+        return []
+
+    references: List[Token] = []
+    clause = None
+    depth = 0
+    for index, token in enumerate(tokens):
+        if token.kind == PUNCT and token.value in "()":
+            depth += 1 if token.value == "(" else -1
+        elif depth == 0 and token.kind == WORD and token.value in TOP_LEVEL_CLAUSES:
+            clause = token.value
+        elif (
+            depth == 0 and clause in ("GROUP", "ORDER") and token.kind in (WORD, QUOTED_IDENT) and name(token) == unit
+            and not (index + 1 < len(tokens) and tokens[index + 1].value in ("(", "."))
+        ):
+            references.append(token)
+    return definitions + references
+
+
+def coarsen_time_buckets(sql: str, max_buckets: int) -> Tuple[str, Optional[str]]:
+    """
+    Укрупнение DATE_TRUNC ряда графика по диапазону запроса: если в диапазоне больше max_buckets
+    интервалов, единица заменяется ближайшей более крупной, дающей не больше max_buckets.
+
+    DATE_TRUNC('day', ts) AS day за 2020-2024 (1826 точек) -> DATE_TRUNC('week', ts) AS week (261 точка)
+
+    Меняются только DATE_TRUNC в SELECT, GROUP BY и ORDER BY (в WHERE они задают фильтр);
+    псевдоним, совпадающий с прежней единицей, переименовывается вместе со ссылками на него.
+    Диапазон берется только из литералов запроса: без нижней и верхней границы (например,
+    transaction_timestamp >= '2020-01-01' без конца периода) запрос не меняется, чтобы результат
+    не зависел от текущего времени. Также без изменений остаются запросы с подзапросами и
+    несколькими разными единицами группировки. Возвращает SQL и новую единицу (None - без изменений).
+    """
+    tokens = tokenize(sql)
+    if sum(1 for token in tokens if token.kind == WORD and token.value == "SELECT") != 1:
+        return sql, None
+
+    units: List[Token] = []
+    clause = None
+    depth = 0
+    for index, token in enumerate(tokens):
+        if token.kind == PUNCT and token.value in "()":
+            depth += 1 if token.value == "(" else -1
+        elif depth == 0 and token.kind == WORD and token.value in TOP_LEVEL_CLAUSES:
+            clause = token.value
+        if (
+            clause in BUCKET_CLAUSES and token.kind == WORD and token.value == "DATE_TRUNC"
+            and index + 2 < len(tokens) and tokens[index + 1].value == "("
+            and tokens[index + 2].kind == STRING and tokens[index + 2].value.startswith("'")
+        ):
+            units.append(tokens[index + 2])
+    names = {unit.value[1:-1].strip().lower() for unit in units}
+    durations = dict(TIME_UNITS)
+    if len(names) != 1:
+        return sql, None
+    unit = names.pop()
+    if unit not in durations:
+        return sql, None
+
+    lower, upper = query_time_range(tokens)
+    if lower is None or upper is None:
+        return sql, None
+    span = (upper - lower).total_seconds()
+    if span <= 0 or span / durations[unit] <= max_buckets:
+        return sql, None
+    coarser = [name for name, seconds in TIME_UNITS if seconds > durations[unit]]
+    target = next((name for name in coarser if span / durations[name] <= max_buckets), coarser[-1] if coarser else unit)
+    if target == unit:
+        return sql, None
+
+    edits = [(literal.position, literal.position + len(literal.value), _quote(target)) for literal in units]
+    for alias in _bucket_aliases(sql, tokens, units, unit):
+        end = alias.position + len(alias.value) + (2 if alias.kind == QUOTED_IDENT else 0)
+        edits.append((alias.position, end, f'"{target}"' if alias.kind == QUOTED_IDENT else target))
+    for start, end, replacement in sorted(edits, reverse=True):
+        sql = sql[:start] + replacement + sql[end:]
+    return sql, target
@@ -1,17 +1,163 @@
+import asyncio
+import hashlib
 import re
+import threading
 import time
-from typing import List, Dict, Any, Optional
+from collections import OrderedDict
+from typing import List, Dict, Any, NamedTuple, Optional
 from datetime import date, datetime
 from decimal import Decimal
-from sqlalchemy import create_engine, text
-from app.config import DATABASE_URL
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Connection, CursorResult, Engine
+from app.config import (
+    DATABASE_URL, PREPARED_STATEMENTS, PREPARED_STATEMENTS_PER_CONNECTION,
+    PLAN_CACHE_MODE, DB_POOL_SIZE, DB_MAX_OVERFLOW
+)
 from app.models import ExecutionResult
 from app.security_validator import SecurityValidator, SecurityException
+from app.metrics import timed
+from app.singleflight import SingleFlight
+from app.sql_fingerprint import analyze_sql
 
 BATCH_SIZE = 50000  # Максимальный размер батча
 MAX_RESULT_ROWS = 10000  # Максимальное количество строк результата
 
 security_validator = SecurityValidator()
+# Коалесинг одинаковых параллельно выполняемых SQL запросов
+sql_flight = SingleFlight("sql")
+
+PLAN_CACHE_MODES = {"auto", "force_generic_plan", "force_custom_plan"}
+
+# Классы ошибок PostgreSQL, обнаруживаемых без выполнения:
+# 42 - синтаксис, несуществующие столбцы/таблицы/функции, несовпадение типов; 22 - некорректные литералы
+COMPILE_ERROR_CLASSES = ("42", "22")
+COMPILED_CACHE_SIZE = 1024
+
+_engine: Optional[Engine] = None
+_engine_lock = threading.Lock()
+
+
+def get_db_engine() -> Engine:
+    """Общий пул соединений (создается при первом запросе)"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = create_engine(
+                    DATABASE_URL,
+                    pool_size=DB_POOL_SIZE,
+                    max_overflow=DB_MAX_OVERFLOW,
+                    pool_pre_ping=True
+                )
+                if PREPARED_STATEMENTS and PLAN_CACHE_MODE != "auto":
+                    if PLAN_CACHE_MODE not in PLAN_CACHE_MODES:
+                        raise ValueError(f"Unknown PLAN_CACHE_MODE '{PLAN_CACHE_MODE}'")
+                    
+                    @event.listens_for(engine, "connect")
+                    def set_plan_cache_mode(dbapi_connection, connection_record):
+                        cursor = dbapi_connection.cursor()
+                        cursor.execute(f"SET plan_cache_mode = {PLAN_CACHE_MODE}")
+                        cursor.close()
+                
+                _engine = engine
+    return _engine
+
+
+class CompileError(NamedTuple):
+    code: str       # SQLSTATE PostgreSQL
+    message: str    # первая строка сообщения об ошибке
+
+
+# LRU канонических SQL, успешно прошедших компиляцию
+_compiled: "OrderedDict[str, bool]" = OrderedDict()
+_compiled_lock = threading.Lock()
+
+
+def compile_sql(sql_query: str) -> Optional[CompileError]:
+    """
+    Проверка запроса без выполнения (EXPLAIN без ANALYZE): PostgreSQL разбирает запрос,
+    разрешает имена и типы и строит план, но не читает данные.
+    Возвращает ошибку компиляции или None. Прочие ошибки (нет соединения и т.п.) не считаются
+    ошибками запроса - они проявятся при выполнении.
+    """
+    # EXPLAIN по несколько операторов выполнил бы все, кроме первого: проверка безопасности обязательна
+    validation = security_validator.validate_sql(sql_query, "")
+    if not validation.is_safe:
+        raise SecurityException(f"Query violates security policy: {validation.validation_notes}")
+    
+    key = analyze_sql(sql_query).canonical
+    with _compiled_lock:
+        if key in _compiled:
+            _compiled.move_to_end(key)
+            return None
+    
+    try:
+        with get_db_engine().connect() as connection:
+            # Курсор DBAPI напрямую: без подстановки параметров '%' в LIKE не требует экранирования
+            cursor = connection.connection.cursor()
+            try:
+                cursor.execute(f"EXPLAIN {sql_query}")
+            finally:
+                cursor.close()
+    except Exception as e:
+        code = getattr(e, "pgcode", None)
+        if code and code[:2] in COMPILE_ERROR_CLASSES:
+            message = (getattr(e, "pgerror", None) or str(e)).strip().splitlines()[0]
+            return CompileError(code, message.removeprefix("ERROR:").strip())
+        print(f"SQL dry run skipped: {e}")
+        return None
+    
+    with _compiled_lock:
+        _compiled[key] = True
+        if len(_compiled) > COMPILED_CACHE_SIZE:
+            _compiled.popitem(last=False)
+    return None
+
+
+def _prepared_cache(connection: Connection) -> "OrderedDict[str, bool]":
+    """
+    LRU prepared statements соединения: имя -> удалось ли подготовить.
+    Хранится в info DBAPI-соединения, поэтому живет, пока соединение в пуле.
+    """
+    return connection.info.setdefault("prepared_statements", OrderedDict())
+
+
+def _execute(connection: Connection, sql_query: str) -> CursorResult:
+    """
+    Выполнение запроса через именованный prepared statement.
+
+    Литералы выносятся в параметры, поэтому запросы одной формы с разными датами,
+    городами или категориями используют один план. Если форму подготовить нельзя
+    (например, тип параметра не выводится), запрос выполняется как обычно.
+    """
+    if not PREPARED_STATEMENTS:
+        return connection.execute(text(sql_query))
+    
+    shape = analyze_sql(sql_query)
+    name = "t2s_" + hashlib.sha256(shape.parameterized.encode("utf-8")).hexdigest()[:16]
+    prepared = _prepared_cache(connection)
+    
+    if name not in prepared:
+        try:
+            with connection.begin_nested():
+                connection.exec_driver_sql(f"PREPARE {name} AS {shape.parameterized}")
+            prepared[name] = True
+        except Exception as e:
+            print(f"Could not prepare statement {name}, executing directly: {e}")
+            prepared[name] = False
+        while len(prepared) > PREPARED_STATEMENTS_PER_CONNECTION:
+            evicted, was_prepared = prepared.popitem(last=False)
+            if was_prepared:
+                connection.exec_driver_sql(f"DEALLOCATE {evicted}")
+    else:
+        prepared.move_to_end(name)
+    
+    if not prepared[name]:
+        return connection.execute(text(sql_query))
+    if not shape.params:
+        return connection.exec_driver_sql(f"EXECUTE {name}")
+    placeholders = ", ".join(["%s"] * len(shape.params))
+    return connection.exec_driver_sql(f"EXECUTE {name}({placeholders})", tuple(shape.params))
 
 
 def _convert_to_json_serializable(value: Any) -> Any:
@@ -31,6 +177,14 @@ def _convert_to_json_serializable(value: Any) -> Any:
 
 
 
+def _rows_to_dicts(columns: List[str], rows) -> List[Dict[str, Any]]:
+    """Строки результата в список словарей с JSON-совместимыми значениями"""
+    return [
+        {col: _convert_to_json_serializable(row[i]) for i, col in enumerate(columns)}
+        for row in rows
+    ]
+
+
 def _has_limit_in_query(sql_query: str) -> bool:
     """
     Проверяет, есть ли LIMIT в SQL запросе (включая подзапросы).
@@ -90,30 +244,38 @@ async def execute_sql_query(sql_query: str, user_intent: str = "") -> ExecutionR
     Returns:
         ExecutionResult с данными и метаинформацией
     """
-    start_time = time.time()
-    engine = create_engine(DATABASE_URL)
-    
-    validation = security_validator.validate_sql(sql_query, user_intent)
+    # Валидация выполняется для каждого вызывающего, коалесится только само выполнение
+    with timed("validation"):
+        validation = security_validator.validate_sql(sql_query, user_intent)
     if not validation.is_safe:
         raise SecurityException(f"Query violates security policy: {validation.validation_notes}")
     
+    # Ключ коалесинга - канонический SQL: запросы, отличающиеся форматированием,
+    # псевдонимами таблиц или порядком значений в IN, выполняются один раз
+    shape = analyze_sql(sql_query)
+    with timed("db_execution"):
+        result = await sql_flight.do(
+            shape.canonical,
+            lambda: asyncio.to_thread(_run_sql_query, sql_query)
+        )
+    result.sql_fingerprint = shape.fingerprint
+    return result
+
+
+def _run_sql_query(sql_query: str) -> ExecutionResult:
+    """Блокирующее выполнение запроса к БД (вызывается в отдельном потоке)"""
+    start_time = time.time()
+    engine = get_db_engine()
+    
     with engine.connect() as connection:
         has_limit = _has_limit_in_query(sql_query)
         query_limit = _extract_limit_from_query(sql_query)
         
         if has_limit:
             try:
-                result = connection.execute(text(sql_query))
+                result = _execute(connection, sql_query)
                 columns = list(result.keys())
-                rows = result.fetchall()
-                
-                all_data: List[Dict[str, Any]] = []
-                for row in rows:
-                    row_dict = {
-                        col: _convert_to_json_serializable(row[i]) 
-                        for i, col in enumerate(columns)
-                    }
-                    all_data.append(row_dict)
+                all_data = _rows_to_dicts(columns, result.fetchall())
                 
                 execution_time_ms = (time.time() - start_time) * 1000
                 
@@ -133,7 +295,7 @@ async def execute_sql_query(sql_query: str, user_intent: str = "") -> ExecutionR
             paginated_query = _add_limit_offset(sql_query, BATCH_SIZE, offset)
             
             try:
-                result = connection.execute(text(paginated_query))
+                result = _execute(connection, paginated_query)
                 
                 if offset == 0:
                     columns = list(result.keys())
@@ -143,12 +305,7 @@ async def execute_sql_query(sql_query: str, user_intent: str = "") -> ExecutionR
                 if not rows:
                     break
                 
-                for row in rows:
-                    row_dict = {
-                        col: _convert_to_json_serializable(row[i]) 
-                        for i, col in enumerate(columns)
-                    }
-                    all_data.append(row_dict)
+                all_data.extend(_rows_to_dicts(columns, rows))
                 
                 total_rows += len(rows)
                 
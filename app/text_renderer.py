@@ -0,0 +1,260 @@
+from typing import Any, Dict, List, Optional
+
+from app.prompts import NO_DATA
+
+# Результаты больших размеров отдаются LLM-нарратору
+MAX_LIST_ROWS = 10
+MAX_ROW_COLUMNS = 6
+
+# Формы существительных: ru - (1, 2-4, 5+), kk - (ед., мн.), en - (ед., мн.)
+NOUNS = {
+    "transaction": {"ru": ("транзакция", "транзакции", "транзакций"), "kk": ("транзакция", "транзакциялар"), "en": ("transaction", "transactions")},
+    "merchant": {"ru": ("мерчант", "мерчанта", "мерчантов"), "kk": ("мерчант", "мерчанттар"), "en": ("merchant", "merchants")},
+    "card": {"ru": ("карта", "карты", "карт"), "kk": ("карта", "карталар"), "en": ("card", "cards")},
+    "client": {"ru": ("клиент", "клиента", "клиентов"), "kk": ("клиент", "клиенттер"), "en": ("client", "clients")},
+    "city": {"ru": ("город", "города", "городов"), "kk": ("қала", "қалалар"), "en": ("city", "cities")},
+    "bank": {"ru": ("банк", "банка", "банков"), "kk": ("банк", "банктер"), "en": ("bank", "banks")},
+}
+
+# Слова в имени столбца, означающие денежную сумму
+AMOUNT_WORDS = ("amount", "sum", "kzt", "volume", "revenue", "spent", "spend")
+# Множественное число сущностей: total_transactions, unique_cards - количество
+COUNTED_ENTITY_WORDS = (
+    "transactions", "operations", "purchases", "payments",
+    "merchants", "cards", "clients", "customers", "users", "cities", "banks",
+)
+
+# Названия столбцов схемы и типичных агрегатов
+COLUMN_LABELS = {
+    "ru": {
+        "transaction_timestamp": "Дата транзакции",
+        "card_id": "ID карты",
+        "issuer_bank_name": "Банк-эмитент",
+        "merchant_id": "ID мерчанта",
+        "merchant_mcc": "MCC код",
+        "mcc_category": "Категория",
+        "merchant_city": "Город",
+        "transaction_type": "Тип транзакции",
+        "transaction_amount_kzt": "Сумма транзакции",
+        "original_amount": "Сумма в исходной валюте",
+        "transaction_currency": "Валюта",
+        "acquirer_country_iso": "Страна эквайера",
+        "pos_entry_mode": "Способ оплаты",
+        "wallet_type": "Тип кошелька",
+        "transaction_year": "Год",
+        "transaction_month": "Месяц",
+        "year": "Год",
+        "month": "Месяц",
+        "day": "День",
+    },
+    "kk": {
+        "transaction_timestamp": "Транзакция күні",
+        "card_id": "Карта ID",
+        "issuer_bank_name": "Эмитент банк",
+        "merchant_id": "Мерчант ID",
+        "merchant_mcc": "MCC коды",
+        "mcc_category": "Санат",
+        "merchant_city": "Қала",
+        "transaction_type": "Транзакция түрі",
+        "transaction_amount_kzt": "Транзакция сомасы",
+        "original_amount": "Бастапқы валютадағы сома",
+        "transaction_currency": "Валюта",
+        "acquirer_country_iso": "Эквайер елі",
+        "pos_entry_mode": "Төлем тәсілі",
+        "wallet_type": "Әмиян түрі",
+        "transaction_year": "Жыл",
+        "transaction_month": "Ай",
+        "year": "Жыл",
+        "month": "Ай",
+        "day": "Күн",
+    },
+    "en": {
+        "transaction_timestamp": "Transaction date",
+        "issuer_bank_name": "Issuer bank",
+        "mcc_category": "Category",
+        "merchant_city": "City",
+        "transaction_amount_kzt": "Transaction amount",
+        "transaction_currency": "Currency",
+        "pos_entry_mode": "Entry mode",
+    },
+}
+
+KIND_LABELS = {
+    "ru": {"amount": "Сумма", "avg": "Среднее значение"},
+    "kk": {"amount": "Сома", "avg": "Орташа мән"},
+    "en": {"amount": "Amount", "avg": "Average"},
+}
+
+SCALAR_TEMPLATES = {
+    "ru": {"count": "Всего {value} {noun}.", "amount": "Сумма составляет {value}.", "avg": "Среднее значение составляет {value}."},
+    "kk": {"count": "Барлығы {value} {noun}.", "amount": "Сомасы {value} құрайды.", "avg": "Орташа мәні {value}."},
+    "en": {"count": "In total, {value} {noun}.", "amount": "The total amount is {value}.", "avg": "The average is {value}."},
+}
+
+CURRENCY = {"ru": "₸", "kk": "₸", "en": "KZT"}
+
+
+def ru_plural(number: int, forms: tuple) -> str:
+    """Русская форма существительного для числа: 1 транзакция, 2 транзакции, 5 транзакций"""
+    number = abs(number)
+    if number % 10 == 1 and number % 100 != 11:
+        return forms[0]
+    if 2 <= number % 10 <= 4 and not 12 <= number % 100 <= 14:
+        return forms[1]
+    return forms[2]
+
+
+def noun_for(entity: str, number: int, lang: str) -> str:
+    forms = NOUNS[entity][lang]
+    if lang == "ru":
+        return ru_plural(number, forms)
+    if lang == "en":
+        return forms[0] if abs(number) == 1 else forms[1]
+    # В казахском после числительного существительное стоит в единственном числе
+    return forms[0]
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def format_number(value: Any, lang: str) -> str:
+    """Число с разделителями разрядов: 1 234 567,89 (ru/kk) или 1,234,567.89 (en)"""
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        value = int(value)
+    text = f"{value:,}" if isinstance(value, int) else f"{value:,.2f}"
+    if lang == "en":
+        return text
+    return text.replace(",", " ").replace(".", ",")
+
+
+def _metric_kind(column: str) -> Optional[str]:
+    """
+    Вид показателя по имени столбца. "total" сам по себе неоднозначен (total_transactions -
+    количество, total - может быть суммой), поэтому решают слова рядом с ним;
+    без них вид не определяется и значение выводится без шаблона суммы.
+    """
+    name = column.lower()
+    if "avg" in name or "average" in name or "mean" in name:
+        return "avg"
+    if "count" in name or name in ("cnt", "n", "num", "количество") or name.startswith("num_"):
+        return "count"
+    if any(word in name for word in AMOUNT_WORDS):
+        return "amount"
+    if any(word in name for word in COUNTED_ENTITY_WORDS):
+        return "count"
+    return None
+
+
+def _entity(column: str) -> str:
+    name = column.lower()
+    for entity, words in (
+        ("merchant", ("merchant",)),
+        ("card", ("card",)),
+        ("client", ("client", "customer", "user")),
+        ("city", ("city",)),
+        ("bank", ("bank",)),
+    ):
+        if any(word in name for word in words):
+            return entity
+    return "transaction"
+
+
+def _is_kzt(column: str) -> bool:
+    name = column.lower()
+    return "original" not in name and ("kzt" in name or "amount" in name)
+
+
+def column_label(column: str, lang: str) -> str:
+    """Человекочитаемое название столбца на языке пользователя"""
+    label = COLUMN_LABELS[lang].get(column.lower())
+    if label:
+        return label
+    kind = _metric_kind(column)
+    if kind == "count":
+        forms = NOUNS[_entity(column)][lang]
+        if lang == "ru":
+            return f"Количество {forms[2]}"
+        if lang == "kk":
+            return f"{forms[1].capitalize()} саны"
+        return f"Number of {forms[1]}"
+    if kind in ("amount", "avg"):
+        return KIND_LABELS[lang][kind]
+    return column.replace("_", " ").strip().capitalize()
+
+
+def format_value(column: str, value: Any, lang: str) -> str:
+    if value is None:
+        return "—"
+    if not _is_number(value):
+        return str(value)
+    text = format_number(value, lang)
+    if _metric_kind(column) in ("amount", "avg") and _is_kzt(column):
+        text = f"{text} {CURRENCY[lang]}"
+    return text
+
+
+def _render_scalar(column: str, value: Any, lang: str) -> Optional[str]:
+    if value is None:
+        return NO_DATA[lang]
+    kind = _metric_kind(column)
+    if kind is None and _is_number(value) and column.lower() not in COLUMN_LABELS[lang]:
+        # Вид числа по имени столбца не понятен (например, total) - ответ формирует LLM
+        return None
+    if _is_number(value) and kind == "count" and float(value).is_integer():
+        return SCALAR_TEMPLATES[lang]["count"].format(
+            value=format_number(int(value), lang),
+            noun=noun_for(_entity(column), int(value), lang)
+        )
+    if _is_number(value) and kind in ("amount", "avg"):
+        return SCALAR_TEMPLATES[lang][kind].format(value=format_value(column, value, lang))
+    return f"{column_label(column, lang)}: {format_value(column, value, lang)}."
+
+
+def _render_row(row: Dict[str, Any], lang: str) -> str:
+    parts = [f"{column_label(column, lang)} — {format_value(column, value, lang)}" for column, value in row.items()]
+    return "; ".join(parts) + "."
+
+
+def _render_list(rows: List[Dict[str, Any]], lang: str) -> Optional[str]:
+    columns = list(rows[0].keys())
+    if len(columns) == 1:
+        column = columns[0]
+        values = [format_value(column, row.get(column), lang) for row in rows]
+        return f"{column_label(column, lang)}: {', '.join(values)}."
+    if len(columns) != 2:
+        return None
+    key_column, value_column = columns
+    if not all(_is_number(row.get(value_column)) or row.get(value_column) is None for row in rows):
+        return None
+    lines = [f"{column_label(value_column, lang)}:"]
+    for index, row in enumerate(rows, 1):
+        lines.append(
+            f"{index}. {format_value(key_column, row.get(key_column), lang)} — "
+            f"{format_value(value_column, row.get(value_column), lang)}"
+        )
+    return "\n".join(lines)
+
+
+def render_text(rows: List[Dict[str, Any]], lang: str) -> Optional[str]:
+    """
+    Локальный шаблонный ответ для простых форм результата без вызова LLM.
+
+    Поддерживаются: пустой результат, одно значение (COUNT/SUM/AVG), одна строка
+    с несколькими столбцами и короткий список (топ-N: ключ и значение).
+    Для более сложных результатов возвращается None - ответ формирует LLM.
+    """
+    if lang not in NOUNS["transaction"]:
+        lang = "ru"
+    if not rows:
+        return NO_DATA[lang]
+    columns = list(rows[0].keys())
+    if len(rows) == 1:
+        if len(columns) == 1:
+            return _render_scalar(columns[0], rows[0][columns[0]], lang)
+        if len(columns) <= MAX_ROW_COLUMNS:
+            return _render_row(rows[0], lang)
+        return None
+    if len(rows) <= MAX_LIST_ROWS:
+        return _render_list(rows, lang)
+    return None
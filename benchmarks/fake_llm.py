@@ -0,0 +1,239 @@
+"""
+Детерминированный заглушечный LLM-сервер для бенчмарков.
+
+Отвечает по протоколам обоих движков:
+  - Gemini:  POST /v1beta/models/<model>:generateContent и :streamGenerateContent?alt=sse,
+             POST/PATCH /v1beta/cachedContents (кэш контекста: системная инструкция хранится на заглушке)
+  - Ollama:  POST /api/chat (stream true/false)
+
+Этап определяется по тексту промпта (clarity, format, sql, translate, narrate),
+SQL и формат берутся из сценария: вопрос -> {"output_format", "sql"}.
+Задержка задается на запрос (--latency-ms) и для потоковых ответов на фрагмент (--chunk-ms).
+
+Запуск отдельно от бенчмарка (для замеров живого сервера):
+    python benchmarks/fake_llm.py --port 8089 --latency-ms 300
+    LLM_API_URL=http://127.0.0.1:8089 OLLAMA_API_URL=http://127.0.0.1:8089 ./run.sh
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.workload import WORKLOAD  # noqa: E402
+
+DEFAULT_SQL = "SELECT COUNT(*) AS transaction_count FROM transactions"
+NARRATION = "По данным за период больше всего операций пришлось на Алматы, следом идут Астана и Шымкент."
+_COLUMNS_RE = re.compile(r"\[\s*\"[^\[\]]*\]")
+
+
+class FakeLLM:
+    """Заглушка LLM: сценарий ответов, фиксированная задержка, счетчики вызовов по этапам"""
+
+    def __init__(self, scenario: Optional[Dict[str, Dict[str, str]]] = None, latency_ms: float = 0.0, chunk_ms: float = 0.0):
+        self.scenario = scenario if scenario is not None else {item["question"]: item for item in WORKLOAD}
+        self.latency_ms = latency_ms
+        self.chunk_ms = chunk_ms
+        self.calls: Dict[str, int] = {}
+        # Кэш контекста: имя -> системная инструкция
+        self.cached_contents: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def _find_case(self, text: str) -> Dict[str, str]:
+        # В промпте бывают и предыдущие вопросы из истории: текущий стоит последним
+        positions = {question: text.rfind(question) for question in self.scenario}
+        question = max(positions, key=positions.get, default=None)
+        if question is None or positions[question] < 0:
+            return {"output_format": "table", "sql": DEFAULT_SQL}
+        return self.scenario[question]
+
+    def respond(self, system: str, text: str, engine: str) -> Tuple[str, str]:
+        """Этап и текст ответа для промпта"""
+        # Правила этапа могут быть как в промпте, так и в системной инструкции этапа
+        if "is_clear" in system + text:
+            stage, answer = "clarity", json.dumps({"is_clear": True, "clarification_question": None})
+        elif "refined_query" in system + text:
+            case = self._find_case(text)
+            stage, answer = "format", json.dumps({
+                "output_format": case["output_format"],
+                "confidence_score": 0.95,
+                "clarification_question": None,
+                "refined_query": case.get("question", text[-200:]),
+            }, ensure_ascii=False)
+        elif "переводишь названия столбцов" in system or "баған атауларын" in system:
+            match = _COLUMNS_RE.search(text)
+            columns = json.loads(match.group(0)) if match else []
+            stage, answer = "translate", json.dumps(
+                {column: column.replace("_", " ").capitalize() for column in columns}, ensure_ascii=False
+            )
+        elif "sql_query" in system + text or "SQL SELECT" in system:
+            sql = self._find_case(text)["sql"]
+            stage = "sql"
+            answer = json.dumps({"sql_query": sql}, ensure_ascii=False) if engine == "api" else f"```sql\n{sql};\n```"
+        else:
+            stage, answer = "narrate", NARRATION
+        with self._lock:
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+        return stage, answer
+
+    def chunks(self, answer: str) -> List[str]:
+        words = answer.split(" ")
+        return [word + (" " if index < len(words) - 1 else "") for index, word in enumerate(words)]
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запуск в фоновом потоке, возвращает базовый URL"""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, content_type: str, body: bytes):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_stream(self, content_type: str, frames: List[bytes]):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for frame in frames:
+                    if fake.chunk_ms:
+                        time.sleep(fake.chunk_ms / 1000)
+                    self.wfile.write(f"{len(frame):x}\r\n".encode() + frame + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _payload(self) -> dict:
+                return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+            def _cached_content(self, name: str, payload: dict) -> bytes:
+                expire = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 3600))
+                return json.dumps({"name": name, "model": payload.get("model", ""), "expireTime": expire}).encode()
+
+            def do_PATCH(self):
+                payload = self._payload()
+                name = self.path.split("/v1beta/", 1)[-1].split("?", 1)[0]
+                if name not in fake.cached_contents:
+                    self._send(404, "application/json", b'{"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}}')
+                    return
+                self._send(200, "application/json", self._cached_content(name, payload))
+
+            def do_POST(self):
+                payload = self._payload()
+                if self.path.startswith("/v1beta/cachedContents"):
+                    system = " ".join(part.get("text", "") for part in (payload.get("systemInstruction") or {}).get("parts", []))
+                    name = f"cachedContents/fake{len(fake.cached_contents)}"
+                    fake.cached_contents[name] = system
+                    self._send(200, "application/json", self._cached_content(name, payload))
+                    return
+                if fake.latency_ms:
+                    time.sleep(fake.latency_ms / 1000)
+                if self.path.startswith("/api/chat"):
+                    self._ollama(payload)
+                elif ":generateContent" in self.path or ":streamGenerateContent" in self.path:
+                    self._gemini(payload, stream=":streamGenerateContent" in self.path)
+                else:
+                    self._send(404, "application/json", b'{"error": "not found"}')
+
+            def _gemini(self, payload: dict, stream: bool):
+                system = " ".join(part.get("text", "") for part in (payload.get("systemInstruction") or {}).get("parts", []))
+                cached = payload.get("cachedContent")
+                if cached and cached not in fake.cached_contents:
+                    self._send(404, "application/json", b'{"error": {"code": 404, "message": "cached content not found", "status": "NOT_FOUND"}}')
+                    return
+                system = system or fake.cached_contents.get(cached, "")
+                contents = payload.get("contents") or [{}]
+                text = " ".join(part.get("text", "") for part in contents[-1].get("parts", []))
+                _, answer = fake.respond(system, text, "api")
+                # Грубая оценка токенов (~4 байта на токен), чтобы была видна экономия на кэше
+                prompt_text = system + "".join(part.get("text", "") for content in contents for part in content.get("parts", []))
+                usage = {"promptTokenCount": len(prompt_text.encode()) // 4}
+                if cached:
+                    usage["cachedContentTokenCount"] = len(system.encode()) // 4
+
+                def candidate(chunk: str) -> dict:
+                    return {"candidates": [{"content": {"role": "model", "parts": [{"text": chunk}]}, "finishReason": "STOP"}],
+                            "usageMetadata": usage}
+
+                if not stream:
+                    self._send(200, "application/json", json.dumps(candidate(answer)).encode())
+                    return
+                frames = [f"data: {json.dumps(candidate(chunk))}\r\n\r\n".encode() for chunk in fake.chunks(answer)]
+                self._send_stream("text/event-stream", frames)
+
+            def _ollama(self, payload: dict):
+                messages = payload.get("messages") or []
+                system = " ".join(m.get("content", "") for m in messages if m.get("role") == "system")
+                user = [m.get("content", "") for m in messages if m.get("role") == "user"]
+                # Со структурированным выводом (format) ответ - JSON, как у Gemini
+                _, answer = fake.respond(system, user[-1] if user else "", "api" if payload.get("format") else "llm")
+                model = payload.get("model", "")
+
+                prompt_tokens = sum(len(m.get("content", "").encode()) for m in messages) // 4
+
+                def message(chunk: str, done: bool) -> dict:
+                    body = {"model": model, "created_at": "1970-01-01T00:00:00Z",
+                            "message": {"role": "assistant", "content": chunk}, "done": done}
+                    if done:
+                        # Вся задержка заглушки считается генерацией, разбор промпта - мгновенным
+                        body.update(prompt_eval_count=prompt_tokens, prompt_eval_duration=0,
+                                    eval_count=len(answer.encode()) // 4, eval_duration=int(fake.latency_ms * 1e6))
+                    return body
+
+                if payload.get("stream") is False:
+                    self._send(200, "application/json", json.dumps(message(answer, True)).encode())
+                    return
+                frames = [(json.dumps(message(chunk, False)) + "\n").encode() for chunk in fake.chunks(answer)]
+                frames.append((json.dumps(message("", True)) + "\n").encode())
+                self._send_stream("application/x-ndjson", frames)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self._server.server_port}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Задержка каждого ответа")
+    parser.add_argument("--chunk-ms", type=float, default=0.0, help="Задержка между фрагментами потокового ответа")
+    parser.add_argument("--scenario", help="JSON со сценарием: [{question, output_format, sql}, ...]")
+    args = parser.parse_args()
+
+    scenario = None
+    if args.scenario:
+        with open(args.scenario, encoding="utf-8") as f:
+            scenario = {item["question"]: item for item in json.load(f)}
+    fake = FakeLLM(scenario, args.latency_ms, args.chunk_ms)
+    print(f"Fake LLM listening on {fake.start(args.host, args.port)}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Бенчмарк холодного старта app.server.
+
+Каждый замер выполняется в отдельном процессе, чтобы импорты были холодными:
+  - import_ms        время `import app.server`
+  - first_request_ms время первого запроса к /health
+  - engine_build_ms  время ленивого создания и прогрева каждого включенного движка
+
+Запуск:
+    python benchmarks/startup_bench.py --runs 5 --output bench_output.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD_SCRIPT = r"""
+import json, time
+t0 = time.perf_counter()
+import app.server as server
+t1 = time.perf_counter()
+from fastapi.testclient import TestClient
+client = TestClient(server.app)
+t2 = time.perf_counter()
+client.get("/health")
+t3 = time.perf_counter()
+builds = {}
+for name in server.ENABLED_ENGINES:
+    b0 = time.perf_counter()
+    server.get_engine(name).warmup()
+    builds[name] = (time.perf_counter() - b0) * 1000
+print(json.dumps({
+    "import_ms": (t1 - t0) * 1000,
+    "first_request_ms": (t3 - t2) * 1000,
+    "ready_ms": (t1 - t0 + t3 - t2) * 1000,
+    "engine_build_ms": builds,
+}))
+"""
+
+
+def run_once() -> dict:
+    env = dict(os.environ)
+    env.setdefault("LLM_API_KEY", "benchmark")
+    env.setdefault("WARMUP_ENGINES", "false")
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD_SCRIPT],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start benchmark for app.server")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", default=None, help="Путь для JSON с результатами")
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    summary = {
+        key: statistics.median(run[key] for run in runs)
+        for key in ("import_ms", "first_request_ms", "ready_ms")
+    }
+    summary["engine_build_ms"] = {
+        name: statistics.median(run["engine_build_ms"][name] for run in runs)
+        for name in runs[0]["engine_build_ms"]
+    }
+    result = {"runs": runs, "median": summary}
+
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Микро-бенчмарк валидатора SQL на враждебных входах.
+
+Сравниваются:
+  - legacy_ms   прежняя проверка пятью регулярными выражениями (re.search)
+  - lexer_ms    однопроходный лексер без кэша (check_sql_safety)
+  - cached_ms   повторная проверка того же SQL через SecurityValidator (кэш вердиктов)
+
+Для каждого входа берется худшее время из --runs повторов.
+
+Запуск:
+    python benchmarks/validator_bench.py --sizes 1000,10000,50000 --runs 5
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app.security_validator import SecurityValidator, check_sql_safety  # noqa: E402
+
+LEGACY_PATTERNS = [
+    r"\b(INSERT|UPDATE|DELETE|DROP|ALTER|CREATE|TRUNCATE)\b",
+    r";\s*(\w|\s)*$",
+    r"\b(COPY|GRANT|REVOKE|EXEC)\b",
+    r"(\bUNION\b.*\bSELECT\b)",
+    r"\b(SLEEP|BENCHMARK|WAITFOR)\b"
+]
+
+
+def legacy_validate(sql: str) -> bool:
+    return not any(re.search(pattern, sql, re.IGNORECASE) for pattern in LEGACY_PATTERNS)
+
+
+def adversarial_inputs(size: int):
+    """Входы, на которых регулярные выражения уходят в квадратичный перебор"""
+    repeat = max(1, size // 4)
+    return {
+        "many_semicolons": "SELECT 1" + "; a" * repeat + " !",
+        "many_unions": "SELECT a FROM t " + "UNION " * (size // 6) + "x",
+        "long_literal": "SELECT * FROM transactions WHERE merchant_city = '" + "Create drop " * (size // 12) + "'",
+        "nested_comments": "SELECT 1 " + "/*" * (size // 4) + "*/" * (size // 4),
+        "plain_select": "SELECT merchant_city, COUNT(*) FROM transactions WHERE " + " AND ".join(
+            f"transaction_amount_kzt > {i}" for i in range(size // 30)
+        ),
+    }
+
+
+def worst_ms(fn, sql: str, runs: int) -> float:
+    worst = 0.0
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(sql)
+        worst = max(worst, (time.perf_counter() - start) * 1000)
+    return worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,50000", help="Размеры входов в символах")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="Путь для сохранения результатов в JSON")
+    args = parser.parse_args()
+
+    validator = SecurityValidator()
+    results = []
+    for size in (int(value) for value in args.sizes.split(",")):
+        for name, sql in adversarial_inputs(size).items():
+            validator.validate_sql(sql, "")
+            row = {
+                "input": name,
+                "chars": len(sql),
+                "legacy_ms": round(worst_ms(legacy_validate, sql, args.runs), 3),
+                "lexer_ms": round(worst_ms(check_sql_safety, sql, args.runs), 3),
+                "cached_ms": round(worst_ms(lambda q: validator.validate_sql(q, ""), sql, args.runs), 3),
+                "legacy_safe": legacy_validate(sql),
+                "lexer_safe": check_sql_safety(sql)[0],
+            }
+            results.append(row)
+            print(
+                f"{name:16} {row['chars']:>7} chars  legacy {row['legacy_ms']:>10.3f} ms  "
+                f"lexer {row['lexer_ms']:>8.3f} ms  cached {row['cached_ms']:>6.3f} ms"
+            )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
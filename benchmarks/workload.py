@@ -0,0 +1,137 @@
+"""
+Рабочая нагрузка бенчмарков: вопросы со сценарием ответов заглушки LLM
+и синтетический набор transactions в локальном PostgreSQL.
+"""
+from sqlalchemy import create_engine, inspect, text
+
+# Вопросы покрывают все форматы и оба пути текстового ответа (шаблон и LLM)
+WORKLOAD = [
+    {
+        "question": "Сколько транзакций в Алматы?",
+        "output_format": "text",
+        "sql": "SELECT COUNT(*) AS transaction_count FROM transactions WHERE merchant_city = 'Almaty'",
+    },
+    {
+        "question": "Топ-5 категорий по сумме транзакций",
+        "output_format": "table",
+        "sql": "SELECT mcc_category, SUM(transaction_amount_kzt) AS total_amount FROM transactions "
+               "GROUP BY mcc_category ORDER BY total_amount DESC LIMIT 5",
+    },
+    {
+        "question": "Покажи график суммы транзакций по месяцам",
+        "output_format": "graph",
+        "sql": "SELECT DATE_TRUNC('month', transaction_timestamp) AS month, SUM(transaction_amount_kzt) AS total_amount "
+               "FROM transactions GROUP BY 1 ORDER BY 1",
+    },
+    {
+        "question": "Список последних транзакций через Apple Pay",
+        "output_format": "table",
+        "sql": "SELECT transaction_id, transaction_timestamp, merchant_city, transaction_amount_kzt FROM transactions "
+               "WHERE wallet_type ILIKE '%apple%' ORDER BY transaction_timestamp DESC LIMIT 1000",
+    },
+    {
+        "question": "Опиши распределение типов транзакций по городам",
+        "output_format": "text",
+        "sql": "SELECT merchant_city, transaction_type, COUNT(*) AS transaction_count FROM transactions "
+               "GROUP BY 1, 2 ORDER BY 1, 2",
+    },
+]
+
+# Отметка таблицы, созданной бенчмарком: только такую таблицу можно пересоздавать
+SEED_MARKER = "benchmark dataset"
+
+_CREATE_TABLE = """
+CREATE TABLE transactions (
+    id integer PRIMARY KEY,
+    transaction_id varchar NOT NULL,
+    transaction_timestamp timestamp,
+    card_id integer,
+    expiry_date varchar,
+    issuer_bank_name varchar,
+    merchant_id integer,
+    merchant_mcc integer,
+    mcc_category varchar,
+    merchant_city varchar,
+    transaction_type varchar,
+    transaction_amount_kzt numeric,
+    original_amount numeric,
+    transaction_currency varchar,
+    acquirer_country_iso varchar,
+    pos_entry_mode varchar,
+    wallet_type varchar
+)
+"""
+
+# Распределения близки к реальным: города и типы операций заметно перекошены
+_INSERT_ROWS = """
+INSERT INTO transactions
+SELECT
+    g,
+    md5(g::text),
+    timestamp '2024-01-01' + r1 * interval '365 days',
+    1 + floor(r2 * 50000)::int,
+    lpad((1 + floor(r3 * 12))::int::text, 2, '0') || '/' || (26 + floor(r4 * 5))::int::text,
+    (ARRAY['Halyk Bank', 'Kaspi Bank', 'Jusan Bank', 'ForteBank', 'Bank CenterCredit', 'Freedom Bank'])[1 + floor(r5 * 6)::int],
+    1 + floor(r6 * 5000)::int,
+    (ARRAY[5411, 5812, 5541, 5732, 5912, 4111, 5311, 4900, 5651, 7299, 5942, 5712, 0])[1 + floor(r7 * 13)::int],
+    (ARRAY['Grocery & Food Markets', 'Dining & Restaurants', 'Fuel & Service Stations', 'Electronics & Software',
+           'Pharmacies & Health', 'Travel & Transportation', 'General Retail & Department', 'Utilities & Bill Payments',
+           'Clothing & Apparel', 'Services (Other)', 'Hobby, Books, Sporting Goods', 'Home Furnishings & Supplies',
+           'Unknown'])[1 + floor(r7 * 13)::int],
+    CASE WHEN r8 < 0.45 THEN 'Almaty' WHEN r8 < 0.75 THEN 'Astana' WHEN r8 < 0.85 THEN 'Shymkent' ELSE 'Other' END,
+    CASE WHEN r9 < 0.55 THEN 'POS' WHEN r9 < 0.7 THEN 'ECOM' WHEN r9 < 0.8 THEN 'P2P_OUT' WHEN r9 < 0.88 THEN 'P2P_IN'
+         WHEN r9 < 0.94 THEN 'BILL_PAYMENT' WHEN r9 < 0.98 THEN 'ATM_WITHDRAWAL' ELSE 'SALARY' END,
+    round((100 + r10 * r10 * 500000)::numeric, 2),
+    CASE WHEN r11 < 0.9 THEN NULL ELSE round((1 + r10 * 1000)::numeric, 2) END,
+    CASE WHEN r11 < 0.9 THEN 'KZT' WHEN r11 < 0.95 THEN 'USD' ELSE 'EUR' END,
+    CASE WHEN r11 < 0.9 THEN 'KAZ' WHEN r11 < 0.95 THEN 'USA' ELSE 'DEU' END,
+    CASE WHEN r12 < 0.4 THEN 'Contactless' WHEN r12 < 0.7 THEN 'Chip' WHEN r12 < 0.9 THEN 'QR_Code' ELSE 'Swipe' END,
+    CASE WHEN r12 >= 0.7 AND r12 < 0.9 THEN 'Bank''s QR' WHEN r13 < 0.5 THEN NULL
+         WHEN r13 < 0.7 THEN 'Apple Pay' WHEN r13 < 0.9 THEN 'Google Pay' ELSE 'Samsung Pay' END
+FROM (
+    SELECT g, random() AS r1, random() AS r2, random() AS r3, random() AS r4, random() AS r5, random() AS r6,
+           random() AS r7, random() AS r8, random() AS r9, random() AS r10, random() AS r11, random() AS r12,
+           random() AS r13
+    FROM generate_series(1, :rows) AS g
+) AS s
+"""
+
+_INDEXES = ["transaction_timestamp", "merchant_city", "mcc_category", "transaction_type"]
+
+
+def seed_transactions(database_url: str, rows: int, seed: float = 0.42) -> bool:
+    """
+    Создание синтетической таблицы transactions на rows строк (детерминированно по seed).
+    Таблица с тем же размером и seed переиспользуется; чужая таблица transactions не трогается.
+    Возвращает True, если данные были (пере)созданы.
+    """
+    marker = f"{SEED_MARKER}: rows={rows} seed={seed}"
+    engine = create_engine(database_url)
+    try:
+        with engine.begin() as connection:
+            if inspect(connection).has_table("transactions"):
+                comment = connection.execute(text(
+                    "SELECT obj_description('transactions'::regclass, 'pg_class')"
+                )).scalar() or ""
+                if comment == marker:
+                    return False
+                if not comment.startswith(SEED_MARKER):
+                    raise RuntimeError(
+                        "Table transactions exists and was not created by the benchmark; use a separate database"
+                    )
+                connection.execute(text("DROP TABLE transactions"))
+
+            print(f"Seeding {rows} synthetic transactions...")
+            connection.execute(text(_CREATE_TABLE))
+            connection.execute(text("SELECT setseed(:seed)"), {"seed": seed})
+            connection.execute(text(_INSERT_ROWS), {"rows": rows})
+            for column in _INDEXES:
+                connection.execute(text(f"CREATE INDEX ON transactions ({column})"))
+            connection.execute(text(f"COMMENT ON TABLE transactions IS '{marker}'"))
+
+        with engine.connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT")
+            connection.execute(text("ANALYZE transactions"))
+        return True
+    finally:
+        engine.dispose()
@@ -0,0 +1,114 @@
+"""
+Стратифицированная выборка transactions для быстрого приближенного режима (UserQuery.fast_mode).
+
+Страты - месяц transaction_timestamp и merchant_city. Из каждой страты случайно отбирается
+доля --rate строк (не меньше --min-rows и не больше всей страты). Каждая строка выборки
+получает вес sample_weight (numeric) = строк в страте / отобрано из страты, по которому
+приближенный режим масштабирует COUNT/SUM/AVG до всей таблицы.
+
+Выборка строится в отдельной таблице и подменяет прежнюю одной транзакцией, поэтому
+запросы к ней во время пересборки не прерываются. Параметры последней сборки записываются
+в <table>_info и возвращаются в метаданных приближенных ответов.
+
+Запуск (периодически, например из cron):
+    python build_sample.py                 # 1% выборка
+    python build_sample.py --rate 0.005    # 0.5% выборка
+    python build_sample.py --drop          # удалить выборку (fast mode выполняет точные запросы)
+"""
+import argparse
+import time
+
+from sqlalchemy import create_engine, inspect, text
+
+from app.config import DATABASE_URL, SAMPLE_TABLE
+
+# Выражения, задающие страту
+STRATA = ["DATE_TRUNC('month', transaction_timestamp)", "merchant_city"]
+# Индексы выборки по основным фильтрам
+SAMPLE_INDEXES = ["transaction_timestamp", "merchant_city", "mcc_category"]
+
+
+def build(engine, rate: float, min_rows: int):
+    if not 0 < rate <= 1:
+        raise ValueError("--rate must be in (0, 1]")
+    columns = [column["name"] for column in inspect(engine).get_columns("transactions")]
+    staging = f"{SAMPLE_TABLE}_new"
+    partition = ", ".join(STRATA)
+    selected = ", ".join(columns)
+    # Размер выборки из страты: доля rate, но не меньше min_rows и не больше самой страты
+    take = f"LEAST(stratum_rows, GREATEST({int(min_rows)}, CEIL(stratum_rows * {float(rate)!r})))::bigint"
+
+    started = time.perf_counter()
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {staging}"))
+        print("Sampling transactions...")
+        connection.execute(text(f"""
+            CREATE TABLE {staging} AS
+            SELECT {selected}, stratum_rows::numeric / {take} AS sample_weight
+            FROM (
+                SELECT t.*,
+                       ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY random()) AS stratum_position,
+                       COUNT(*) OVER (PARTITION BY {partition}) AS stratum_rows
+                FROM transactions t
+            ) ranked
+            WHERE stratum_position <= {take}
+        """))
+        for column in SAMPLE_INDEXES:
+            if column in columns:
+                connection.execute(text(f"CREATE INDEX ON {staging} ({column})"))
+
+        stats = connection.execute(text(f"""
+            SELECT COUNT(*), SUM(sample_weight), COUNT(DISTINCT ({partition})) FROM {staging}
+        """)).one()
+        sample_rows, source_rows, strata = int(stats[0]), int(round(stats[1] or 0)), int(stats[2])
+
+        connection.execute(text(f"DROP TABLE IF EXISTS {SAMPLE_TABLE}"))
+        connection.execute(text(f"ALTER TABLE {staging} RENAME TO {SAMPLE_TABLE}"))
+        connection.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {SAMPLE_TABLE}_info (
+                built_at timestamptz NOT NULL,
+                sample_rate double precision NOT NULL,
+                source_rows bigint NOT NULL,
+                sample_rows bigint NOT NULL,
+                strata integer NOT NULL
+            )
+        """))
+        connection.execute(text(f"DELETE FROM {SAMPLE_TABLE}_info"))
+        connection.execute(
+            text(f"""
+                INSERT INTO {SAMPLE_TABLE}_info (built_at, sample_rate, source_rows, sample_rows, strata)
+                VALUES (now(), :rate, :source_rows, :sample_rows, :strata)
+            """),
+            {"rate": rate, "source_rows": source_rows, "sample_rows": sample_rows, "strata": strata}
+        )
+
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT")
+        connection.execute(text(f"ANALYZE {SAMPLE_TABLE}"))
+    print(f"{SAMPLE_TABLE}: {sample_rows:,} of {source_rows:,} rows in {strata:,} strata "
+          f"({time.perf_counter() - started:.1f}s)")
+
+
+def drop(engine):
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {SAMPLE_TABLE}"))
+        connection.execute(text(f"DROP TABLE IF EXISTS {SAMPLE_TABLE}_info"))
+    print(f"Dropped {SAMPLE_TABLE}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=0.01, help="Доля строк каждой страты (по умолчанию 0.01)")
+    parser.add_argument("--min-rows", type=int, default=10, help="Минимум строк из страты (по умолчанию 10)")
+    parser.add_argument("--drop", action="store_true", help="Удалить выборку")
+    args = parser.parse_args()
+
+    engine = create_engine(DATABASE_URL)
+    if args.drop:
+        drop(engine)
+    else:
+        build(engine, args.rate, args.min_rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Словарное кодирование низкокардинальных текстовых столбцов transactions.
+
+Миграция:
+  1. для каждого столбца из ENCODED_COLUMNS создается словарь dict_<column>(code smallint, value text);
+  2. данные переносятся в transactions_fact, где эти столбцы заменены кодами <column>_code smallint;
+  3. исходная таблица переименовывается в transactions_raw (удаляется с --drop-raw);
+  4. создается представление transactions с прежними именами столбцов и строковыми значениями,
+     поэтому сгенерированный SQL работает без изменений;
+  5. INSTEAD OF INSERT триггер на представлении пополняет словари и пишет в transactions_fact,
+     поэтому import_parquet.py продолжает работать.
+
+Запуск:
+    python migrate_dictionary.py            # миграция
+    python migrate_dictionary.py --rollback # возврат к transactions_raw
+"""
+import argparse
+
+from sqlalchemy import create_engine, inspect, text
+
+from app.config import DATABASE_URL
+
+ENCODED_COLUMNS = [
+    "mcc_category",
+    "merchant_city",
+    "transaction_type",
+    "transaction_currency",
+    "acquirer_country_iso",
+    "pos_entry_mode",
+    "wallet_type",
+    "issuer_bank_name",
+]
+# Индексы на fact-таблице (коды и время транзакции)
+FACT_INDEXES = ["transaction_timestamp", "merchant_city_code", "mcc_category_code", "transaction_type_code"]
+SMALLINT_MAX = 32767
+
+
+def _dictionary_sql(column: str) -> list:
+    return [
+        f"""
+        CREATE TABLE dict_{column} (
+            code smallint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            value text NOT NULL UNIQUE
+        )
+        """,
+        f"""
+        INSERT INTO dict_{column} (value)
+        SELECT DISTINCT {column}::text FROM transactions_raw WHERE {column} IS NOT NULL ORDER BY 1
+        """,
+        # Код значения с пополнением словаря (для вставок через представление)
+        f"""
+        CREATE OR REPLACE FUNCTION dict_{column}_code(v text) RETURNS smallint AS $$
+        DECLARE result smallint;
+        BEGIN
+            IF v IS NULL THEN
+                RETURN NULL;
+            END IF;
+            SELECT code INTO result FROM dict_{column} WHERE value = v;
+            IF result IS NULL THEN
+                INSERT INTO dict_{column} (value) VALUES (v)
+                ON CONFLICT (value) DO NOTHING;
+                SELECT code INTO result FROM dict_{column} WHERE value = v;
+            END IF;
+            RETURN result;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+    ]
+
+
+def migrate(engine, drop_raw: bool):
+    if inspect(engine).has_table("transactions_fact"):
+        print("transactions_fact already exists, nothing to migrate")
+        return
+    columns = [column["name"] for column in inspect(engine).get_columns("transactions")]
+    encoded = [column for column in ENCODED_COLUMNS if column in columns]
+    plain = [column for column in columns if column not in encoded]
+
+    with engine.begin() as connection:
+        for column in encoded:
+            distinct = connection.execute(text(f"SELECT COUNT(DISTINCT {column}) FROM transactions")).scalar()
+            if distinct > SMALLINT_MAX:
+                raise RuntimeError(f"Column {column} has {distinct} distinct values, too many for smallint codes")
+
+        connection.execute(text("ALTER TABLE transactions RENAME TO transactions_raw"))
+        for column in encoded:
+            for statement in _dictionary_sql(column):
+                connection.execute(text(statement))
+
+        fact_columns = [f"t.{column}" for column in plain] + [f"d_{column}.code AS {column}_code" for column in encoded]
+        joins = "\n".join(
+            f"LEFT JOIN dict_{column} d_{column} ON d_{column}.value = t.{column}::text" for column in encoded
+        )
+        print("Copying rows into transactions_fact...")
+        connection.execute(text(
+            f"CREATE TABLE transactions_fact AS SELECT {', '.join(fact_columns)} FROM transactions_raw t\n{joins}"
+        ))
+        if "id" in plain:
+            connection.execute(text("ALTER TABLE transactions_fact ADD PRIMARY KEY (id)"))
+        for column in encoded:
+            connection.execute(text(
+                f"ALTER TABLE transactions_fact ADD FOREIGN KEY ({column}_code) REFERENCES dict_{column} (code)"
+            ))
+        for column in FACT_INDEXES:
+            if column in plain or column[:-len("_code")] in encoded:
+                connection.execute(text(f"CREATE INDEX ON transactions_fact ({column})"))
+
+        # Представление с прежними именами и порядком столбцов.
+        # LEFT JOIN по первичному ключу словаря планировщик убирает, если столбец не используется
+        view_columns = [
+            f"d_{column}.value AS {column}" if column in encoded else f"f.{column}" for column in columns
+        ]
+        view_joins = "\n".join(
+            f"LEFT JOIN dict_{column} d_{column} ON d_{column}.code = f.{column}_code" for column in encoded
+        )
+        connection.execute(text(
+            f"CREATE VIEW transactions AS SELECT {', '.join(view_columns)} FROM transactions_fact f\n{view_joins}"
+        ))
+
+        insert_columns = plain + [f"{column}_code" for column in encoded]
+        insert_values = [f"NEW.{column}" for column in plain] + [f"dict_{column}_code(NEW.{column}::text)" for column in encoded]
+        connection.execute(text(f"""
+            CREATE OR REPLACE FUNCTION transactions_view_insert() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO transactions_fact ({', '.join(insert_columns)})
+                VALUES ({', '.join(insert_values)});
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+        """))
+        connection.execute(text(
+            "CREATE TRIGGER transactions_view_insert INSTEAD OF INSERT ON transactions "
+            "FOR EACH ROW EXECUTE FUNCTION transactions_view_insert()"
+        ))
+
+        if drop_raw:
+            connection.execute(text("DROP TABLE transactions_raw"))
+
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT")
+        for table in ["transactions_fact"] + [f"dict_{column}" for column in encoded]:
+            connection.execute(text(f"ANALYZE {table}"))
+    print(f"Encoded columns: {', '.join(encoded)}")
+
+
+def rollback(engine):
+    """Возврат к исходной таблице (если она не была удалена)"""
+    with engine.begin() as connection:
+        connection.execute(text("DROP VIEW IF EXISTS transactions"))
+        connection.execute(text("DROP FUNCTION IF EXISTS transactions_view_insert()"))
+        connection.execute(text("DROP TABLE IF EXISTS transactions_fact"))
+        for column in ENCODED_COLUMNS:
+            connection.execute(text(f"DROP FUNCTION IF EXISTS dict_{column}_code(text)"))
+            connection.execute(text(f"DROP TABLE IF EXISTS dict_{column}"))
+        connection.execute(text("ALTER TABLE transactions_raw RENAME TO transactions"))
+    print("Rolled back to the plain transactions table")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drop-raw", action="store_true", help="Удалить исходную таблицу после миграции")
+    parser.add_argument("--rollback", action="store_true", help="Вернуть исходную таблицу transactions")
+    args = parser.parse_args()
+
+    engine = create_engine(DATABASE_URL)
+    if args.rollback:
+        rollback(engine)
+    else:
+        migrate(engine, args.drop_raw)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import math
+from datetime import date, timedelta
+
+from app.downsampling import downsample_graph
+
+
+def _rows(series: int, days: int, columns: int):
+    start = date(2024, 1, 1)
+    return [
+        {
+            "day": (start + timedelta(days=day)).isoformat(),
+            "merchant_city": f"City {city}",
+            **{f"value_{column}": math.sin(day / 7 + city + column) * (city + 1) for column in range(columns)},
+        }
+        for city in range(series)
+        for day in range(days)
+    ]
+
+
+def test_many_short_series_stay_within_budget():
+    kept, info = downsample_graph(_rows(400, 5, 1), max_points=500)
+    assert len(kept) <= 500
+    assert info["points"] == len(kept)
+    assert info["series"] == 500 // 3
+    assert info["series_dropped"] == 400 - 500 // 3
+
+
+def test_multiple_y_columns_share_the_budget():
+    data = _rows(50, 336, 3)
+    kept, info = downsample_graph(data, max_points=500)
+    assert 450 <= len(kept) <= 500
+    per_series = {}
+    for index in kept:
+        per_series[data[index]["merchant_city"]] = per_series.get(data[index]["merchant_city"], 0) + 1
+    assert len(per_series) == 50
+    assert min(per_series.values()) >= 8
+
+
+def test_single_series_keeps_endpoints():
+    data = _rows(1, 2000, 1)
+    kept, info = downsample_graph(data, max_points=500)
+    assert len(kept) == 500
+    assert kept[0] == 0 and kept[-1] == len(data) - 1
+    assert "series_dropped" not in info
@@ -0,0 +1,21 @@
+from app.sql_fingerprint import analyze_sql
+
+
+def test_group_by_date_trunc_reuses_parameter():
+    shape = analyze_sql(
+        "SELECT DATE_TRUNC('month', transaction_timestamp) AS month, SUM(amount) "
+        "FROM transactions WHERE transaction_timestamp >= '2024-01-01' "
+        "GROUP BY DATE_TRUNC('month', transaction_timestamp) ORDER BY 1"
+    )
+    assert shape.parameterized == (
+        "SELECT date_trunc($1, transaction_timestamp) AS month, sum(amount) "
+        "FROM transactions WHERE transaction_timestamp >= $2 "
+        "GROUP BY date_trunc($1, transaction_timestamp) ORDER BY 1"
+    )
+    assert list(shape.params) == ["month", "2024-01-01"]
+
+
+def test_distinct_literals_get_distinct_parameters():
+    shape = analyze_sql("SELECT COUNT(*) FROM transactions WHERE amount > 10 AND amount < 20")
+    assert shape.parameterized.endswith("amount > $1::integer AND amount < $2::integer")
+    assert list(shape.params) == [10, 20]